@@ -8,6 +8,7 @@ from followthemoney.cli.util import InPath
 import json
 
 from zavod.archive import StatementGen, _read_fh_statements
+from zavod.archive.compression import open_text_file
 from zavod.dedupe import get_dataset_resolver
 from zavod.logs import get_logger
 from zavod.entity import Entity
@@ -41,7 +42,7 @@ class Store(BaseStore):
         self.statements_path = statements_path
 
     def iter_dataset_statements(self, external: bool = False) -> StatementGen:
-        with open(self.statements_path, "r") as fh:
+        with open_text_file(self.statements_path) as fh:
             yield from _read_fh_statements(fh, external)
         return
 
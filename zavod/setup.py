@@ -51,6 +51,8 @@ setup(
         "xlrd == 2.0.1",
         "cryptography",
         "duckdb < 2.0.0",
+        "numpy",
+        "zstandard",
     ],
     tests_require=[],
     entry_points={
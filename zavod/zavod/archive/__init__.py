@@ -12,6 +12,8 @@ from nomenklatura.versions import Version, VersionHistory
 from zavod import settings
 from zavod.logs import get_logger
 from zavod.archive.backend import get_archive_backend, ArchiveObject
+from zavod.archive.columnar import read_columnar_statements
+from zavod.archive.compression import open_text_file
 
 if TYPE_CHECKING:
     from zavod.meta.dataset import Dataset
@@ -20,7 +22,10 @@ log = get_logger(__name__)
 StatementGen = Generator[Statement, None, None]
 DATASETS = "datasets"
 ARTIFACTS = "artifacts"
+SOURCES = "sources"
 STATEMENTS_FILE = "statements.pack"
+STATEMENTS_COLUMNAR_FILE = "statements.parquet"
+TIMESTAMPS_FILE = "timestamps.idx"
 HASH_FILE = "entities.hash"
 DELTA_EXPORT_FILE = "entities.delta.json"
 DELTA_INDEX_FILE = "delta.json"
@@ -31,14 +36,18 @@ RESOURCES_FILE = "resources.json"
 INDEX_FILE = "index.json"
 CATALOG_FILE = "catalog.json"
 VERSIONS_FILE = "versions.json"
+SOURCES_FILE = "sources.json"
 ARTIFACT_FILES = [
     ISSUES_FILE,
     ISSUES_LOG,
     INDEX_FILE,
     STATEMENTS_FILE,
+    STATEMENTS_COLUMNAR_FILE,
+    TIMESTAMPS_FILE,
     STATISTICS_FILE,
     VERSIONS_FILE,
     RESOURCES_FILE,
+    SOURCES_FILE,
     DELTA_EXPORT_FILE,
     DELTA_INDEX_FILE,
     HASH_FILE,
@@ -155,6 +164,29 @@ def get_artifact_object(
     return None
 
 
+def get_statements_version(dataset_name: str) -> Optional[str]:
+    """Get the ID of the version whose statements would be read for the given
+    dataset, or `None` if it cannot be determined."""
+    local_paths = (
+        dataset_resource_path(dataset_name, STATEMENTS_FILE),
+        dataset_resource_path(dataset_name, STATEMENTS_COLUMNAR_FILE),
+    )
+    if any(p.exists() for p in local_paths):
+        path = dataset_resource_path(dataset_name, VERSIONS_FILE)
+        if not path.exists():
+            return None
+        with open(path, "r") as fh:
+            latest = VersionHistory.from_json(fh.read()).latest
+        return latest.id if latest is not None else None
+
+    backend = get_archive_backend()
+    for v in iter_dataset_versions(dataset_name):
+        name = f"{ARTIFACTS}/{dataset_name}/{v.id}/{STATEMENTS_FILE}"
+        if backend.get_object(name).exists():
+            return v.id
+    return None
+
+
 def publish_dataset_version(dataset_name: str) -> None:
     """Publish the history of versions for a given dataset to the artifact directory."""
     path = dataset_resource_path(dataset_name, VERSIONS_FILE)
@@ -222,10 +254,59 @@ def iter_dataset_statements(dataset: "Dataset", external: bool = True) -> Statem
 def iter_local_statements(dataset: "Dataset", external: bool = True) -> StatementGen:
     """Create a generator that yields all statements in the given dataset."""
     assert not dataset.is_collection
+    columnar_path = dataset_resource_path(dataset.name, STATEMENTS_COLUMNAR_FILE)
+    if columnar_path.exists():
+        yield from read_columnar_statements(columnar_path, external=external)
+        return
     path = dataset_resource_path(dataset.name, STATEMENTS_FILE)
     if not path.exists():
         raise FileNotFoundError(f"Statements not found: {dataset.name}")
-    with open(path, "r") as fh:
+    with open_text_file(path) as fh:
+        yield from _read_fh_statements(fh, external)
+
+
+def _columnar_copy_path(dataset_name: str, object: ArchiveObject) -> Path:
+    """Get the local path of a columnar statements file backfilled from the archive.
+    The published versions are immutable, so the copy is kept in a directory named
+    after its version and re-used while that is being read."""
+    prefix, file_name = object.name.rsplit("/", 1)
+    version = prefix.rsplit("/", 1)[-1]
+    return dataset_state_path(dataset_name) / "columnar" / version / file_name
+
+
+def _stream_object_statements(
+    dataset_name: str, object: ArchiveObject, external: bool
+) -> StatementGen:
+    # Prefer a columnar copy of the statements if one was published in the same
+    # version directory as the statement pack:
+    prefix, _ = object.name.rsplit("/", 1)
+    backend = get_archive_backend()
+    columnar = backend.get_object(f"{prefix}/{STATEMENTS_COLUMNAR_FILE}")
+    if columnar.exists():
+        path = _columnar_copy_path(dataset_name, columnar)
+        if not path.exists():
+            log.info(
+                "Backfilling columnar statements...",
+                dataset=dataset_name,
+                object=columnar.name,
+            )
+            # Copies of other versions are no longer needed, but may still be
+            # open in another reader, which keeps reading the unlinked file:
+            if path.parent.parent.exists():
+                for other in path.parent.parent.iterdir():
+                    shutil.rmtree(other, ignore_errors=True)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fetch_path = path.with_name(f"{path.name}.fetch")
+            columnar.backfill(fetch_path)
+            fetch_path.replace(path)
+        yield from read_columnar_statements(path, external=external)
+        return
+    log.info(
+        "Streaming statements...",
+        dataset=dataset_name,
+        object=object.name,
+    )
+    with object.open() as fh:
         yield from _read_fh_statements(fh, external)
 
 
@@ -238,13 +319,7 @@ def _iter_scope_statements(dataset: "Dataset", external: bool = True) -> Stateme
 
     object = get_artifact_object(dataset.name, STATEMENTS_FILE)
     if object is not None:
-        log.info(
-            "Streaming statements...",
-            dataset=dataset.name,
-            object=object.name,
-        )
-        with object.open() as fh:
-            yield from _read_fh_statements(fh, external)
+        yield from _stream_object_statements(dataset.name, object, external)
         return
     log.error(f"Cannot load statements for: {dataset.name}")
 
@@ -257,10 +332,4 @@ def iter_previous_statements(
     for scope in dataset.leaves:
         object = get_artifact_object(dataset.name, STATEMENTS_FILE, version)
         if object is not None:
-            log.info(
-                "Streaming backfilled statements...",
-                dataset=scope.name,
-                object=object.name,
-            )
-            with object.open() as fh:
-                yield from _read_fh_statements(fh, external)
+            yield from _stream_object_statements(scope.name, object, external)
@@ -1,22 +1,98 @@
+import io
+import os
+import json
+import base64
+import hashlib
 import shutil
 import warnings
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from pathlib import Path
 from functools import cache
-from typing import cast, Dict, Optional, Type, TextIO
+from typing import cast, Any, Deque, Dict, Optional, Set, Type, TextIO
 from google.cloud.storage import Client, Blob  # type: ignore
 
 from zavod import settings
 from zavod.logs import get_logger
 from zavod.exc import ConfigurationException
+from zavod.archive.cache import get_artifact_cache
+from zavod.archive.compression import open_text_file, open_text_reader
 
 
 log = get_logger(__name__)
-BLOB_CHUNK = 40 * 1024 * 1024
 warnings.filterwarnings(
     "ignore", "Your application has authenticated using end user credentials"
 )
 
 
+def md5_checksum(path: Path) -> str:
+    """Compute the base64-encoded MD5 digest of a file, in the format used by GCS."""
+    digest = hashlib.md5()
+    with open(path, "rb") as fh:
+        while chunk := fh.read(settings.ARCHIVE_CHUNK_SIZE):
+            digest.update(chunk)
+    return base64.b64encode(digest.digest()).decode("ascii")
+
+
+class RangeReader(io.RawIOBase):
+    """Read an archive object front to back, keeping several range reads of the
+    following chunks in flight."""
+
+    def __init__(self, object: "ArchiveObject") -> None:
+        self.object = object
+        self.size = object.size()
+        self.pool = ThreadPoolExecutor(settings.ARCHIVE_WORKERS)
+        self.pending: Deque["Future[bytes]"] = deque()
+        self.buffer = memoryview(b"")
+        self.pos = 0
+        self.offset = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("Can only seek from the start")
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.buffer = memoryview(b"")
+        self.pos = self.offset = offset
+        return self.pos
+
+    def _fill(self) -> None:
+        while len(self.pending) < settings.ARCHIVE_WORKERS and self.offset < self.size:
+            end = min(self.size, self.offset + settings.ARCHIVE_CHUNK_SIZE)
+            future = self.pool.submit(self.object.read_range, self.offset, end)
+            self.pending.append(future)
+            self.offset = end
+
+    def readinto(self, buffer: Any) -> int:
+        if not len(self.buffer):
+            self._fill()
+            if not len(self.pending):
+                return 0
+            self.buffer = memoryview(self.pending.popleft().result())
+            self._fill()
+        size = min(len(buffer), len(self.buffer))
+        buffer[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        self.pos += size
+        return size
+
+    def close(self) -> None:
+        if not self.closed:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pending.clear()
+        super().close()
+
+
 class ArchiveObject(object):
     def __init__(self, name: str) -> None:
         self.name = name
@@ -27,9 +103,80 @@ class ArchiveObject(object):
     def size(self) -> int:
         raise NotImplementedError
 
-    def backfill(self, dest: Path) -> None:
+    def checksum(self) -> Optional[str]:
+        """The base64-encoded MD5 digest of the object, if known."""
+        return None
+
+    def generation(self) -> Optional[str]:
+        """An identifier of the current version of the object's contents."""
+        return self.checksum()
+
+    def read_range(self, start: int, end: int) -> bytes:
+        """Read the bytes of the object from `start` up to (excluding) `end`."""
         raise NotImplementedError
 
+    def _write_range(self, fd: int, start: int, end: int) -> None:
+        os.pwrite(fd, self.read_range(start, end), start)
+
+    def backfill(self, dest: Path) -> None:
+        """Copy the object to the given path, via the local artifact cache if one is
+        configured."""
+        cache = get_artifact_cache()
+        if cache is not None:
+            with cache.entry(self) as path:
+                if path is not None:
+                    shutil.copyfile(path, dest)
+                    return
+        self.download(dest)
+
+    def download(self, dest: Path) -> None:
+        """Download the object to the given path. The object is fetched in chunks
+        by a pool of threads, into a partial file which is resumed if a previous
+        download of the same object was interrupted. The result is verified against
+        the checksum of the object, if it has one."""
+        size = self.size()
+        checksum = self.checksum()
+        part_path = dest.with_name(f"{dest.name}.part")
+        state_path = dest.with_name(f"{dest.name}.part.json")
+        identity = {"name": self.name, "size": size, "generation": self.generation()}
+        done: Set[int] = set()
+        if part_path.exists() and state_path.exists():
+            with open(state_path, "r") as fh:
+                state = json.load(fh)
+            if state.get("object") == identity:
+                done.update(state.get("chunks", []))
+                log.info("Resuming backfill", name=self.name, chunks=len(done))
+        if not len(done):
+            with open(part_path, "wb") as fh:
+                fh.truncate(size)
+
+        chunk_size = settings.ARCHIVE_CHUNK_SIZE
+        fd = os.open(part_path, os.O_WRONLY)
+        try:
+            with ThreadPoolExecutor(settings.ARCHIVE_WORKERS) as pool:
+                futures: Dict["Future[None]", int] = {}
+                for idx, start in enumerate(range(0, size, chunk_size)):
+                    if idx in done:
+                        continue
+                    end = min(size, start + chunk_size)
+                    futures[pool.submit(self._write_range, fd, start, end)] = idx
+                for future in as_completed(futures):
+                    future.result()
+                    done.add(futures[future])
+                    tmp_path = state_path.with_suffix(".tmp")
+                    with open(tmp_path, "w") as fh:
+                        json.dump({"object": identity, "chunks": sorted(done)}, fh)
+                    tmp_path.replace(state_path)
+        finally:
+            os.close(fd)
+
+        if checksum is not None and md5_checksum(part_path) != checksum:
+            part_path.unlink()
+            state_path.unlink(missing_ok=True)
+            raise RuntimeError("Checksum mismatch in backfill: %s" % self.name)
+        part_path.replace(dest)
+        state_path.unlink(missing_ok=True)
+
     def publish(
         self,
         source: Path,
@@ -43,7 +190,13 @@ class ArchiveObject(object):
         pass
 
     def open(self) -> TextIO:
-        raise NotImplementedError
+        """Open the object to read its text, decompressing it if needed."""
+        cache = get_artifact_cache()
+        if cache is not None:
+            with cache.entry(self) as path:
+                if path is not None:
+                    return open_text_file(path)
+        return open_text_reader(io.BufferedReader(RangeReader(self)))
 
 
 class ArchiveBackend(object):
@@ -78,16 +231,35 @@ class GoogleCloudObject(ArchiveObject):
             return 0
         return self.blob.size or 0
 
+    def checksum(self) -> Optional[str]:
+        if self.blob is None:
+            return None
+        return cast(Optional[str], self.blob.md5_hash)
+
+    def generation(self) -> Optional[str]:
+        if self.blob is None or self.blob.generation is None:
+            return None
+        return str(self.blob.generation)
+
+    def read_range(self, start: int, end: int) -> bytes:
+        if self.blob is None:
+            raise RuntimeError("Object does not exist: %s" % self.name)
+        # The blob is pinned to its generation, so all ranges are read from the
+        # same version of the object:
+        data = self.blob.download_as_bytes(start=start, end=end - 1, checksum=None)
+        return bytes(data)
+
     def open(self) -> TextIO:
         if self.blob is None:
             raise RuntimeError("Object does not exist: %s" % self.name)
         self.blob.reload()
-        return cast(TextIO, self.blob.open(mode="r", chunk_size=BLOB_CHUNK))
+        return super().open()
 
     def backfill(self, dest: Path) -> None:
         if self.blob is None:
             raise RuntimeError("Object does not exist: %s" % self.name)
-        self.blob.download_to_filename(dest)
+        log.info(f"Downloading blob: {self.name}", size=self.size())
+        super().backfill(dest)
 
     def publish(
         self,
@@ -134,21 +306,50 @@ class AnonymousGoogleCloudBackend(GoogleCloudBackend):
 
 
 class FileSystemObject(ArchiveObject):
+    """A file in a local archive directory. When a file is published, its MD5
+    checksum is stored in a sidecar file next to it, together with the version of
+    the file it was computed for, so that downloads of the file can be verified."""
+
     def __init__(self, backend: "FileSystemBackend", name: str) -> None:
         self.backend = backend
         self.path = settings.ARCHIVE_PATH / name
+        self.checksum_path = self.path.with_name(f"{self.path.name}.md5")
         self.name = name
 
     def exists(self) -> bool:
         return self.path.exists()
 
+    def checksum(self) -> Optional[str]:
+        try:
+            with open(self.checksum_path, "r") as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        # A file replaced outside of publish() is not verified:
+        if data.get("generation") != self.generation():
+            return None
+        return cast(Optional[str], data.get("md5"))
+
+    def _write_checksum(self) -> None:
+        data = {"md5": md5_checksum(self.path), "generation": self.generation()}
+        with open(self.checksum_path, "w") as fh:
+            json.dump(data, fh)
+
     def size(self) -> int:
         if not self.path.exists():
             return 0
         return self.path.stat().st_size
 
-    def open(self) -> TextIO:
-        return open(self.path, "r", buffering=BLOB_CHUNK)
+    def generation(self) -> Optional[str]:
+        if not self.path.exists():
+            return None
+        stat = self.path.stat()
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+    def read_range(self, start: int, end: int) -> bytes:
+        with open(self.path, "rb") as fh:
+            fh.seek(start)
+            return fh.read(end - start)
 
     def backfill(self, dest: Path) -> None:
         log.info(
@@ -156,7 +357,7 @@ class FileSystemObject(ArchiveObject):
             source=self.path.as_posix(),
             dest=dest.as_posix(),
         )
-        shutil.copyfile(self.path, dest)
+        super().backfill(dest)
 
     def publish(
         self,
@@ -171,6 +372,7 @@ class FileSystemObject(ArchiveObject):
         )
         self.path.parent.mkdir(parents=True, exist_ok=True)
         shutil.copyfile(source, self.path)
+        self._write_checksum()
 
     def republish(self, source: str) -> None:
         source_path = settings.ARCHIVE_PATH / source
@@ -181,6 +383,7 @@ class FileSystemObject(ArchiveObject):
         )
         self.path.parent.mkdir(parents=True, exist_ok=True)
         shutil.copyfile(source_path, self.path)
+        self._write_checksum()
 
 
 class FileSystemBackend(ArchiveBackend):
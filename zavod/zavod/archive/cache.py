@@ -0,0 +1,147 @@
+"""A size-bounded cache of archive objects on the local disk. Entries are keyed by
+the object name and its generation (or checksum), so a replaced object is never
+served from a stale entry. The cache directory can be shared by several processes
+on the same machine: file locks make sure each object is downloaded only once, and
+that entries are not evicted while they are being read."""
+
+import os
+import fcntl
+import hashlib
+from contextlib import contextmanager
+from functools import cache
+from pathlib import Path
+from typing import TYPE_CHECKING, Generator, List, Optional, Tuple
+
+from zavod import settings
+from zavod.logs import get_logger
+
+if TYPE_CHECKING:
+    from zavod.archive.backend import ArchiveObject
+
+log = get_logger(__name__)
+LOCK_SUFFIX = ".lock"
+TMP_SUFFIX = ".tmp"
+
+
+@contextmanager
+def _locked(path: Path, blocking: bool = True) -> Generator[bool, None, None]:
+    """Hold an exclusive lock on the given lock file. If not `blocking`, yields
+    false when the lock is held by someone else. Lock files are deleted together
+    with their cache entries while locked, so a lock acquired on a file which has
+    since been deleted is not valid, and is taken again on the new file."""
+    while True:
+        with open(path, "a+") as fh:
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(fh, flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                try:
+                    current = os.stat(path).st_ino
+                except FileNotFoundError:
+                    current = None
+                if current != os.fstat(fh.fileno()).st_ino:
+                    continue
+                yield True
+                return
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+class ArtifactCache(object):
+    """Keep copies of archive objects in a local directory, evicting the least
+    recently used entries once the cache grows beyond `max_size` bytes."""
+
+    def __init__(self, path: Path, max_size: int) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _key(self, object: "ArchiveObject") -> Optional[str]:
+        generation = object.generation()
+        if generation is None:
+            return None
+        key = f"{object.name}\0{generation}".encode("utf-8")
+        return hashlib.sha1(key).hexdigest()
+
+    def _paths(self, key: str) -> Tuple[Path, Path]:
+        entry = self.path / key[:2] / key
+        return entry, entry.with_name(f"{key}{LOCK_SUFFIX}")
+
+    @contextmanager
+    def entry(self, object: "ArchiveObject") -> Generator[Optional[Path], None, None]:
+        """Yield the path of the cached copy of the object, downloading it first if
+        needed. The entry will not be evicted until the context is left. Yields
+        `None` if the object cannot be cached."""
+        key = self._key(object)
+        if key is None:
+            yield None
+            return
+        entry, lock = self._paths(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        added = False
+        with _locked(lock):
+            if entry.exists():
+                self.hits += 1
+                # The modification time is used to track recent use:
+                os.utime(entry)
+            else:
+                self.misses += 1
+                log.info("Caching archive object...", name=object.name)
+                tmp_path = entry.with_name(f"{key}.{os.getpid()}{TMP_SUFFIX}")
+                try:
+                    object.download(tmp_path)
+                    tmp_path.replace(entry)
+                finally:
+                    tmp_path.unlink(missing_ok=True)
+                added = True
+            yield entry
+        if added:
+            self.evict()
+
+    def _entries(self) -> List[Tuple[float, int, Path]]:
+        entries: List[Tuple[float, int, Path]] = []
+        for path in self.path.glob("*/*"):
+            if path.name.endswith(LOCK_SUFFIX) or path.name.endswith(TMP_SUFFIX):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self) -> None:
+        """Delete the least recently used entries until the cache fits its size."""
+        with _locked(self.path / f"evict{LOCK_SUFFIX}", blocking=False) as locked:
+            if not locked:
+                return
+            entries = sorted(self._entries())
+            size = sum(s for _, s, _ in entries)
+            for _, entry_size, entry in entries:
+                if size <= self.max_size:
+                    break
+                lock = self._paths(entry.name)[1]
+                with _locked(lock, blocking=False) as free:
+                    if not free:
+                        continue
+                    entry.unlink(missing_ok=True)
+                    lock.unlink(missing_ok=True)
+                    size -= entry_size
+                    log.info("Evicted archive cache entry", entry=entry.name)
+
+    def __repr__(self) -> str:
+        return f"<ArtifactCache({self.path.as_posix()!r})>"
+
+
+@cache
+def get_artifact_cache() -> Optional[ArtifactCache]:
+    """Get the shared cache of archive objects, if one is configured."""
+    if settings.ARCHIVE_CACHE_PATH is None:
+        return None
+    max_size = settings.ARCHIVE_CACHE_SIZE * 1024 * 1024
+    return ArtifactCache(Path(settings.ARCHIVE_CACHE_PATH), max_size)
@@ -0,0 +1,150 @@
+"""Columnar (Parquet) copies of the dataset statement packs, which can be read
+with column selection and an `external` filter pushed down into the scan."""
+
+import duckdb
+from pathlib import Path
+from typing import Any, Generator, Sequence, Tuple
+from nomenklatura.statement import Statement
+
+from zavod.logs import get_logger
+from zavod.archive.compression import get_file_compression
+
+log = get_logger(__name__)
+BATCH_SIZE = 10_000
+PACK_TYPES = {
+    "entity_id": "VARCHAR",
+    "prop": "VARCHAR",
+    "value": "VARCHAR",
+    "dataset": "VARCHAR",
+    "lang": "VARCHAR",
+    "original_value": "VARCHAR",
+    "target": "VARCHAR",
+    "external": "VARCHAR",
+    "first_seen": "VARCHAR",
+    "last_seen": "VARCHAR",
+}
+COLUMNS = (
+    "entity_id",
+    "schema",
+    "prop",
+    "value",
+    "dataset",
+    "lang",
+    "original_value",
+    "target",
+    "external",
+    "first_seen",
+    "last_seen",
+)
+# Empty CSV fields are read as NULL, but only the optional attributes are NULL
+# in a statement; the others are kept as empty strings:
+CONVERT_QUERY = """
+    COPY (
+        SELECT
+            coalesce(entity_id, '') AS entity_id,
+            split_part(prop, ':', 1) AS schema,
+            split_part(prop, ':', 2) AS prop,
+            coalesce(value, '') AS value,
+            coalesce(dataset, '') AS dataset,
+            nullif(lang, '') AS lang,
+            nullif(original_value, '') AS original_value,
+            coalesce(lower(target) LIKE 't%', false) AS target,
+            coalesce(lower(external) LIKE 't%', false) AS external,
+            coalesce(first_seen, '') AS first_seen,
+            coalesce(last_seen, '') AS last_seen
+        FROM read_csv(
+            {source},
+            header = false,
+            auto_detect = false,
+            delim = ',',
+            quote = '"',
+            escape = '"',
+            compression = {compression},
+            columns = {types}
+        )
+    ) TO {dest} (FORMAT PARQUET, COMPRESSION ZSTD)
+"""
+
+
+def _literal(value: str) -> str:
+    """Quote a string as an SQL literal. COPY statements cannot take bound
+    parameters, so paths are escaped instead."""
+    escaped = value.replace("'", "''")
+    return f"'{escaped}'"
+
+
+def write_columnar_statements(pack_path: Path, path: Path) -> None:
+    """Convert a statement pack file into a Parquet file with one column per
+    statement attribute."""
+    log.info("Writing columnar statements...", path=path.as_posix())
+    tmp_path = path.with_suffix(".tmp")
+    types = ", ".join(f"{_literal(k)}: {_literal(v)}" for k, v in PACK_TYPES.items())
+    query = CONVERT_QUERY.format(
+        source=_literal(pack_path.as_posix()),
+        dest=_literal(tmp_path.as_posix()),
+        compression=_literal(get_file_compression(pack_path) or "none"),
+        types=f"{{{types}}}",
+    )
+    con = duckdb.connect()
+    try:
+        con.execute(query)
+    finally:
+        con.close()
+    tmp_path.rename(path)
+
+
+def read_columnar_rows(
+    path: Path,
+    columns: Sequence[str] = COLUMNS,
+    external: bool = True,
+) -> Generator[Tuple[Any, ...], None, None]:
+    """Read the selected columns from a columnar statements file. If `external`
+    is false, enrichment candidates are filtered out before they are decoded."""
+    for column in columns:
+        if column not in COLUMNS:
+            raise ValueError("Invalid statement column: %s" % column)
+    fields = ", ".join(f'"{c}"' for c in columns)
+    query = f"SELECT {fields} FROM read_parquet(?)"
+    if not external:
+        query = f"{query} WHERE external IS NOT TRUE"
+    con = duckdb.connect()
+    try:
+        results = con.execute(query, [path.as_posix()])
+        while batch := results.fetchmany(BATCH_SIZE):
+            yield from batch
+    finally:
+        con.close()
+
+
+def read_columnar_statements(
+    path: Path, external: bool = True
+) -> Generator[Statement, None, None]:
+    """Read all statements from a columnar statements file."""
+    for row in read_columnar_rows(path, COLUMNS, external=external):
+        (
+            entity_id,
+            schema,
+            prop,
+            value,
+            dataset,
+            lang,
+            original_value,
+            target,
+            external_,
+            first_seen,
+            last_seen,
+        ) = row
+        yield Statement(
+            entity_id=entity_id,
+            prop=prop,
+            schema=schema,
+            value=value,
+            dataset=dataset,
+            lang=lang,
+            original_value=original_value,
+            first_seen=first_seen,
+            last_seen=last_seen,
+            target=target,
+            external=external_,
+        )
+
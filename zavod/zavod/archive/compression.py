@@ -0,0 +1,128 @@
+"""Compression of archived text files, like the statement packs. Compressed files
+are recognised by their magic bytes, so they can be read without knowing how they
+were written. Decompression runs in a background thread, so that it overlaps with
+the parsing of the text by the reader."""
+
+import io
+import gzip
+import queue
+import threading
+import zstandard
+from pathlib import Path
+from typing import IO, Any, List, Optional, TextIO, Union, cast
+
+GZIP = "gzip"
+ZSTD = "zstd"
+MAGIC = {GZIP: b"\x1f\x8b", ZSTD: b"\x28\xb5\x2f\xfd"}
+CHUNK_SIZE = 4 * 1024 * 1024
+PREFETCH_CHUNKS = 4
+ENCODING = "utf-8"
+
+
+def detect_compression(head: bytes) -> Optional[str]:
+    """Determine the compression of a file from its first bytes."""
+    for compression, magic in MAGIC.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def get_file_compression(path: Path) -> Optional[str]:
+    with open(path, "rb") as fh:
+        return detect_compression(fh.read(4))
+
+
+def open_text_writer(
+    path: Path, compression: Optional[str] = None, encoding: str = ENCODING
+) -> TextIO:
+    """Open a text file for writing, compressed with the given algorithm."""
+    if compression is None or not len(compression):
+        return open(path, "w", encoding=encoding)
+    if compression == GZIP:
+        return cast(TextIO, gzip.open(path, "wt", encoding=encoding, compresslevel=6))
+    if compression == ZSTD:
+        return cast(TextIO, zstandard.open(path, "wt", encoding=encoding))
+    raise ValueError("Invalid compression: %s" % compression)
+
+
+class PrefetchReader(io.RawIOBase):
+    """Read a binary stream in a background thread, a few chunks ahead of the
+    consumer."""
+
+    def __init__(
+        self, stream: IO[bytes], closing: Optional[List[IO[bytes]]] = None
+    ) -> None:
+        self.stream = stream
+        self.closing = closing or []
+        self.queue: "queue.Queue[Union[bytes, BaseException]]" = queue.Queue(
+            maxsize=PREFETCH_CHUNKS
+        )
+        self.buffer = memoryview(b"")
+        self.eof = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _put(self, item: Union[bytes, BaseException]) -> None:
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _run(self) -> None:
+        try:
+            while not self.stopped.is_set():
+                chunk = self.stream.read(CHUNK_SIZE)
+                self._put(chunk)
+                if not chunk:
+                    return
+        except Exception as exc:
+            self._put(exc)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        if not len(self.buffer) and not self.eof:
+            item = self.queue.get()
+            if isinstance(item, BaseException):
+                raise item
+            self.eof = not len(item)
+            self.buffer = memoryview(item)
+        size = min(len(buffer), len(self.buffer))
+        buffer[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def close(self) -> None:
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.stream.close()
+            for fh in self.closing:
+                fh.close()
+        super().close()
+
+
+def open_text_reader(fh: IO[bytes], encoding: str = ENCODING) -> TextIO:
+    """Wrap a seekable binary file handle to read text, decompressing it if
+    needed."""
+    head = fh.read(4)
+    fh.seek(0)
+    stream: IO[bytes]
+    compression = detect_compression(head)
+    if compression == GZIP:
+        stream = cast(IO[bytes], gzip.GzipFile(fileobj=fh, mode="rb"))
+    elif compression == ZSTD:
+        stream = cast(IO[bytes], zstandard.ZstdDecompressor().stream_reader(fh))
+    else:
+        return io.TextIOWrapper(fh, encoding=encoding)
+    reader = io.BufferedReader(PrefetchReader(stream, closing=[fh]))
+    return io.TextIOWrapper(reader, encoding=encoding)
+
+
+def open_text_file(path: Path, encoding: str = ENCODING) -> TextIO:
+    """Open a text file for reading, decompressing it if needed."""
+    return open_text_reader(open(path, "rb"), encoding=encoding)
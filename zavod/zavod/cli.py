@@ -17,15 +17,16 @@ from zavod.archive import clear_data_path, dataset_state_path
 from zavod.exporters import export_dataset
 from zavod.integration import get_resolver, get_dataset_linker
 from zavod.integration.dedupe import blocking_xref, merge_entities
-from zavod.integration.dedupe import explode_cluster
+from zavod.integration.dedupe import explode_cluster, INDEX_TYPES
 from zavod.runtime.versions import make_version
+from zavod.runtime.cache import get_cache
 from zavod.publish import publish_dataset, publish_failure
 from zavod.tools.load_db import load_dataset_to_db
 from zavod.tools.dump_file import dump_dataset_to_file
 from zavod.tools.summarize import summarize as _summarize
 from zavod.exc import RunFailedException
 from zavod.tools.wikidata import run_app
-from zavod.validators import validate_dataset
+from zavod.validators import VALIDATORS, validate_dataset
 
 
 log = get_logger(__name__)
@@ -150,10 +151,9 @@ def run(
     store = get_store(dataset, linker)
     # Validate
     try:
-        store.sync(clear=True)
+        # Collections only re-load the sources which have changed:
+        store.sync(clear=not dataset.is_collection, incremental=dataset.is_collection)
         view = store.view(dataset, external=False)
-        if not dataset.is_collection:
-            validate_dataset(dataset, view)
     except Exception:
         log.exception("Validation failed for %r" % dataset.name)
         publish_failure(dataset, latest=latest)
@@ -161,7 +161,18 @@ def run(
         sys.exit(1)
     # Export and Publish
     try:
-        export_dataset(dataset, view)
+        # Leaf datasets are validated and exported in a single pass over the store:
+        validators = [] if dataset.is_collection else VALIDATORS
+        export_dataset(dataset, view, validators=validators)
+    except RunFailedException:
+        log.error("Validation failed for %r" % dataset.name)
+        publish_failure(dataset, latest=latest)
+        store.close()
+        sys.exit(1)
+    except Exception:
+        log.exception("Failed to export and publish %r" % dataset.name)
+        sys.exit(1)
+    try:
         publish_dataset(dataset, latest=latest)
 
         if not dataset.is_collection and dataset.load_db_uri is not None:
@@ -238,6 +249,20 @@ def dump_file(
     default=None,
     help="Threshold for conflicting match reporting",
 )
+@click.option(
+    "-w",
+    "--score-workers",
+    type=int,
+    default=1,
+    help="Number of processes used to score candidates",
+)
+@click.option(
+    "-i",
+    "--index-type",
+    type=click.Choice(sorted(INDEX_TYPES)),
+    default="duckdb",
+    help="Blocking index used to generate candidates",
+)
 def xref(
     dataset_paths: List[Path],
     clear: bool,
@@ -248,6 +273,8 @@ def xref(
     schema: Optional[str] = None,
     conflicting_match_threshold: Optional[float] = None,
     discount_internal: float = 1.0,
+    score_workers: int = 1,
+    index_type: str = "duckdb",
 ) -> None:
     dataset = _load_datasets(dataset_paths)
     resolver = get_resolver()
@@ -263,6 +290,8 @@ def xref(
         schema_range=schema,
         conflicting_match_threshold=conflicting_match_threshold,
         discount_internal=discount_internal,
+        score_workers=score_workers,
+        index_type=index_type,
     )
 
 
@@ -316,6 +345,19 @@ def clear(dataset_path: Path) -> None:
         sys.exit(1)
 
 
+@cli.command("cache-sweep", help="Delete cached content no longer referred to")
+@click.argument("dataset_path", type=InPath)
+def cache_sweep(dataset_path: Path) -> None:
+    try:
+        dataset = _load_dataset(dataset_path)
+        cache = get_cache(dataset)
+        cache.sweep_blobs()
+        cache.close()
+    except Exception:
+        log.exception("Failed to sweep cache: %s" % dataset_path)
+        sys.exit(1)
+
+
 @cli.command("summarize")
 @click.argument("dataset_path", type=InPath)
 @click.option("-c", "--clear", is_flag=True, default=False)
@@ -1,8 +1,11 @@
 import orjson
 from pathlib import Path
 from datetime import datetime
+from collections import deque
 from functools import cached_property
-from typing import Any, Optional, Union, Dict, List
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Optional, Union, Dict, Iterable, List
+from typing import Deque, Generator, Tuple
 from requests import Response
 from prefixdate import DatePrefix
 from lxml import html, etree
@@ -11,6 +14,7 @@ from followthemoney.schema import Schema
 from followthemoney.util import make_entity_id
 from nomenklatura.versions import Version
 from nomenklatura.cache import Cache
+from nomenklatura.statement import Statement
 from nomenklatura.util import PathLike
 from rigour.urls import build_url, ParamsType
 from structlog.contextvars import clear_contextvars, bind_contextvars
@@ -20,19 +24,24 @@ from zavod.audit import inspect
 from zavod.meta import Dataset, DataResource
 from zavod.entity import Entity
 from zavod.archive import dataset_resource_path, dataset_data_path
+from zavod.archive import iter_previous_statements
 from zavod.runtime.versions import get_latest
 from zavod.runtime.stats import ContextStats
 from zavod.runtime.sink import DatasetSink
 from zavod.runtime.issues import DatasetIssues
 from zavod.runtime.resources import DatasetResources
-from zavod.runtime.timestamps import TimeStampIndex
+from zavod.runtime.sources import DatasetSources
+from zavod.runtime.timestamps import TimeStampIndex, StatementTimestamps
 from zavod.runtime.cache import get_cache
 from zavod.runtime.versions import make_version
 from zavod.runtime.http_ import fetch_file, make_session, request_hash
+from zavod.runtime.http_ import download_file
 from zavod.runtime.http_ import _Auth, _Headers, _Body
 from zavod.logs import get_logger
 from zavod.util import join_slug, prefixed_hash_id
 
+EMIT_BATCH_SIZE = 10_000
+
 
 class Context:
     """The context is a utility object that is passed as an argument into crawlers
@@ -52,8 +61,9 @@ class Context:
         self.sink = DatasetSink(dataset)
         self.issues = DatasetIssues(dataset)
         self.resources = DatasetResources(dataset)
+        self.sources = DatasetSources(dataset)
         self.log = get_logger(dataset.name)
-        self.http = make_session(dataset.http)
+        self.http = make_session(dataset.http, stats=self.stats.http)
         self._cache: Optional[Cache] = None
         self._timestamps: Optional[TimeStampIndex] = None
 
@@ -188,17 +198,64 @@ class Context:
         data: _Body = None,
     ) -> Path:
         """Fetch a URL into a file located in the current run folder,
-        if it does not exist."""
-        return fetch_file(
+        if it does not exist.
+
+        If `archive_sources` is set in the `http` section of the dataset metadata,
+        a copy of the file is archived with the version of the dataset. The next
+        run then only downloads the file again if the server reports that it has
+        changed, and otherwise uses the archived copy (see `is_source_unchanged`).
+        """
+        data_path = dataset_data_path(self.dataset.name)
+        out_path = data_path.joinpath(name)
+        if not self.dataset.http.archive_sources or method != "GET":
+            return fetch_file(
+                self.http,
+                url,
+                name,
+                data_path=data_path,
+                auth=auth,
+                headers=headers,
+                method=method,
+                data=data,
+            )
+        if out_path.exists():
+            return out_path
+        key = request_hash(url, auth=auth, method=method, data=data)
+        object = self.sources.get_object(key)
+        request_headers: Dict[str, str] = dict(headers or {})
+        if object is not None:
+            request_headers.update(self.sources.conditional_headers(key))
+        response = download_file(
             self.http,
             url,
-            name,
-            data_path=dataset_data_path(self.dataset.name),
+            out_path,
             auth=auth,
-            headers=headers,
+            headers=request_headers,
             method=method,
             data=data,
         )
+        if response.status_code == 304:
+            if object is None:
+                raise RuntimeError("Source is unchanged, but not archived: %s" % url)
+            self.log.info("Source is unchanged", url=url, object=object.name)
+            object.backfill(out_path)
+            self.sources.reuse(key)
+        else:
+            self.sources.save(key, name, out_path, response, self.version.id)
+        return out_path
+
+    def is_source_unchanged(self, name: str) -> bool:
+        """Check if a file fetched with `fetch_resource` has not changed on the
+        server since the previous version of the dataset. A crawler can then skip
+        parsing it, and use `emit_previous` instead.
+
+        Args:
+            name: The name of the file, as passed to `fetch_resource`.
+
+        Returns:
+            True if the archived copy of the file was used.
+        """
+        return name in self.sources.unchanged
 
     def fetch_response(
         self,
@@ -248,6 +305,22 @@ class Context:
         response.raise_for_status()
         return response
 
+    def _get_cached_text(
+        self, url: str, fingerprint: str, method: str, cache_days: int
+    ) -> Optional[str]:
+        text = None
+        if method == "GET":
+            # keeping the old caching keys that was GET requests only
+            text = self.cache.get(url, max_age=cache_days)
+
+        if text is None:
+            # if the old cache is empty, try to get the cache by fingerprint
+            text = self.cache.get(fingerprint, max_age=cache_days)
+
+        if text is not None:
+            self.log.debug("HTTP cache hit", url=url, fingerprint=fingerprint)
+        return text
+
     def fetch_text(
         self,
         url: str,
@@ -278,18 +351,8 @@ class Context:
 
         if cache_days is not None:
             fingerprint = request_hash(url, auth=auth, method=method, data=data)
-            text = None
-
-            if method == "GET":
-                # keeping the old caching keys that was GET requests only
-                text = self.cache.get(url, max_age=cache_days)
-
-            if text is None:
-                # if the old cache is empty, try to get the cache by fingerprint
-                text = self.cache.get(fingerprint, max_age=cache_days)
-
+            text = self._get_cached_text(url, fingerprint, method, cache_days)
             if text is not None:
-                self.log.debug("HTTP cache hit", url=url, fingerprint=fingerprint)
                 return text
 
         response = self.fetch_response(
@@ -395,6 +458,90 @@ class Context:
                 raise
         raise ValueError("Invalid HTML document: %s" % url)
 
+    def _fetch_text_uncached(
+        self,
+        url: str,
+        headers: _Headers,
+        auth: _Auth,
+        method: str,
+        data: _Body,
+    ) -> Optional[str]:
+        response = self.fetch_response(
+            url, headers=headers, auth=auth, method=method, data=data
+        )
+        return response.text
+
+    def fetch_many(
+        self,
+        urls: Iterable[str],
+        headers: _Headers = None,
+        auth: _Auth = None,
+        cache_days: Optional[int] = None,
+        method: str = "GET",
+        data: _Body = None,
+        ordered: bool = True,
+    ) -> Generator[Tuple[str, Optional[str]], None, None]:
+        """Execute HTTP requests for many URLs concurrently and yield the decoded
+        response bodies. Up to `max_concurrency` requests (see the `http` section
+        of the dataset metadata) are run at the same time, and the `rate_limit`
+        for each host is observed. Responses are cached like in `fetch_text`.
+
+        Args:
+            urls: The URLs to be fetched.
+            headers: HTTP request headers to be included.
+            auth: HTTP basic authorization username and password to be included.
+            cache_days: Number of days to retain cached responses for. `None` to disable.
+            method: The HTTP method to use for the requests.
+            data: The data to be sent in the request bodies.
+            ordered: Yield the responses in the order of the URLs, rather than
+                as soon as they are received.
+
+        Returns:
+            A generator of `(url, text)` tuples.
+        """
+        workers = max(1, self.dataset.http.max_concurrency)
+        Pending = Tuple[str, Optional[str], Future[Optional[str]]]
+        pending: Deque[Pending] = deque()
+
+        def next_done() -> Tuple[str, Optional[str]]:
+            if ordered:
+                url, fingerprint, future = pending.popleft()
+            else:
+                wait([f for _, _, f in pending], return_when=FIRST_COMPLETED)
+                item = next(p for p in pending if p[2].done())
+                pending.remove(item)
+                url, fingerprint, future = item
+            text = future.result()
+            if fingerprint is not None and text is not None:
+                self.cache.set(fingerprint, text)
+            return url, text
+
+        pool = ThreadPoolExecutor(workers)
+        try:
+            for url in urls:
+                fingerprint: Optional[str] = None
+                text: Optional[str] = None
+                if cache_days is not None:
+                    fingerprint = request_hash(url, auth=auth, method=method, data=data)
+                    text = self._get_cached_text(url, fingerprint, method, cache_days)
+                future: Future[Optional[str]]
+                if text is not None:
+                    future = Future()
+                    future.set_result(text)
+                    pending.append((url, None, future))
+                else:
+                    future = pool.submit(
+                        self._fetch_text_uncached, url, headers, auth, method, data
+                    )
+                    pending.append((url, fingerprint, future))
+                # Keep the workers busy, but don't queue up all the URLs:
+                while len(pending) > workers * 2:
+                    yield next_done()
+            while len(pending):
+                yield next_done()
+        finally:
+            pool.shutdown(cancel_futures=True)
+
     def clear_url(self, fingerprint: str) -> None:
         """
         Remove a given URL from the cache using request fingerprint
@@ -535,6 +682,78 @@ class Context:
         """
         if entity.id is None:
             raise ValueError("Entity has no ID: %r", entity)
+        stamps = StatementTimestamps({})
+        if not self.dry_run:
+            stamps = self.timestamps.get(entity.id)
+        self._emit(entity, stamps, target, external)
+
+    def emit_many(
+        self,
+        entities: Iterable[Entity],
+        target: bool = False,
+        external: bool = False,
+        batch_size: int = EMIT_BATCH_SIZE,
+    ) -> None:
+        """Send a sequence of entities to be stored. The entities are buffered, and
+        the timestamps of each batch are looked up in one ordered pass over the
+        timestamp index. This is faster than calling `emit` for each entity when a
+        crawler produces a large number of entities. Entities must not be modified
+        after they have been passed in, since they may not have been stored yet.
+
+        Args:
+            entities: The entities to be stored.
+            target: Whether the entities are targets of the dataset.
+            external: Whether the entities are enrichment candidates or already
+                part of the dataset.
+            batch_size: The number of entities to buffer.
+        """
+        batch: List[Entity] = []
+        for entity in entities:
+            batch.append(entity)
+            if len(batch) >= batch_size:
+                self._emit_batch(batch, target, external)
+                batch = []
+        if len(batch):
+            self._emit_batch(batch, target, external)
+
+    def emit_previous(self) -> None:
+        """Emit the entities of the previous version of the dataset again, e.g.
+        when its source data has not changed. The statements keep their first_seen
+        date, and are marked as seen in this run."""
+        statements: List[Statement] = []
+        for stmt in iter_previous_statements(self.dataset, external=True):
+            if len(statements) and statements[0].entity_id != stmt.entity_id:
+                self._emit_previous(statements)
+                statements = []
+            statements.append(stmt)
+        if len(statements):
+            self._emit_previous(statements)
+
+    def _emit_previous(self, statements: List[Statement]) -> None:
+        entity = Entity.from_statements(self.dataset, statements)
+        target = any(s.target for s in statements)
+        external = all(s.external for s in statements)
+        self.emit(entity, target=target, external=external)
+
+    def _emit_batch(self, batch: List[Entity], target: bool, external: bool) -> None:
+        stamps: Dict[str, StatementTimestamps] = {}
+        if not self.dry_run:
+            ids = [e.id for e in batch if e.id is not None]
+            stamps = self.timestamps.get_many(ids)
+        for entity in batch:
+            if entity.id is None:
+                raise ValueError("Entity has no ID: %r", entity)
+            entity_stamps = stamps.get(entity.id, StatementTimestamps({}))
+            self._emit(entity, entity_stamps, target, external)
+
+    def _emit(
+        self,
+        entity: Entity,
+        stamps: StatementTimestamps,
+        target: bool,
+        external: bool,
+    ) -> None:
+        assert entity.id is not None
         if len(entity.properties) == 0:
             self.log.error("Entity has no properties", entity=entity)
             return
@@ -547,7 +766,6 @@ class Context:
                 targets=self.stats.targets,
                 statements=self.stats.statements,
             )
-        stamps = {} if self.dry_run else self.timestamps.get(entity.id)
         for stmt in entity.statements:
             if stmt.id is None:
                 self.log.warn("Statement has no ID", stmt=stmt.to_dict())
@@ -44,6 +44,8 @@ def crawl_dataset(dataset: Dataset, dry_run: bool = False) -> ContextStats:
             statements=context.stats.statements,
             changed=context.stats.changed,
         )
+        if context.stats.http.requests > 0:
+            context.log.info("HTTP statistics", **context.stats.http.as_dict())
         if settings.DEBUG:
             context.debug_lookups()
         return context.stats
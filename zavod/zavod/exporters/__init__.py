@@ -1,9 +1,18 @@
-from typing import List, Dict, Type, Set
+import multiprocessing
+from pathlib import Path
+from shutil import rmtree
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import List, Dict, Optional, Sequence, Type, Set, Tuple
 
+from zavod import settings
 from zavod.logs import get_logger
-from zavod.store import View
+from zavod.store import View, CachedView, Shard, Store, cached_view
+from zavod.store import get_entity_shards, iter_shard_entities
 from zavod.context import Context
+from zavod.exc import RunFailedException
 from zavod.meta import Dataset
+from zavod.archive import dataset_resource_path, dataset_state_path
+from zavod.archive import HASH_FILE, DELTA_INDEX_FILE
 from zavod.exporters.common import Exporter
 from zavod.exporters.ftm import FtMExporter
 from zavod.exporters.nested import NestedTargetsJSONExporter
@@ -17,6 +26,7 @@ from zavod.exporters.statements import StatementsCSVExporter
 from zavod.exporters.delta import DeltaExporter
 from zavod.exporters.metadata import write_dataset_index, write_issues
 from zavod.exporters.metadata import write_catalog, write_delta_index
+from zavod.validators.common import BaseValidator
 
 log = get_logger(__name__)
 
@@ -45,7 +55,157 @@ EXPORTERS: Dict[str, Type[Exporter]] = {
 __all__ = ["export_dataset", "write_dataset_index", "write_issues"]
 
 
-def export_data(context: Context, view: View) -> None:
+# Shared with the forked export workers, which cannot be sent the (unpicklable)
+# view and dataset objects:
+_shard_source: Optional[Tuple[Dataset, CachedView]] = None
+
+
+def _part_path(path: Path, idx: int) -> Path:
+    return path.with_name(f"{path.name}.{idx}.part")
+
+
+def _snapshot_path(dataset: Dataset, idx: int) -> Path:
+    return dataset_state_path(dataset.name) / f"export-store.{idx}"
+
+
+def _export_shard(names: List[str], idx: int, shard: Shard) -> List[Dict[str, int]]:
+    assert _shard_source is not None, "Export worker has no view"
+    dataset, parent_view = _shard_source
+    # LevelDB handles are not fork-safe, so each worker reads its own snapshot
+    # of the store instead of the handle inherited from the parent:
+    parent_store = parent_view.store
+    assert isinstance(parent_store, Store), parent_store
+    store = Store(dataset, parent_store.linker, path=_snapshot_path(dataset, idx))
+    view = CachedView(store, parent_view.scope, external=parent_view.external)
+    context = Context(dataset, dry_run=True)
+    try:
+        exporters = [EXPORTERS[name](context, view) for name in names]
+        for exporter in exporters:
+            exporter.path = _part_path(exporter.path, idx)
+            exporter.setup()
+        for count, entity in enumerate(iter_shard_entities(view, shard)):
+            if count > 0 and count % 10000 == 0:
+                log.info(
+                    "Exported %s entities in shard %s..." % (count, idx),
+                    dataset=dataset.name,
+                )
+            for exporter in exporters:
+                exporter.feed(entity)
+        for exporter in exporters:
+            exporter.finish()
+        view.log_stats()
+        return [exporter.get_counts() for exporter in exporters]
+    finally:
+        context.close()
+        store.close()
+
+
+def _feed_entities(
+    context: Context,
+    view: CachedView,
+    exporters: List[Exporter],
+    validators: List[BaseValidator],
+) -> None:
+    for exporter in exporters:
+        exporter.setup()
+    for validator in validators:
+        validator.attach(exporters)
+
+    for idx, entity in enumerate(view.entities()):
+        if idx > 0 and idx % 10000 == 0:
+            log.info("Exported %s entities..." % idx, dataset=context.dataset.name)
+        for exporter in exporters:
+            exporter.feed(entity)
+        for validator in validators:
+            validator.feed(entity)
+
+    for exporter in exporters:
+        exporter.finish()
+
+
+def _export_entities(
+    context: Context,
+    view: CachedView,
+    exporters: List[Exporter],
+    validators: List[BaseValidator],
+    workers: int,
+) -> None:
+    global _shard_source
+    sharded = [e for e in exporters if e.PARALLEL]
+    serial = [e for e in exporters if not e.PARALLEL]
+    shards = get_entity_shards(view, workers)
+    names = [e.FILE_NAME for e in sharded]
+    log.info(
+        "Exporting in %s shards..." % len(shards),
+        dataset=context.dataset.name,
+        sharded=names,
+    )
+    _shard_source = (context.dataset, view)
+    store = view.store
+    assert isinstance(store, Store), store
+    for idx in range(len(shards)):
+        store.snapshot(_snapshot_path(context.dataset, idx))
+    mp_context = multiprocessing.get_context("fork")
+    try:
+        with ProcessPoolExecutor(workers, mp_context=mp_context) as pool:
+            futures: List[Future[List[Dict[str, int]]]] = []
+            for idx, shard in enumerate(shards):
+                futures.append(pool.submit(_export_shard, names, idx, shard))
+
+            _feed_entities(context, view, serial, validators)
+
+            # The counts reported by the shards, per exporter:
+            counts: List[List[Dict[str, int]]] = [[] for _ in sharded]
+            for future in futures:
+                for idx, shard_counts in enumerate(future.result()):
+                    counts[idx].append(shard_counts)
+    finally:
+        _shard_source = None
+        for idx in range(len(shards)):
+            rmtree(_snapshot_path(context.dataset, idx), ignore_errors=True)
+
+    for exporter, exporter_counts in zip(sharded, counts):
+        parts = [_part_path(exporter.path, idx) for idx in range(len(shards))]
+        exporter.merge(parts, exporter_counts)
+
+
+def _check_validators(
+    context: Context, exporters: List[Exporter], validators: List[BaseValidator]
+) -> None:
+    abort = False
+    for validator in validators:
+        validator.finish()
+        if validator.abort:
+            abort = True
+
+    if abort:
+        # Don't leave behind any outputs which could get published:
+        for exporter in exporters:
+            exporter.path.unlink(missing_ok=True)
+            context.resources.remove(exporter.resource_name)
+        # The delta exporter also writes the entity hashes which the next run's
+        # delta is computed against:
+        for artifact in (HASH_FILE, DELTA_INDEX_FILE):
+            path = dataset_resource_path(context.dataset.name, artifact)
+            path.unlink(missing_ok=True)
+        raise RunFailedException("Validation caused abort.")
+
+
+def export_data(
+    context: Context,
+    view: View,
+    workers: Optional[int] = None,
+    validators: Sequence[Type[BaseValidator]] = (),
+) -> None:
+    """Run the configured exporters over all entities in the view. If more than
+    one worker is configured, exporters which support it are run on shards of
+    the entities in separate processes and their outputs are merged in order.
+
+    The given validators are fed from the same pass over the entities. If any
+    of them aborts, the exported files are removed and `RunFailedException` is
+    raised."""
+    workers = settings.EXPORT_WORKERS if workers is None else workers
+    view = cached_view(view)
     exporter_names = set(context.dataset.exports)
     if not len(exporter_names):
         exporter_names.update(DEFAULT_EXPORTERS)
@@ -57,31 +217,33 @@ def export_data(context: Context, view: View) -> None:
             log.error(f"No exporter found for target: {name}")
             continue
         exporters.append(clazz(context, view))
+    validator_objs = [validator(context, view) for validator in validators]
 
     log.info(
         "Exporting dataset...",
         dataset=context.dataset.name,
         exporters=len(exporters),
+        validators=len(validator_objs),
     )
-    for exporter in exporters:
-        exporter.setup()
-
-    for idx, entity in enumerate(view.entities()):
-        if idx > 0 and idx % 10000 == 0:
-            log.info("Exported %s entities..." % idx, dataset=context.dataset.name)
-        for exporter in exporters:
-            exporter.feed(entity)
-
-    for exporter in exporters:
-        exporter.finish()
+    if workers > 1 and any(e.PARALLEL for e in exporters):
+        _export_entities(context, view, exporters, validator_objs, workers)
+    else:
+        _feed_entities(context, view, exporters, validator_objs)
+    view.log_stats()
+    _check_validators(context, exporters, validator_objs)
 
 
-def export_dataset(dataset: Dataset, view: View) -> None:
-    """Dump the contents of the dataset to the output directory."""
+def export_dataset(
+    dataset: Dataset,
+    view: View,
+    validators: Sequence[Type[BaseValidator]] = (),
+) -> None:
+    """Dump the contents of the dataset to the output directory, optionally
+    validating it in the same pass over the entities."""
     try:
         context = Context(dataset)
         context.begin(clear=False)
-        export_data(context, view)
+        export_data(context, view, validators=validators)
 
         # Export full metadata
         write_issues(dataset)
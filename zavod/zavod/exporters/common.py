@@ -1,3 +1,7 @@
+import shutil
+from pathlib import Path
+from typing import Dict, List
+
 from zavod.entity import Entity
 from zavod.store import View
 from zavod.context import Context
@@ -9,6 +13,10 @@ class Exporter(object):
     FILE_NAME = ""
     TITLE = ""
     MIME_TYPE = "text/plain"
+    PARALLEL = False
+    """The exporter can run on shards of the entities and combine its part files."""
+    HEADER_LINES = 0
+    """Number of header lines to drop from every part file but the first one."""
 
     def __init__(self, context: Context, view: View):
         self.context = context
@@ -23,7 +31,38 @@ class Exporter(object):
     def feed(self, entity: Entity) -> None:
         raise NotImplementedError()
 
+    def get_counts(self) -> Dict[str, int]:
+        """Counts of the exported records, which are logged once the output file
+        is finished. Sharded copies of the exporter report their counts to be
+        summed up when the part files are merged."""
+        return {}
+
+    def merge(self, parts: List[Path], counts: List[Dict[str, int]]) -> None:
+        """Concatenate the part files written by sharded copies of the exporter
+        into the output file, and register it as a resource."""
+        with open(self.path, "wb") as out:
+            for idx, part in enumerate(parts):
+                with open(part, "rb") as fh:
+                    if idx > 0:
+                        for _ in range(self.HEADER_LINES):
+                            fh.readline()
+                    shutil.copyfileobj(fh, out)
+                part.unlink()
+        self.merged(counts)
+
+    def merged(self, counts: List[Dict[str, int]]) -> None:
+        """Register the output file merged from the parts written by sharded
+        copies of the exporter, with the sum of their counts."""
+        totals: Dict[str, int] = {}
+        for part_counts in counts:
+            for key, value in part_counts.items():
+                totals[key] = totals.get(key, 0) + value
+        self._export(totals)
+
     def finish(self) -> None:
+        self._export(self.get_counts())
+
+    def _export(self, counts: Dict[str, int]) -> None:
         try:
             resource = self.context.export_resource(
                 self.path,
@@ -34,10 +73,10 @@ class Exporter(object):
                 "Exported: %s" % self.TITLE,
                 path=self.path,
                 size=resource.size,
+                **counts,
             )
         except ValueError as ve:
             self.context.log.warning(
                 "Export failed: %s" % ve,
                 path=self.path,
             )
-            return
@@ -8,6 +8,7 @@ class FtMExporter(Exporter):
     TITLE = "FollowTheMoney entities"
     FILE_NAME = "entities.ftm.json"
     MIME_TYPE = "application/json+ftm"
+    PARALLEL = True
 
     def setup(self) -> None:
         super().setup()
@@ -1,14 +1,17 @@
-from typing import Set
+from pathlib import Path
+from typing import Dict, List, Set
 from normality import collapse_spaces
 from followthemoney.types import registry
 
 from zavod.exporters.common import Exporter
 from zavod.entity import Entity
 
+
 class NamesExporter(Exporter):
     TITLE = "Target names text file"
     FILE_NAME = "names.txt"
     MIME_TYPE = "text/plain"
+    PARALLEL = True
 
     def setup(self) -> None:
         super().setup()
@@ -24,6 +27,20 @@ class NamesExporter(Exporter):
                     self.seen_hashes.add(key)
                     self.fh.write(f"{name_collapsed}\n")
 
+    def merge(self, parts: List[Path], counts: List[Dict[str, int]]) -> None:
+        # Names can repeat across the shards, so they are de-duplicated again:
+        seen_hashes: Set[int] = set()
+        with open(self.path, "w") as out:
+            for part in parts:
+                with open(part, "r") as fh:
+                    for line in fh:
+                        key = hash(line.strip().lower())
+                        if key not in seen_hashes:
+                            seen_hashes.add(key)
+                            out.write(line)
+                part.unlink()
+        self.merged(counts)
+
     def finish(self) -> None:
         self.fh.close()
         super().finish()
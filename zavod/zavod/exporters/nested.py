@@ -5,6 +5,8 @@ from zavod.entity import Entity
 
 
 class NestedJSONExporter(Exporter):
+    PARALLEL = True
+
     def setup(self) -> None:
         super().setup()
         self.fh = open(self.path, "wb")
@@ -1,11 +1,10 @@
 import csv
-from typing import Set, Iterable
+from typing import Dict, Set, Iterable
 from normality import collapse_spaces
 from followthemoney.types import registry
 from nomenklatura.util import bool_text
 
 from zavod.entity import Entity
-from zavod.logs import get_logger
 from zavod.runtime.urls import make_entity_url
 from zavod.exporters.common import Exporter
 
@@ -31,8 +30,6 @@ PUBLIC = "corp.public"
 EO_14071 = "ru_nsd_isin"
 CONTEXT_DATASETS = set(["ru_nsd_isin", "permid", "openfigi", "research", "ext_gleif"])
 
-log = get_logger(__name__)
-
 
 def join_cell(texts: Iterable[str], sep: str = ";") -> str:
     values: Set[str] = set()
@@ -50,6 +47,8 @@ class SecuritiesExporter(Exporter):
     TITLE = "Security-centric tabular format"
     FILE_NAME = "securities.csv"
     MIME_TYPE = "text/csv"
+    PARALLEL = True
+    HEADER_LINES = 1
 
     def setup(self) -> None:
         super().setup()
@@ -110,12 +109,13 @@ class SecuritiesExporter(Exporter):
         ]
         self.csv.writerow(row)
 
+    def get_counts(self) -> Dict[str, int]:
+        return {
+            "entities": self._count_entities,
+            "leis": self._count_leis,
+            "isins": self._count_isins,
+        }
+
     def finish(self) -> None:
         self.fh.close()
         super().finish()
-        log.info(
-            "Exported securities",
-            entities=self._count_entities,
-            leis=self._count_leis,
-            isins=self._count_isins,
-        )
@@ -44,6 +44,7 @@ class SenzingExporter(Exporter):
     TITLE = "Senzing entity format"
     FILE_NAME = "senzing.json"
     MIME_TYPE = "application/json+senzing"
+    PARALLEL = True
 
     def setup(self) -> None:
         super().setup()
@@ -13,6 +13,8 @@ class SimpleCSVExporter(Exporter):
     TITLE = "Targets as simplified CSV"
     FILE_NAME = "targets.simple.csv"
     MIME_TYPE = "text/csv"
+    PARALLEL = True
+    HEADER_LINES = 1
 
     HEADERS = [
         "id",
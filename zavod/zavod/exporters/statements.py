@@ -9,6 +9,8 @@ class StatementsCSVExporter(Exporter):
     TITLE = "Statement-based granular CSV"
     FILE_NAME = "statements.csv"
     MIME_TYPE = "text/csv+ftm-statements"
+    PARALLEL = True
+    HEADER_LINES = 1
 
     def setup(self) -> None:
         super().setup()
@@ -1,17 +1,20 @@
-from typing import List, Optional, TYPE_CHECKING
+from typing import Dict, Generator, List, Optional, Tuple, Type, Union, TYPE_CHECKING
 from pathlib import Path
 from functools import cache
 from zavod.entity import Entity
 from followthemoney import model
-from nomenklatura.xref import xref
+from followthemoney.schema import Schema
 from nomenklatura.resolver import Resolver, Identifier, Linker
 from nomenklatura.judgement import Judgement
-from nomenklatura.matching import DefaultAlgorithm, get_algorithm
+from nomenklatura.matching import DefaultAlgorithm, ScoringAlgorithm, get_algorithm
+from nomenklatura.conflicting_match import ConflictingMatchReporter
 
 from zavod import settings
 from zavod.logs import get_logger
 from zavod.meta import Dataset
 from zavod.integration.duckdb_index import DuckDBIndex
+from zavod.integration.numpy_index import NumpyIndex
+from zavod.integration.scoring import PairScorer
 
 if TYPE_CHECKING:
     from zavod.store import Store
@@ -19,6 +22,19 @@ if TYPE_CHECKING:
 log = get_logger(__name__)
 AUTO_USER = "zavod/xref"
 
+BlockingIndex = Union[DuckDBIndex[Dataset, Entity], NumpyIndex[Dataset, Entity]]
+INDEX_TYPES: Dict[str, Type[BlockingIndex]] = {
+    "duckdb": DuckDBIndex,
+    "numpy": NumpyIndex,
+}
+
+
+def get_index_type(name: str) -> Type[BlockingIndex]:
+    """Get the blocking index class with the given name."""
+    if name not in INDEX_TYPES:
+        raise ValueError("Invalid index type: %s" % name)
+    return INDEX_TYPES[name]
+
 
 def _get_resolver_path() -> Path:
     """Get the path to the deduplication resolver."""
@@ -54,10 +70,16 @@ def blocking_xref(
     schema_range: Optional[str] = None,
     discount_internal: float = 1.0,
     conflicting_match_threshold: Optional[float] = None,
+    score_workers: int = 1,
+    index_type: str = "duckdb",
 ) -> None:
     """This runs the deduplication process, which compares all entities in the given
     dataset against each other, and stores the highest-scoring candidates for human
     review. Candidates above the given threshold score will be merged automatically.
+
+    With more than one `score_workers`, candidate pairs are scored by the matching
+    algorithm in a pool of worker processes, with the same decisions as otherwise. `index_type` selects the blocking
+    index used to generate the candidate pairs (see `INDEX_TYPES`).
     """
     resolver = get_resolver()
     resolver.prune()
@@ -68,27 +90,137 @@ def blocking_xref(
     algorithm_type = get_algorithm(algorithm)
     if algorithm_type is None:
         raise ValueError("Invalid algorithm: %s" % algorithm)
+    index_cls = get_index_type(index_type)
     range = model.get(schema_range) if schema_range is not None else None
     index_dir = state_path / "dedupe-index"
 
-    xref(
+    _xref(
         resolver,
         store,
-        index_dir=index_dir,
-        index_type=DuckDBIndex,
+        index_dir,
+        index_cls,
         limit=limit,
         range=range,
-        scored=True,
         auto_threshold=auto_threshold,
         focus_dataset=focus_dataset,
         algorithm=algorithm_type,
         discount_internal=discount_internal,
-        user=AUTO_USER,
         conflicting_match_threshold=conflicting_match_threshold,
+        score_workers=score_workers,
     )
     resolver.save()
 
 
+def _print_stats(pairs: int, suggested: int, scores: List[float]) -> None:
+    log.info(
+        "Xref: %d pairs, %d suggested, avg: %.2f, min: %.2f, max: %.2f"
+        % (
+            pairs,
+            suggested,
+            sum(scores) / max(1, len(scores)),
+            min(scores, default=0.0),
+            max(scores, default=0.0),
+        )
+    )
+
+
+def _xref(
+    resolver: Resolver[Entity],
+    store: "Store",
+    index_dir: Path,
+    index_cls: Type[BlockingIndex],
+    limit: int,
+    range: Optional[Schema],
+    auto_threshold: Optional[float],
+    focus_dataset: Optional[str],
+    algorithm: Type[ScoringAlgorithm],
+    discount_internal: float,
+    conflicting_match_threshold: Optional[float],
+    score_workers: int,
+    limit_factor: int = 10,
+) -> None:
+    """A variant of `nomenklatura.xref.xref` which scores the candidate pairs with a
+    `PairScorer` (in a process pool if there is more than one worker), and then
+    applies the decisions in the order of the index."""
+    view = store.default_view(external=True)
+    index = index_cls(view, index_dir)
+    index.build()
+    reporter: Optional[ConflictingMatchReporter[Entity]] = None
+    if conflicting_match_threshold is not None:
+        reporter = ConflictingMatchReporter(view, resolver, conflicting_match_threshold)
+    scorer = PairScorer(algorithm, store.dataset, workers=score_workers)
+    merged = False
+    pairs = 0
+
+    def candidates() -> (
+        Generator[Tuple[Tuple[Identifier, Identifier], Entity, Entity], None, None]
+    ):
+        nonlocal pairs
+        for (left_id, right_id), _ in index.pairs(max_pairs=limit * limit_factor):
+            pairs += 1
+            if not resolver.check_candidate(left_id, right_id):
+                continue
+            left = view.get_entity(left_id.id)
+            right = view.get_entity(right_id.id)
+            if left is None or left.id is None or right is None or right.id is None:
+                continue
+            if not left.schema.can_match(right.schema):
+                continue
+            if range is not None:
+                if not left.schema.is_a(range) and not right.schema.is_a(range):
+                    continue
+            yield (left_id, right_id), left, right
+
+    suggested = 0
+    scores: List[float] = []
+    try:
+        scored = scorer.score(candidates())
+        for idx, ((left_id, right_id), left, right, score) in enumerate(scored):
+            assert left.id is not None and right.id is not None
+            if idx % 1000 == 0 and idx > 0:
+                _print_stats(pairs, suggested, scores)
+            # Earlier auto-merges may have made the pair obsolete since it was
+            # scored:
+            if merged:
+                if not resolver.check_candidate(left_id, right_id):
+                    continue
+                if not view.has_entity(left.id) or not view.has_entity(right.id):
+                    continue
+            scores.append(score)
+            if reporter is not None:
+                reporter.check_match(score, left.id, right.id)
+
+            if len(left.datasets.intersection(right.datasets)) > 0:
+                score = score * discount_internal
+
+            if auto_threshold is not None and score > auto_threshold:
+                log.info("Auto-merge [%.2f]: %s <> %s" % (score, left, right))
+                canonical_id = resolver.decide(
+                    left_id, right_id, Judgement.POSITIVE, user=AUTO_USER
+                )
+                store.update(canonical_id)
+                merged = True
+                continue
+
+            if focus_dataset in left.datasets and focus_dataset not in right.datasets:
+                score = (score + 1.0) / 2.0
+            if focus_dataset not in left.datasets and focus_dataset in right.datasets:
+                score = (score + 1.0) / 2.0
+
+            resolver.suggest(left.id, right.id, score, user=AUTO_USER)
+            if suggested >= limit:
+                break
+            suggested += 1
+        _print_stats(pairs, suggested, scores)
+        if reporter is not None:
+            reporter.report()
+    except KeyboardInterrupt:
+        log.info("User cancelled, xref will end gracefully.")
+    finally:
+        scorer.close()
+        index.close()
+
+
 def explode_cluster(entity_id: str) -> None:
     """Destroy a cluster of deduplication matches."""
     resolver = get_resolver()
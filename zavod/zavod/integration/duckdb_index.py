@@ -1,19 +1,26 @@
-from io import TextIOWrapper
 from followthemoney.types import registry
 from pathlib import Path
 from shutil import rmtree
-from typing import Any, Dict, Generator, Iterable, List, Optional, Tuple
-import csv
+from typing import Any, Dict, Generator, Iterable, List, Optional, Sequence, Tuple
+import os
+import math
+import heapq
+import itertools
 import duckdb
+import hashlib
 import logging
+import numpy as np
+import resource
 
 from nomenklatura.dataset import DS
 from nomenklatura.entity import CE
 from nomenklatura.index.common import BaseIndex
 from nomenklatura.resolver import Pair, Identifier
 from nomenklatura.store import View
+from nomenklatura.store.level import LevelDBView
 
-from zavod.integration.tokenizer import tokenize_entity
+from zavod.integration.tokenizer import tokenize_entity, tokenize_entities
+from zavod.integration.tokenizer import log_cache_stats
 from zavod.integration.tokenizer import NAME_PART_FIELD, WORD_FIELD, PHONETIC_FIELD
 
 BlockingMatches = List[Tuple[Identifier, float]]
@@ -21,6 +28,70 @@ BlockingMatches = List[Tuple[Identifier, float]]
 log = logging.getLogger(__name__)
 
 BATCH_SIZE = 1000
+INSERT_BATCH_SIZE = 100_000
+MB = 1024 * 1024
+Row = Tuple[str, ...]
+MEMORY_PER_THREAD = 5 * 1024
+"""Memory (MB) to plan for each DuckDB worker thread."""
+PAIR_ROW_BYTES = 128
+"""Estimated memory use of each joined token row in the pairs query."""
+REBUILD_RATIO = 0.2
+"""Share of changed entities above which all entries are re-loaded from a scan of
+the view, rather than by looking up each changed entity."""
+
+
+CGROUP_MEMORY_LIMITS = (
+    Path("/sys/fs/cgroup/memory.max"),
+    Path("/sys/fs/cgroup/memory/memory.limit_in_bytes"),
+)
+
+
+def cgroup_memory_limit() -> Optional[int]:
+    """The memory limit (in bytes) of the container (cgroup v2 or v1), if any."""
+    for path in CGROUP_MEMORY_LIMITS:
+        try:
+            limit = path.read_text().strip()
+        except OSError:
+            continue
+        if limit.isdigit():
+            return int(limit)
+    return None
+
+
+def available_memory() -> int:
+    """The memory (in bytes) available to this process: the physical memory of the
+    machine, or the memory limit of the container if that is lower."""
+    memory: int = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    limit = cgroup_memory_limit()
+    if limit is not None:
+        memory = min(memory, limit)
+    return memory
+
+
+def available_cpus() -> int:
+    """The number of CPUs this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def plan_resources(
+    memory_budget: Optional[int], threads: Optional[int] = None
+) -> Tuple[int, int]:
+    """Pick the number of DuckDB threads and the memory limit (in MB) for an index
+    from the configured memory budget and the cores of the machine. Without a budget,
+    80% of the available memory are used, like the DuckDB default, but observing
+    the memory limit of the container."""
+    if memory_budget is None:
+        memory_budget = int((available_memory() / MB) * 0.8)
+    if threads is None:
+        threads = memory_budget // MEMORY_PER_THREAD
+    threads = max(1, min(available_cpus(), threads))
+    return threads, memory_budget
+
+
+INDEX_FORMAT = "2"
+"""Bump this when the tokenizer or the table layout change, to force a rebuild."""
 
 
 class DuckDBIndex(BaseIndex[DS, CE]):
@@ -30,6 +101,10 @@ class DuckDBIndex(BaseIndex[DS, CE]):
 
     Pairs match if they share one or more tokens. A basic similarity score is calculated
     cumulatively based on each token's Term Frequency (TF) and the field's boost factor.
+
+    The index is kept in `data_dir` between runs. When it is built again for the same
+    scope, only entities from datasets with a new statement version, or with changed
+    entity clusters, are re-tokenized before the frequency tables are recalculated.
     """
 
     BOOSTS = {
@@ -54,56 +129,279 @@ class DuckDBIndex(BaseIndex[DS, CE]):
             int(memory_budget) if memory_budget else None
         )
         """Memory budget in megabytes"""
+        threads = options.get("threads", None)
+        self.threads, self.memory_limit = plan_resources(
+            self.memory_budget, int(threads) if threads else None
+        )
+        pair_partitions = options.get("pair_partitions", None)
+        self.pair_partitions: Optional[int] = (
+            int(pair_partitions) if pair_partitions else None
+        )
+        """Number of partitions to split the pairs query into, planned if unset"""
         self.max_candidates = int(options.get("max_candidates", 50))
         self.stopwords_pct = options.get("stopwords_pct", 1)
         self.data_dir = data_dir
-        if self.data_dir.exists():
+        self.db_path = self.data_dir / "duckdb_index.db"
+        if self.data_dir.exists() and not self._is_reusable():
             rmtree(self.data_dir)
-        self.data_dir.mkdir(parents=True)
-        self.con = duckdb.connect((self.data_dir / "duckdb_index.db").as_posix())
-        self.matching_path = self.data_dir / "matching.csv"
-        self.matching_path.unlink(missing_ok=True)
-        self.matching_dump: TextIOWrapper | None = open(self.matching_path, "w")
-        writer = csv.writer(self.matching_dump)
-        writer.writerow(["id", "field", "token"])
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        self.con = duckdb.connect(self.db_path.as_posix())
+        self.con.execute(
+            "CREATE OR REPLACE TEMP TABLE matching (id TEXT, field TEXT, token TEXT)"
+        )
+        self.matching_rows: Optional[List[Row]] = []
 
         # https://duckdb.org/docs/guides/performance/environment
         # > For ideal performance,
         # > aggregation-heavy workloads require approx. 5 GB memory per thread and
         # > join-heavy workloads require approximately 10 GB memory per thread.
         # > Aim for 5-10 GB memory per thread.
-        if self.memory_budget is not None:
-            self.con.execute("SET memory_limit = ?;", [f"{self.memory_budget}MB"])
+        # Without a configured budget or container limit, DuckDB picks its own.
+        if self.memory_budget is not None or cgroup_memory_limit() is not None:
+            self.con.execute("SET memory_limit = ?;", [f"{self.memory_limit}MB"])
         # > If you have a limited amount of memory, try to limit the number of threads
-        self.con.execute("SET threads = 1;")
+        self.con.execute(f"SET threads = {self.threads};")
+        log.info(
+            "Index resources: %d threads, %d MB memory limit",
+            self.threads,
+            self.memory_limit,
+        )
+
+    @property
+    def _meta(self) -> Dict[str, str]:
+        """Properties of the index which must match for it to be reused."""
+        return {
+            "format": INDEX_FORMAT,
+            "scope": self.view.scope.name,
+            "external": str(self.view.external),
+        }
+
+    def _is_reusable(self) -> bool:
+        """Check if the index in the data directory was built for the same scope
+        and with the same tokenizer, so it can be updated instead of rebuilt."""
+        if not self.db_path.exists():
+            return False
+        try:
+            with duckdb.connect(self.db_path.as_posix(), read_only=True) as con:
+                meta = dict(con.execute("SELECT key, value FROM meta").fetchall())
+        except duckdb.Error:
+            return False
+        for key, value in self._meta.items():
+            if meta.get(key) != value:
+                log.info("Index mismatch (%s), rebuilding: %r", key, self.data_dir)
+                return False
+        return meta.get("complete") == "true"
+
+    def _entity_states(self) -> Optional[Generator[Row, None, None]]:
+        """Fingerprint the contents of each entity in the store without loading it,
+        using the IDs of its statements, which are derived from their values. The
+        statement keys of an entity are contiguous, as they start with its ID. An
+        entity with external statements has a fingerprint for each kind."""
+        if not isinstance(self.view, LevelDBView):
+            return None
+        db = self.view.store.db
+        prefixes = (b"s:", b"x:") if self.view.external else (b"s:",)
+
+        def states() -> Generator[Row, None, None]:
+            for prefix in prefixes:
+                entity_id: Optional[bytes] = None
+                digest = hashlib.sha1()
+                with db.iterator(prefix=prefix, include_value=False) as it:
+                    for key in it:
+                        key_id, stmt_id = key[len(prefix) :].rsplit(b":", 1)
+                        if key_id != entity_id:
+                            if entity_id is not None:
+                                yield entity_id.decode("utf-8"), digest.hexdigest()
+                            entity_id = key_id
+                            digest = hashlib.sha1()
+                        digest.update(stmt_id)
+                if entity_id is not None:
+                    yield entity_id.decode("utf-8"), digest.hexdigest()
+
+        return states()
+
+    def _scoped_ids(self) -> Generator[Row, None, None]:
+        """Yield the IDs of the entities in the store which are part of the view."""
+        assert isinstance(self.view, LevelDBView)
+        previous: Optional[str] = None
+        with self.view.store.db.iterator(prefix=b"e:", include_value=False) as it:
+            for key in it:
+                _, entity_id, dataset = key.decode("utf-8").split(":", 2)
+                if entity_id != previous and dataset in self.view.dataset_names:
+                    previous = entity_id
+                    yield (entity_id,)
+
+    def _insert_batch(
+        self, table: str, columns: Sequence[str], rows: List[Row]
+    ) -> None:
+        data = {c: np.array(v, dtype=object) for c, v in zip(columns, zip(*rows))}
+        self.con.register("insert_batch", data)
+        self.con.execute(f"INSERT INTO {table} SELECT * FROM insert_batch")
+        self.con.unregister("insert_batch")
+
+    def _insert(self, table: str, columns: Sequence[str], rows: Iterable[Row]) -> int:
+        """Stream rows into the given table in batches of column arrays, which DuckDB
+        scans directly without serialising them to a text file first."""
+        count = 0
+        batch: List[Row] = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= INSERT_BATCH_SIZE:
+                self._insert_batch(table, columns, batch)
+                count += len(batch)
+                batch = []
+        if len(batch):
+            self._insert_batch(table, columns, batch)
+            count += len(batch)
+        return count
+
+    def _log_usage(self, stage: str) -> None:
+        """Log the memory and temporary disk use of the database, and the peak
+        memory use of the process."""
+        query = """
+            SELECT sum(memory_usage_bytes), sum(temporary_storage_bytes)
+            FROM duckdb_memory()
+        """
+        res = self.con.execute(query).fetchone()
+        memory, temp = res if res is not None else (0, 0)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        log.info(
+            "%s: %.1f MB in memory, %.1f MB spilled to disk, peak RSS %.1f MB",
+            stage,
+            (memory or 0) / MB,
+            (temp or 0) / MB,
+            rss,
+        )
+
+    def _entity_rows(
+        self, entities: Iterable[Optional[CE]]
+    ) -> Generator[Row, None, None]:
+        def matchable() -> Generator[CE, None, None]:
+            for idx, entity in enumerate(entities):
+                if idx % 50000 == 0 and idx > 0:
+                    log.info("Tokenized %s entities" % idx)
+                if entity is None or entity.id is None:
+                    continue
+                if entity.schema.matchable:
+                    yield entity
+
+        for entity, tokens in tokenize_entities(matchable()):
+            assert entity.id is not None
+            for field, token in tokens:
+                yield entity.id, field, token
+        log_cache_stats()
+
+    def _load_entries(self, entities: Iterable[Optional[CE]]) -> None:
+        log.info("Loading entity tokens into the database...")
+        rows = self._entity_rows(entities)
+        count = self._insert("entries", ("id", "field", "token"), rows)
+        log.info("Loaded %d tokens.", count)
+        self._log_usage("Loaded tokens")
+
+    def _load_states(self, states: Iterable[Row]) -> None:
+        self.con.execute("CREATE OR REPLACE TEMP TABLE parts (id TEXT, state TEXT)")
+        self._insert("parts", ("id", "state"), states)
+        self.con.execute("CREATE OR REPLACE TEMP TABLE scoped (id TEXT)")
+        self._insert("scoped", ("id",), self._scoped_ids())
+        current_query = """
+            CREATE OR REPLACE TEMP TABLE current AS
+            SELECT id, string_agg(state, ',' ORDER BY state) AS state
+            FROM parts SEMI JOIN scoped USING (id)
+            GROUP BY id
+        """
+        self.con.execute(current_query)
+        self.con.execute("DROP TABLE parts")
+        self.con.execute("DROP TABLE scoped")
+
+    def _update_entries(self) -> bool:
+        """Re-index only the entities whose contents have changed since the index
+        was last built, and remove those no longer in the store. If many of them
+        changed, all entries are re-loaded from a scan of the view instead. Returns
+        true if any entries were modified."""
+        changed_query = """
+            CREATE OR REPLACE TEMP TABLE changed AS
+            SELECT current.id FROM current
+            LEFT OUTER JOIN entities ON entities.id = current.id
+            WHERE entities.state IS NULL
+            OR entities.state != current.state
+        """
+        self.con.execute(changed_query)
+        self.con.execute(
+            "CREATE OR REPLACE TEMP TABLE stale AS "
+            "SELECT id FROM entities ANTI JOIN current USING (id)"
+        )
+        counts_query = """
+            SELECT
+                (SELECT count(*) FROM changed),
+                (SELECT count(*) FROM stale),
+                (SELECT count(*) FROM current)
+        """
+        res = self.con.execute(counts_query).fetchone()
+        counts: Tuple[int, int, int] = res if res is not None else (0, 0, 0)
+        num_changed, removed, total = counts
+        log.info("Index update: %d changed, %d removed", num_changed, removed)
+        if num_changed + removed > total * REBUILD_RATIO:
+            log.info("Re-loading all entities into the index...")
+            self.con.execute("DELETE FROM entries")
+            self._load_entries(self.view.entities())
+        elif num_changed or removed:
+            self.con.execute(
+                "DELETE FROM entries WHERE id IN (SELECT id FROM changed) "
+                "OR id IN (SELECT id FROM stale)"
+            )
+            changed = self.con.execute("SELECT id FROM changed").fetchall()
+            self._load_entries(self.view.get_entity(i) for (i,) in changed)
+        self.con.execute("DROP TABLE changed")
+        self.con.execute("DROP TABLE stale")
+        return num_changed > 0 or removed > 0
 
     def build(self) -> None:
-        """Index all entities in the dataset."""
+        """Index all entities in the dataset. If the index has been built before
+        for the same scope, only the entities which changed since are re-indexed."""
         log.info("Building index from: %r...", self.view)
-        self.con.execute("CREATE TABLE boosts (field TEXT, boost FLOAT)")
+        self.con.execute("CREATE OR REPLACE TABLE boosts (field TEXT, boost FLOAT)")
         for field, boost in self.BOOSTS.items():
             self.con.execute("INSERT INTO boosts VALUES (?, ?)", [field, boost])
 
-        self.con.execute("CREATE TABLE matching (id TEXT, field TEXT, token TEXT)")
-        self.con.execute("CREATE TABLE entries (id TEXT, field TEXT, token TEXT)")
-        csv_path = self.data_dir / "mentions.csv"
-        log.info("Dumping entity tokens to CSV for bulk load into the database...")
-        with open(csv_path, "w") as fh:
-            writer = csv.writer(fh)
-            for idx, entity in enumerate(self.view.entities()):
-                if not entity.schema.matchable or entity.id is None:
-                    continue
-                for field, token in tokenize_entity(entity):
-                    writer.writerow([entity.id, field, token])
+        self.con.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT, value TEXT)")
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS entries (id TEXT, field TEXT, token TEXT)"
+        )
+        self.con.execute("CREATE TABLE IF NOT EXISTS entities (id TEXT, state TEXT)")
+        meta = dict(self.con.execute("SELECT key, value FROM meta").fetchall())
+        states = self._entity_states()
 
-                if idx % 50000 == 0 and idx > 0:
-                    log.info("Dumped %s entities" % idx)
-        log.info("Loading data...")
-        self.con.execute(f"COPY entries from '{csv_path}'")
-        log.info("Done.")
+        self.con.execute("BEGIN TRANSACTION")
+        if states is not None:
+            self._load_states(states)
+        if states is not None and meta.get("complete") == "true":
+            changed = self._update_entries()
+        else:
+            self.con.execute("DELETE FROM entries")
+            self._load_entries(self.view.entities())
+            changed = True
+        if states is not None:
+            self.con.execute("CREATE OR REPLACE TABLE entities AS FROM current")
+            self.con.execute("DROP TABLE current")
 
-        self._build_frequencies()
-        log.info("Index built.")
+        if changed or meta.get("stopwords_pct") != str(self.stopwords_pct):
+            for table in ("stopwords", "field_len", "mentions", "term_frequencies"):
+                self.con.execute(f"DROP TABLE IF EXISTS {table}")
+            self._build_frequencies()
+            self._log_usage("Index built")
+        else:
+            log.info("Index is up to date.")
+
+        meta = dict(self._meta)
+        meta["stopwords_pct"] = str(self.stopwords_pct)
+        meta["complete"] = "true" if states is not None else "false"
+        self.con.execute("DELETE FROM meta")
+        for key, value in meta.items():
+            self.con.execute("INSERT INTO meta VALUES (?, ?)", [key, value])
+        self.con.execute("COMMIT")
+        if changed:
+            # Reclaim the space of the deleted entries and dropped tables:
+            self.con.execute("CHECKPOINT")
 
     def _build_field_len(self) -> None:
         log.info("Calculating field lengths...")
@@ -173,18 +471,47 @@ class DuckDBIndex(BaseIndex[DS, CE]):
         self._build_field_len()
         self._build_mentions()
         log.info("Calculating term frequencies...")
+        # Sorted by token, so that the min/max statistics of each row group let
+        # single-entity lookups skip all but the blocks holding their tokens:
         term_frequencies_query = """
             CREATE TABLE IF NOT EXISTS term_frequencies as
             SELECT mentions.field, mentions.token, mentions.id, mentions/field_len as tf
             FROM field_len
             JOIN mentions
             ON field_len.field = mentions.field AND field_len.id = mentions.id
+            ORDER BY mentions.token, mentions.field
         """
         self.con.execute(term_frequencies_query)
 
+    def _plan_pair_partitions(self) -> int:
+        """Estimate the number of token rows the pairs self-join produces, and split
+        it into enough partitions for each to be aggregated within the memory limit."""
+        if self.pair_partitions is not None:
+            return self.pair_partitions
+        join_query = """
+            SELECT sum(freq * freq) FROM (
+                SELECT count(*) AS freq FROM term_frequencies GROUP BY field, token
+            )
+        """
+        res = self.con.execute(join_query).fetchone()
+        join_rows = int(res[0] or 0) if res is not None else 0
+        join_mb = (join_rows * PAIR_ROW_BYTES) / MB
+        partitions = max(1, math.ceil(join_mb / self.memory_limit))
+        log.info(
+            "Pairs query: ~%d joined token rows (%.1f MB), %d partition(s)",
+            join_rows,
+            join_mb,
+            partitions,
+        )
+        return partitions
+
     def pairs(
         self, max_pairs: int = BaseIndex.MAX_PAIRS
     ) -> Iterable[Tuple[Pair, float]]:
+        """Yield the highest-scoring pairs of entities which share tokens. If the
+        self-join would not fit into memory, it is run in partitions of the left-hand
+        entity IDs, so that each pair is scored completely within one partition, and
+        the top pairs of all partitions are merged."""
         pairs_query = """
             SELECT "left".id, "right".id, sum(("left".tf + "right".tf) * ifnull(boost, 1)) as score
             FROM term_frequencies as "left"
@@ -193,32 +520,49 @@ class DuckDBIndex(BaseIndex[DS, CE]):
             LEFT OUTER JOIN boosts
             ON "left".field = boosts.field
             WHERE "left".id > "right".id
+            AND hash("left".id) % ? = ?
             GROUP BY "left".id, "right".id
-            ORDER BY score DESC
+            ORDER BY score DESC, "left".id, "right".id
             LIMIT ?
         """
-        results = self.con.execute(pairs_query, [max_pairs])
-        while batch := results.fetchmany(BATCH_SIZE):
-            for left, right, score in batch:
-                yield (Identifier.get(left), Identifier.get(right)), score
+        partitions = self._plan_pair_partitions()
+        if partitions == 1:
+            results = self.con.execute(pairs_query, [1, 0, max_pairs])
+            while batch := results.fetchmany(BATCH_SIZE):
+                for left, right, score in batch:
+                    yield (Identifier.get(left), Identifier.get(right)), score
+            return
+
+        tops: List[List[Tuple[str, str, float]]] = []
+        for partition in range(partitions):
+            params = [partitions, partition, max_pairs]
+            tops.append(self.con.execute(pairs_query, params).fetchall())
+            log.info("Scored pairs partition %d/%d", partition + 1, partitions)
+        merged = heapq.merge(*tops, key=lambda r: (-r[2], r[0], r[1]))
+        for left, right, score in itertools.islice(merged, max_pairs):
+            yield (Identifier.get(left), Identifier.get(right)), score
 
     def add_matching_subject(self, entity: CE) -> None:
-        if self.matching_dump is None:
+        if self.matching_rows is None:
             raise Exception("Cannot add matching subject after getting candidates.")
-        writer = csv.writer(self.matching_dump)
+        if entity.id is None:
+            return
         for field, token in tokenize_entity(entity):
-            writer.writerow([entity.id, field, token])
+            self.matching_rows.append((entity.id, field, token))
+        if len(self.matching_rows) >= INSERT_BATCH_SIZE:
+            self._insert("matching", ("id", "field", "token"), self.matching_rows)
+            self.matching_rows = []
 
     def matches(
         self,
     ) -> Generator[Tuple[Identifier, BlockingMatches], None, None]:
-        if self.matching_dump is not None:
-            self.matching_dump.close()
-            self.matching_dump = None
-            log.info("Loading matching subjects...")
-            self.con.execute(f"COPY matching from '{self.matching_path}'")
-            log.info("Finished loading matching subjects.")
+        if self.matching_rows is not None:
+            self._insert("matching", ("id", "field", "token"), self.matching_rows)
+            self.matching_rows = None
+            self._log_usage("Loaded matching subjects")
 
+        # Only the top `max_candidates` for each subject are selected in the
+        # query, so the full candidate list is never transferred:
         match_query = """
             SELECT matching.id, matches.id, sum(matches.tf * ifnull(boost, 1)) as score
             FROM term_frequencies as matches
@@ -227,9 +571,12 @@ class DuckDBIndex(BaseIndex[DS, CE]):
             LEFT OUTER JOIN boosts
             ON matches.field = boosts.field
             GROUP BY matches.id, matching.id
-            ORDER BY matching.id, score DESC
+            QUALIFY row_number() OVER (
+                PARTITION BY matching.id ORDER BY score DESC, matches.id
+            ) <= ?
+            ORDER BY matching.id, score DESC, matches.id
         """
-        results = self.con.execute(match_query)
+        results = self.con.execute(match_query, [self.max_candidates])
         previous_id = None
         matches: BlockingMatches = []
         while batch := results.fetchmany(BATCH_SIZE):
@@ -246,7 +593,43 @@ class DuckDBIndex(BaseIndex[DS, CE]):
                 matches.append((Identifier.get(match_id), score))
         # Last pair or subject and candidates
         if matches and previous_id is not None:
-            yield Identifier.get(previous_id), matches[: self.max_candidates]
+            yield Identifier.get(previous_id), matches
+
+    def match(self, entity: CE) -> BlockingMatches:
+        """Find the top candidates for a single entity, without loading it into
+        the matching table. This can be used at any time after the index is built,
+        e.g. to screen individual entities."""
+        fields: List[str] = []
+        tokens: List[str] = []
+        for field, token in tokenize_entity(entity):
+            fields.append(field)
+            tokens.append(token)
+        if not len(tokens):
+            return []
+        # The tokens are also given as constants, which are compared against the
+        # row group statistics of the sorted table before it is scanned:
+        placeholders = ", ".join("?" for _ in set(tokens))
+        match_query = f"""
+            SELECT matches.id, sum(matches.tf * ifnull(boost, 1)) as score
+            FROM (
+                SELECT unnest(?::VARCHAR[]) AS field, unnest(?::VARCHAR[]) AS token
+            ) AS matching
+            JOIN term_frequencies as matches
+            ON matches.field = matching.field AND matches.token = matching.token
+            LEFT OUTER JOIN boosts
+            ON matches.field = boosts.field
+            WHERE matches.token IN ({placeholders})
+            GROUP BY matches.id
+            ORDER BY score DESC, matches.id
+            LIMIT ?
+        """
+        params = [fields, tokens, *sorted(set(tokens)), self.max_candidates]
+        results = self.con.execute(match_query, params).fetchall()
+        return [(Identifier.get(match_id), score) for match_id, score in results]
+
+    def close(self) -> None:
+        self.matching_rows = None
+        self.con.close()
 
     def __repr__(self) -> str:
         return "<DuckDBIndex(%r, %r)>" % (
@@ -0,0 +1,365 @@
+from array import array
+from functools import lru_cache
+from hashlib import blake2b
+from pathlib import Path
+from shutil import rmtree
+from typing import Any, Dict, Generator, Iterable, List, Optional, Tuple
+import json
+import math
+import logging
+import numpy as np
+import numpy.typing as npt
+from rigour.env import ENCODING as E
+
+from nomenklatura.dataset import DS
+from nomenklatura.entity import CE
+from nomenklatura.index.common import BaseIndex
+from nomenklatura.resolver import Pair, Identifier
+from nomenklatura.store import View
+
+from zavod.archive import get_statements_version
+from zavod.integration.duckdb_index import DuckDBIndex, BlockingMatches
+from zavod.integration.tokenizer import tokenize_entity, tokenize_entities
+from zavod.integration.tokenizer import log_cache_stats
+
+log = logging.getLogger(__name__)
+
+INDEX_FORMAT = "1"
+"""Version of the array layout, bumped to discard indexes built by older code."""
+PAIR_CHUNK = 5_000_000
+"""Number of token pairs generated and summed up per entity pair at a time."""
+ARRAYS = ("tokens", "offsets", "entities", "tfs", "boosts", "ids", "id_offsets")
+
+
+@lru_cache(maxsize=100_000)
+def _token_hash(field: str, token: str) -> int:
+    digest = blake2b(f"{field}:{token}".encode(E), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _open_array(path: Path) -> npt.NDArray[Any]:
+    data: npt.NDArray[Any] = np.load(path, mmap_mode="r")
+    if data.size == 0:
+        # Empty arrays cannot be memory-mapped:
+        data = np.load(path)
+    return data
+
+
+class NumpyIndex(BaseIndex[DS, CE]):
+    """
+    An index which keeps the term frequencies of each token in postings lists stored
+    as NumPy arrays in memory-mapped files, and scores candidates with vectorised
+    operations instead of SQL queries.
+
+    Tokens are interned as 64-bit hashes in a sorted array, and entities by the
+    position of their ID in sort order. Scoring follows `DuckDBIndex`: the most
+    common tokens are ignored as stopwords, and candidates are scored by the sum of
+    their term frequencies (TF) multiplied by the field's boost factor.
+
+    The arrays are kept in the data directory and re-opened instead of rebuilt
+    while the statement versions of the datasets and the merged entities in the
+    resolver are unchanged. Building the index holds about 13 bytes per token
+    mention and the entity IDs in memory; once built, queries only read the mapped
+    pages of the postings they need.
+    """
+
+    BOOSTS = DuckDBIndex.BOOSTS
+
+    def __init__(
+        self, view: View[DS, CE], data_dir: Path, options: Dict[str, Any] = {}
+    ):
+        self.view = view
+        self.max_candidates = int(options.get("max_candidates", 50))
+        self.stopwords_pct = options.get("stopwords_pct", 1)
+        self.data_dir = data_dir / "numpy-index"
+        self.meta_path = self.data_dir / "meta.json"
+        self.subjects: Dict[str, List[int]] = {}
+        self.arrays: Dict[str, npt.NDArray[Any]] = {}
+
+    @property
+    def _meta(self) -> Optional[Dict[str, Any]]:
+        """Properties of the index which must match for it to be reused, or `None`
+        if the contents of the view cannot be identified."""
+        versions: Dict[str, str] = {}
+        for leaf in self.view.scope.leaves:
+            version = get_statements_version(leaf.name)
+            if version is None:
+                return None
+            versions[leaf.name] = version
+        linker = getattr(self.view.store, "linker", None)
+        if linker is None:
+            return None
+        digest = blake2b(digest_size=16)
+        for canonical in sorted(linker.canonicals()):
+            referents = sorted(linker.get_referents(canonical))
+            digest.update(f"{canonical.id}:{','.join(referents)}\n".encode(E))
+        return {
+            "format": INDEX_FORMAT,
+            "scope": self.view.scope.name,
+            "external": self.view.external,
+            "stopwords_pct": self.stopwords_pct,
+            "versions": versions,
+            "linker": digest.hexdigest(),
+        }
+
+    def _open(self, meta: Optional[Dict[str, Any]]) -> bool:
+        """Open the arrays of a previously built index, if it was built from the
+        same contents."""
+        if meta is None or not self.meta_path.exists():
+            return False
+        with open(self.meta_path, "r") as fh:
+            if json.load(fh) != meta:
+                log.info("Index mismatch, rebuilding: %r", self.data_dir)
+                return False
+        for name in ARRAYS:
+            self.arrays[name] = _open_array(self.data_dir / f"{name}.npy")
+        return True
+
+    def _token_ids(self, entity: CE) -> List[int]:
+        vocabulary = self.arrays["tokens"]
+        token_ids: List[int] = []
+        for field, token in tokenize_entity(entity):
+            token_hash = np.uint64(_token_hash(field, token))
+            token_id = int(np.searchsorted(vocabulary, token_hash))
+            if token_id < len(vocabulary) and vocabulary[token_id] == token_hash:
+                token_ids.append(token_id)
+        return token_ids
+
+    def _entity_id(self, entity_idx: int) -> Identifier:
+        offsets = self.arrays["id_offsets"]
+        data = self.arrays["ids"][offsets[entity_idx] : offsets[entity_idx + 1]]
+        return Identifier.get(data.tobytes().decode(E))
+
+    def build(self) -> None:
+        """Index all entities in the dataset, unless an index of the same contents
+        has been built before."""
+        meta = self._meta
+        if self._open(meta):
+            log.info("Index is up to date: %r", self.data_dir)
+            return
+        log.info("Building index from: %r...", self.view)
+        rmtree(self.data_dir, ignore_errors=True)
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        ids: List[str] = []
+        fields: Dict[str, int] = {}
+        entry_entities = array("i")
+        entry_tokens = array("Q")
+        entry_fields = array("b")
+        matchable = (
+            e for e in self.view.entities() if e.schema.matchable and e.id is not None
+        )
+        for idx, (entity, entity_tokens) in enumerate(tokenize_entities(matchable)):
+            assert entity.id is not None
+            entity_idx = len(ids)
+            ids.append(entity.id)
+            for field, token in entity_tokens:
+                entry_entities.append(entity_idx)
+                entry_tokens.append(_token_hash(field, token))
+                entry_fields.append(fields.setdefault(field, len(fields)))
+
+            if idx % 50000 == 0 and idx > 0:
+                log.info("Tokenized %s entities" % idx)
+        log_cache_stats()
+
+        # Entities are numbered in the order of their IDs, like pairs are ranked:
+        num_entities = len(ids)
+        order = sorted(range(num_entities), key=ids.__getitem__)
+        ranks = np.empty(num_entities, dtype=np.int64)
+        ranks[np.array(order, dtype=np.int64)] = np.arange(num_entities)
+        encoded = [ids[i].encode(E) for i in order]
+        del ids, order
+        lengths = np.array([len(e) for e in encoded], dtype=np.int64)
+        arrays: Dict[str, npt.NDArray[Any]] = {
+            "ids": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            "id_offsets": np.concatenate(([0], np.cumsum(lengths))).astype(np.int64),
+        }
+        del encoded
+
+        entities = ranks[np.frombuffer(entry_entities, dtype=np.int32)]
+        vocabulary, first, tokens = np.unique(
+            np.frombuffer(entry_tokens, dtype=np.uint64),
+            return_index=True,
+            return_inverse=True,
+        )
+        field_ids = np.frombuffer(entry_fields, dtype=np.int8)[first].astype(np.int64)
+        num_tokens = len(vocabulary)
+
+        # Treat the most common tokens as stopwords:
+        token_freq = np.bincount(tokens, minlength=num_tokens)
+        limit = int((num_tokens / 100) * self.stopwords_pct)
+        log.info(
+            "Treating %d (%s%%) most common tokens as stopwords...",
+            limit,
+            self.stopwords_pct,
+        )
+        stopwords = np.zeros(num_tokens, dtype=bool)
+        stopwords[np.argsort(-token_freq, kind="stable")[:limit]] = True
+        keep = ~stopwords[tokens]
+        entities, tokens = entities[keep], tokens[keep]
+
+        # Term frequency: mentions of the token, relative to the field length:
+        log.info("Calculating term frequencies...")
+        num_fields = max(1, len(fields))
+        field_keys, field_lens = np.unique(
+            entities * num_fields + field_ids[tokens], return_counts=True
+        )
+        mention_keys, mentions = np.unique(
+            tokens * max(1, num_entities) + entities, return_counts=True
+        )
+        mention_tokens = mention_keys // max(1, num_entities)
+        mention_entities = mention_keys % max(1, num_entities)
+        mention_fields = mention_entities * num_fields + field_ids[mention_tokens]
+        field_len = field_lens[np.searchsorted(field_keys, mention_fields)]
+
+        # Postings lists, ordered by token and then entity (the keys are sorted):
+        counts = np.bincount(mention_tokens, minlength=num_tokens)
+        field_names = sorted(fields, key=lambda f: fields[f])
+        field_boosts = np.array([self.BOOSTS.get(f, 1.0) for f in field_names])
+        arrays["tokens"] = vocabulary
+        arrays["offsets"] = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        arrays["entities"] = mention_entities.astype(np.int32)
+        arrays["tfs"] = mentions / field_len
+        arrays["boosts"] = field_boosts[field_ids] if len(fields) else np.zeros(0)
+        for name in ARRAYS:
+            path = self.data_dir / f"{name}.npy"
+            np.save(path, arrays[name])
+            self.arrays[name] = _open_array(path)
+        if meta is not None:
+            with open(self.meta_path, "w") as fh:
+                json.dump(meta, fh)
+        log.info(
+            "Index built: %d entities, %d tokens, %d postings.",
+            num_entities,
+            num_tokens,
+            len(arrays["entities"]),
+        )
+
+    def _postings(self, token_id: int) -> Tuple[npt.NDArray[Any], npt.NDArray[Any]]:
+        offsets = self.arrays["offsets"]
+        start, end = offsets[token_id], offsets[token_id + 1]
+        return self.arrays["entities"][start:end], self.arrays["tfs"][start:end]
+
+    def _sum_pairs(
+        self, keys: List[npt.NDArray[Any]], scores: List[npt.NDArray[Any]]
+    ) -> Tuple[npt.NDArray[Any], npt.NDArray[Any]]:
+        uniq, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+        return uniq, np.bincount(inverse, weights=np.concatenate(scores))
+
+    def _token_pairs(
+        self, token_id: int, partitions: int, partition: int
+    ) -> Generator[Tuple[npt.NDArray[Any], npt.NDArray[Any]], None, None]:
+        """Generate the pairs of entities sharing the given token, whose left-hand
+        (greater) entity falls into the partition, with their scores. The pairs
+        are produced in blocks of at most `PAIR_CHUNK`."""
+        entities, tfs = self._postings(token_id)
+        # Postings are sorted, so each entity pairs up with all entities before it:
+        rights = np.flatnonzero(entities % partitions == partition)
+        rights = rights[rights > 0]
+        if not len(rights):
+            return
+        ends = np.cumsum(rights)
+        boost = self.arrays["boosts"][token_id]
+        for start in range(0, int(ends[-1]), PAIR_CHUNK):
+            pos = np.arange(start, min(start + PAIR_CHUNK, int(ends[-1])))
+            row = np.searchsorted(ends, pos, side="right")
+            left = rights[row]
+            right = pos - (ends[row] - left)
+            keys = entities[left].astype(np.int64) * len(self.arrays["id_offsets"])
+            yield keys + entities[right], (tfs[left] + tfs[right]) * boost
+
+    def _plan_partitions(self, token_ids: npt.NDArray[Any]) -> int:
+        """Split the token pairs into enough partitions of left-hand entities for
+        each to be summed up in batches of about `PAIR_CHUNK`."""
+        counts = np.diff(self.arrays["offsets"])[token_ids]
+        total = int(np.sum(counts * (counts - 1) // 2))
+        partitions = max(1, math.ceil(total / PAIR_CHUNK))
+        log.info("Pairs: %d token pairs, %d partition(s)", total, partitions)
+        return partitions
+
+    def _partition_pairs(
+        self, token_ids: npt.NDArray[Any], partitions: int, partition: int
+    ) -> Tuple[npt.NDArray[Any], npt.NDArray[Any]]:
+        """Sum up the scores of all pairs in one partition. Every token pair of an
+        entity pair is in the same partition, so the sums are complete."""
+        run_keys: npt.NDArray[Any] = np.zeros(0, dtype=np.int64)
+        run_scores: npt.NDArray[Any] = np.zeros(0, dtype=np.float64)
+        keys: List[npt.NDArray[Any]] = []
+        scores: List[npt.NDArray[Any]] = []
+        pending = 0
+        for token_id in token_ids:
+            for block_keys, block_scores in self._token_pairs(
+                token_id, partitions, partition
+            ):
+                keys.append(block_keys)
+                scores.append(block_scores)
+                pending += len(block_keys)
+                if pending >= PAIR_CHUNK:
+                    run_keys, run_scores = self._sum_pairs(
+                        [run_keys, *keys], [run_scores, *scores]
+                    )
+                    keys, scores, pending = [], [], 0
+        return self._sum_pairs([run_keys, *keys], [run_scores, *scores])
+
+    def pairs(
+        self, max_pairs: int = BaseIndex.MAX_PAIRS
+    ) -> Iterable[Tuple[Pair, float]]:
+        """Yield the highest-scoring pairs of entities which share tokens. The pairs
+        are summed up in partitions of the left-hand entities, and only the top
+        pairs of each partition are kept."""
+        num_entities = len(self.arrays["id_offsets"]) - 1
+        counts = np.diff(self.arrays["offsets"])
+        token_ids = np.flatnonzero(counts > 1)
+        partitions = self._plan_partitions(token_ids)
+        top_keys: npt.NDArray[Any] = np.zeros(0, dtype=np.int64)
+        top_scores: npt.NDArray[Any] = np.zeros(0, dtype=np.float64)
+        for partition in range(partitions):
+            keys, scores = self._partition_pairs(token_ids, partitions, partition)
+            keys = np.concatenate((top_keys, keys))
+            scores = np.concatenate((top_scores, scores))
+            # Keys sort by the left-hand and then the right-hand entity:
+            order = np.lexsort((keys, -scores))[:max_pairs]
+            top_keys, top_scores = keys[order], scores[order]
+            if partitions > 1:
+                log.info("Scored pairs partition %d/%d", partition + 1, partitions)
+        stride = num_entities + 1
+        for key, score in zip(top_keys, top_scores):
+            left, right = divmod(int(key), stride)
+            yield (self._entity_id(left), self._entity_id(right)), float(score)
+
+    def _score(self, token_ids: List[int]) -> BlockingMatches:
+        entities: List[npt.NDArray[Any]] = []
+        weights: List[npt.NDArray[Any]] = []
+        for token_id in token_ids:
+            ents, tfs = self._postings(token_id)
+            entities.append(ents)
+            weights.append(tfs * self.arrays["boosts"][token_id])
+        if not sum(len(e) for e in entities):
+            return []
+        uniq, scores = self._sum_pairs(entities, weights)
+        order = np.lexsort((uniq, -scores))[: self.max_candidates]
+        return [(self._entity_id(uniq[i]), float(scores[i])) for i in order]
+
+    def match(self, entity: CE) -> BlockingMatches:
+        """Find the top candidates for a single entity."""
+        return self._score(self._token_ids(entity))
+
+    def add_matching_subject(self, entity: CE) -> None:
+        if entity.id is None:
+            return
+        token_ids = self.subjects.setdefault(entity.id, [])
+        token_ids.extend(self._token_ids(entity))
+
+    def matches(
+        self,
+    ) -> Generator[Tuple[Identifier, BlockingMatches], None, None]:
+        for subject_id in sorted(self.subjects):
+            matches = self._score(self.subjects[subject_id])
+            if len(matches):
+                yield Identifier.get(subject_id), matches
+        self.subjects = {}
+
+    def close(self) -> None:
+        self.arrays = {}
+
+    def __repr__(self) -> str:
+        return "<NumpyIndex(%r, %r)>" % (self.view.scope.name, self.data_dir)
@@ -0,0 +1,105 @@
+"""Score pairs of entities with a matching algorithm, optionally spreading the
+work over a pool of worker processes. Matching algorithms are pure CPU work and
+dominate the run time of xref and enrichment once the candidates are blocked."""
+
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Deque, Generator, Iterable, List, Optional, Tuple, Type, TypeVar
+from nomenklatura.matching import ScoringAlgorithm, get_algorithm
+from nomenklatura.statement import Statement
+
+from zavod.entity import Entity
+from zavod.meta import Dataset
+
+T = TypeVar("T")
+BATCH_SIZE = 200
+Payload = List[Statement]
+
+# Inherited by the forked workers, which cannot be sent the (unpicklable)
+# dataset objects:
+_worker_dataset: Optional[Dataset] = None
+
+
+def _score_batch(
+    algorithm_name: str, batch: List[Tuple[Payload, Payload]]
+) -> List[float]:
+    assert _worker_dataset is not None, "Scoring worker has no dataset"
+    algorithm = get_algorithm(algorithm_name)
+    assert algorithm is not None, algorithm_name
+    scores: List[float] = []
+    for left_stmts, right_stmts in batch:
+        left = Entity.from_statements(_worker_dataset, left_stmts)
+        right = Entity.from_statements(_worker_dataset, right_stmts)
+        scores.append(algorithm.compare(left, right).score)
+    return scores
+
+
+class PairScorer(object):
+    """Score pairs of entities with the given algorithm. With more than one worker,
+    batches of pairs are sent to a process pool; the results are still yielded in
+    the order in which the pairs were given."""
+
+    def __init__(
+        self,
+        algorithm: Type[ScoringAlgorithm],
+        dataset: Dataset,
+        workers: int = 1,
+        batch_size: int = BATCH_SIZE,
+    ) -> None:
+        self.algorithm = algorithm
+        self.dataset = dataset
+        self.workers = workers
+        self.batch_size = batch_size
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        global _worker_dataset
+        if self._pool is None:
+            _worker_dataset = self.dataset
+            mp_context = multiprocessing.get_context("fork")
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=mp_context)
+        return self._pool
+
+    def _submit(self, batch: List[Tuple[T, Entity, Entity]]) -> "Future[List[float]]":
+        payload = [
+            (list(left.statements), list(right.statements)) for _, left, right in batch
+        ]
+        return self.pool.submit(_score_batch, self.algorithm.NAME, payload)
+
+    def score(
+        self, pairs: Iterable[Tuple[T, Entity, Entity]]
+    ) -> Generator[Tuple[T, Entity, Entity, float], None, None]:
+        """Score each `(tag, left, right)` tuple, yielding `(tag, left, right, score)`
+        in the same order."""
+        if self.workers <= 1:
+            for tag, left, right in pairs:
+                score = self.algorithm.compare(left, right).score
+                yield tag, left, right, score
+            return
+
+        pending: Deque[Tuple[List[Tuple[T, Entity, Entity]], Future[List[float]]]]
+        pending = deque()
+        batch: List[Tuple[T, Entity, Entity]] = []
+        for pair in pairs:
+            batch.append(pair)
+            if len(batch) >= self.batch_size:
+                pending.append((batch, self._submit(batch)))
+                batch = []
+            # Keep the workers busy, but don't load all the pairs into memory:
+            while len(pending) > self.workers * 2:
+                done, future = pending.popleft()
+                for (tag, left, right), score in zip(done, future.result()):
+                    yield tag, left, right, score
+        if len(batch):
+            pending.append((batch, self._submit(batch)))
+        while len(pending):
+            done, future = pending.popleft()
+            for (tag, left, right), score in zip(done, future.result()):
+                yield tag, left, right, score
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
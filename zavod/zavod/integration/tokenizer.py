@@ -2,13 +2,21 @@ from normality import WS
 from rigour.ids import StrictFormat
 from rigour.text.phonetics import metaphone
 from rigour.text.scripts import is_modern_alphabet
-from typing import Generator, Set, Tuple
+from functools import lru_cache
+from typing import Generator, Iterable, Set, Tuple
 from followthemoney.types import registry
+from followthemoney.types.common import PropertyType
 
 from nomenklatura.entity import CE
 from nomenklatura.util import fingerprint_name
 from nomenklatura.util import name_words, clean_text_basic
 
+from zavod import settings
+from zavod.logs import get_logger
+
+log = get_logger(__name__)
+Token = Tuple[str, str]
+
 WORD_FIELD = "wd"
 NAME_PART_FIELD = "np"
 PHONETIC_FIELD = "ph"
@@ -42,39 +50,72 @@ TEXT_TYPES = (
 )
 
 
-def tokenize_entity(entity: CE) -> Generator[Tuple[str, str], None, None]:
-    unique: Set[Tuple[str, str]] = set()
+@lru_cache(maxsize=settings.TOKENIZER_CACHE_SIZE)
+def _value_tokens(
+    type: PropertyType, value: str
+) -> Tuple[Tuple[str, ...], Tuple[Token, ...]]:
+    """Tokenize a single property value. Returns the words in the value (which are
+    counted each time they occur) and the tokens which count once per entity.
+    Names, countries and identifiers repeat a lot across entities, so the results
+    are memoized."""
+    words: Tuple[str, ...] = ()
+    unique: Set[Token] = set()
+    if type in EMIT_FULL:
+        unique.add((type.name, value[:300].lower()))
+    if type in TEXT_TYPES:
+        words = tuple(name_words(clean_text_basic(value), min_length=3))
+    if type == registry.date:
+        if len(value) > 4:
+            unique.add((type.name, value[:4]))
+        unique.add((type.name, value[:10]))
+    elif type == registry.name:
+        norm = fingerprint_name(value)
+        if norm is not None:
+            alpha = is_modern_alphabet(value)
+            unique.add((type.name, norm))
+            for token in norm.split(WS):
+                if len(token) > 2 and len(token) < 30:
+                    unique.add((NAME_PART_FIELD, norm))
+                if alpha and len(token) > 4:
+                    phoneme = metaphone(token)
+                    if len(phoneme) > 3:
+                        unique.add((PHONETIC_FIELD, phoneme))
+    elif type == registry.identifier:
+        clean_id = StrictFormat.normalize(value)
+        if clean_id is not None:
+            unique.add((type.name, clean_id))
+    return words, tuple(unique)
+
+
+def tokenize_entity(entity: CE) -> Generator[Token, None, None]:
+    unique: Set[Token] = set()
     for prop, value in entity.itervalues():
         type = prop.type
         if not prop.matchable or type in SKIP:
             continue
-        if type in EMIT_FULL:
-            unique.add((type.name, value[:300].lower()))
-        if type in TEXT_TYPES:
-            for word in name_words(clean_text_basic(value), min_length=3):
-                yield WORD_FIELD, word
-        if type == registry.date:
-            if len(value) > 4:
-                unique.add((type.name, value[:4]))
-            unique.add((type.name, value[:10]))
-            continue
-        if type == registry.name:
-            norm = fingerprint_name(value)
-            if norm is not None:
-                alpha = is_modern_alphabet(value)
-                unique.add((type.name, norm))
-                for token in norm.split(WS):
-                    if len(token) > 2 and len(token) < 30:
-                        unique.add((NAME_PART_FIELD, norm))
-                    if alpha and len(token) > 4:
-                        phoneme = metaphone(token)
-                        if len(phoneme) > 3:
-                            unique.add((PHONETIC_FIELD, phoneme))
-            continue
-        if type == registry.identifier:
-            clean_id = StrictFormat.normalize(value)
-            if clean_id is not None:
-                unique.add((type.name, clean_id))
-            continue
+        words, tokens = _value_tokens(type, value)
+        for word in words:
+            yield WORD_FIELD, word
+        unique.update(tokens)
 
     yield from unique
+
+
+def tokenize_entities(
+    entities: Iterable[CE],
+) -> Generator[Tuple[CE, Tuple[Token, ...]], None, None]:
+    """Tokenize a batch of entities, yielding each entity with its tokens."""
+    for entity in entities:
+        yield entity, tuple(tokenize_entity(entity))
+
+
+def log_cache_stats() -> None:
+    """Log how many property values were tokenized from the cache."""
+    info = _value_tokens.cache_info()
+    total = info.hits + info.misses
+    log.info(
+        "Tokenizer cache: %.1f%% hits" % ((info.hits / max(1, total)) * 100),
+        hits=info.hits,
+        misses=info.misses,
+        size=info.currsize,
+    )
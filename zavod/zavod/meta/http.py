@@ -1,6 +1,6 @@
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 from urllib3.util import Retry
-from banal import ensure_list
+from banal import as_bool, ensure_list
 from zavod import settings
 
 
@@ -17,3 +17,18 @@ class HTTP(object):
         )
         self.retry_methods: List[str] = retry_methods
         self.user_agent: str = data.get("user_agent", settings.HTTP_USER_AGENT)
+        self.max_concurrency: int = int(data.get("max_concurrency", 4))
+        rate_limit = data.get("rate_limit")
+        self.rate_limit: Optional[float] = (
+            float(rate_limit) if rate_limit is not None else None
+        )
+        self.burst: int = max(1, int(data.get("burst", 1)))
+        hosts: Dict[str, Any] = data.get("host_rate_limits", {})
+        self.host_rate_limits: Dict[str, float] = {
+            host: float(limit) for host, limit in hosts.items()
+        }
+        self.archive_sources: bool = as_bool(data.get("archive_sources", False))
+
+    def get_rate_limit(self, host: str) -> Optional[float]:
+        """The maximum number of requests per second to send to the given host."""
+        return self.host_rate_limits.get(host, self.rate_limit)
@@ -1,69 +1,175 @@
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, List, Optional
 from rigour.mime.types import JSON
+from nomenklatura.versions import Version
 
+from zavod import settings
 from zavod.meta import Dataset
 from zavod.logs import get_logger
 from zavod.archive import publish_resource, dataset_resource_path
 from zavod.archive import publish_dataset_version, publish_artifact
 from zavod.archive import INDEX_FILE, CATALOG_FILE
 from zavod.archive import STATEMENTS_FILE, RESOURCES_FILE, STATISTICS_FILE
-from zavod.archive import VERSIONS_FILE, ARTIFACT_FILES
-from zavod.archive import DELTA_EXPORT_FILE, DELTA_INDEX_FILE
+from zavod.archive import STATEMENTS_COLUMNAR_FILE, TIMESTAMPS_FILE
+from zavod.archive import VERSIONS_FILE, ARTIFACT_FILES, SOURCES
+from zavod.archive import DELTA_EXPORT_FILE, DELTA_INDEX_FILE, HASH_FILE
 from zavod.runtime.resources import DatasetResources
+from zavod.runtime.sources import DatasetSources
 from zavod.runtime.versions import get_latest
 from zavod.exporters import write_dataset_index, write_issues
 
 log = get_logger(__name__)
 
 
-def _publish_artifacts(dataset: Dataset) -> None:
+META_ARTIFACTS = (INDEX_FILE, VERSIONS_FILE)
+
+
+class Uploader(object):
+    """Upload files in a bounded pool of threads, and keep count of the bytes sent
+    to the archive."""
+
+    def __init__(self, dataset: Dataset, workers: Optional[int] = None) -> None:
+        self.dataset = dataset
+        self.pool = ThreadPoolExecutor(workers or settings.PUBLISH_WORKERS)
+        self.futures: List["Future[None]"] = []
+        self.lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+
+    def submit(
+        self, func: Callable[..., None], path: Path, *args: Any, **kwargs: Any
+    ) -> None:
+        """Schedule `func(path, *args, **kwargs)` to upload the given file."""
+        size = path.stat().st_size
+
+        def upload() -> None:
+            func(path, *args, **kwargs)
+            with self.lock:
+                self.files += 1
+                self.bytes += size
+
+        self.futures.append(self.pool.submit(upload))
+
+    def wait(self) -> None:
+        """Wait for all scheduled uploads to complete."""
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self) -> None:
+        self.wait()
+        self.pool.shutdown()
+        elapsed = time.monotonic() - self.start
+        mb = self.bytes / (1024 * 1024)
+        log.info(
+            "Uploaded %d files (%.1f MB, %.1f MB/s)"
+            % (self.files, mb, mb / max(elapsed, 0.001)),
+            dataset=self.dataset.name,
+            seconds=round(elapsed, 2),
+        )
+
+
+def _get_version(dataset: Dataset) -> Version:
     version = get_latest(dataset.name, backfill=False)
     if version is None:
         raise ValueError(f"No working version found for dataset: {dataset.name}")
+    return version
+
+
+def _schedule_artifacts(
+    dataset: Dataset, version: Version, uploader: Uploader, meta: bool
+) -> None:
+    """Schedule the upload of either the metadata artifacts, or all others."""
+    if not meta and dataset.http.archive_sources:
+        for name in DatasetSources(dataset).fetched(version.id):
+            path = dataset_resource_path(dataset.name, name)
+            if path.is_file():
+                artifact = f"{SOURCES}/{name}"
+                uploader.submit(publish_artifact, path, dataset.name, version, artifact)
     for artifact in ARTIFACT_FILES:
+        if (artifact in META_ARTIFACTS) != meta:
+            continue
         path = dataset_resource_path(dataset.name, artifact)
         if path.is_file():
-            publish_artifact(
+            uploader.submit(
+                publish_artifact,
                 path,
                 dataset.name,
                 version,
                 artifact,
                 mime_type=JSON if artifact.endswith(".json") else None,
             )
-    publish_dataset_version(dataset.name)
+
+
+def _publish_artifacts(dataset: Dataset) -> None:
+    version = _get_version(dataset)
+    uploader = Uploader(dataset)
+    try:
+        _schedule_artifacts(dataset, version, uploader, meta=False)
+        uploader.wait()
+        _schedule_artifacts(dataset, version, uploader, meta=True)
+        uploader.wait()
+        publish_dataset_version(dataset.name)
+    finally:
+        uploader.close()
 
 
 def publish_dataset(dataset: Dataset, latest: bool = True) -> None:
-    """Upload a dataset to the archive."""
-    resources = DatasetResources(dataset)
-    for resource in resources.all():
-        if resource.name in ARTIFACT_FILES:
-            # This is a bit hacky: the delta exporter and statistics exporter are
-            # generating artifacts used for internal purposes, but they should
-            # not be included in the dataset metadata.
-            resources.remove(resource.name)
-            continue
-        path = dataset_resource_path(dataset.name, resource.name)
-        if not path.is_file():
-            log.error("Resource not found: %s" % path, dataset=dataset.name)
-            continue
-        publish_resource(
-            path,
-            dataset.name,
-            resource.name,
-            latest=latest,
-            mime_type=resource.mime_type,
-        )
-    files = [INDEX_FILE]
-    if dataset.is_collection:
-        files.extend([CATALOG_FILE])
-    for meta in files:
-        path = dataset_resource_path(dataset.name, meta)
-        if not path.is_file():
-            log.error("Metadata file not found: %s" % path, dataset=dataset.name)
-            continue
-        mime_type = JSON if meta.endswith(".json") else None
-        publish_resource(path, dataset.name, meta, latest=latest, mime_type=mime_type)
-    _publish_artifacts(dataset)
+    """Upload a dataset to the archive. Resources and artifacts are uploaded in
+    parallel; the index and version metadata are only published after all of them,
+    so readers never see a partially published version."""
+    version = _get_version(dataset)
+    uploader = Uploader(dataset)
+    try:
+        resources = DatasetResources(dataset)
+        for resource in resources.all():
+            if resource.name in ARTIFACT_FILES:
+                # This is a bit hacky: the delta exporter and statistics exporter are
+                # generating artifacts used for internal purposes, but they should
+                # not be included in the dataset metadata.
+                resources.remove(resource.name)
+                continue
+            path = dataset_resource_path(dataset.name, resource.name)
+            if not path.is_file():
+                log.error("Resource not found: %s" % path, dataset=dataset.name)
+                continue
+            uploader.submit(
+                publish_resource,
+                path,
+                dataset.name,
+                resource.name,
+                latest=latest,
+                mime_type=resource.mime_type,
+            )
+        _schedule_artifacts(dataset, version, uploader, meta=False)
+        uploader.wait()
+
+        files = [INDEX_FILE]
+        if dataset.is_collection:
+            files.extend([CATALOG_FILE])
+        for meta in files:
+            path = dataset_resource_path(dataset.name, meta)
+            if not path.is_file():
+                log.error("Metadata file not found: %s" % path, dataset=dataset.name)
+                continue
+            mime_type = JSON if meta.endswith(".json") else None
+            uploader.submit(
+                publish_resource,
+                path,
+                dataset.name,
+                meta,
+                latest=latest,
+                mime_type=mime_type,
+            )
+        _schedule_artifacts(dataset, version, uploader, meta=True)
+        uploader.wait()
+        publish_dataset_version(dataset.name)
+    finally:
+        uploader.close()
 
 
 def publish_failure(dataset: Dataset, latest: bool = True) -> None:
@@ -72,12 +178,16 @@ def publish_failure(dataset: Dataset, latest: bool = True) -> None:
     # generating.
     assert not dataset.is_collection
     dataset_resource_path(dataset.name, STATEMENTS_FILE).unlink(missing_ok=True)
+    columnar_path = dataset_resource_path(dataset.name, STATEMENTS_COLUMNAR_FILE)
+    columnar_path.unlink(missing_ok=True)
+    dataset_resource_path(dataset.name, TIMESTAMPS_FILE).unlink(missing_ok=True)
     dataset_resource_path(dataset.name, STATISTICS_FILE).unlink(missing_ok=True)
     dataset_resource_path(dataset.name, INDEX_FILE).unlink(missing_ok=True)
     dataset_resource_path(dataset.name, CATALOG_FILE).unlink(missing_ok=True)
     dataset_resource_path(dataset.name, RESOURCES_FILE).unlink(missing_ok=True)
     dataset_resource_path(dataset.name, DELTA_EXPORT_FILE).unlink(missing_ok=True)
     dataset_resource_path(dataset.name, DELTA_INDEX_FILE).unlink(missing_ok=True)
+    dataset_resource_path(dataset.name, HASH_FILE).unlink(missing_ok=True)
     write_issues(dataset)
     write_dataset_index(dataset)
     path = dataset_resource_path(dataset.name, INDEX_FILE)
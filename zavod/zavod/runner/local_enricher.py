@@ -1,6 +1,6 @@
 from decimal import Decimal
 import logging
-from typing import Generator, List, Tuple
+from typing import Dict, Generator, Iterable, List, Tuple
 from followthemoney.types import registry
 from followthemoney.helpers import check_person_cutoff
 
@@ -17,10 +17,12 @@ from nomenklatura.cache import Cache
 from zavod.archive import dataset_state_path
 from zavod.context import Context
 from zavod.integration.dedupe import get_dataset_linker, get_resolver
+from zavod.integration.dedupe import get_index_type
 from zavod.entity import Entity
 from zavod.meta import Dataset, get_multi_dataset, get_catalog
 from zavod.store import get_store
-from zavod.integration.duckdb_index import DuckDBIndex, BlockingMatches
+from zavod.integration.duckdb_index import BlockingMatches
+from zavod.integration.scoring import PairScorer
 
 
 log = logging.getLogger(__name__)
@@ -57,7 +59,11 @@ class LocalEnricher(BaseEnricher[DS]):
             bins to consider from a given search result.
           `algorithm`: `str` (default logic-v1) - the name of the algorithm
               to use for matching.
+          `index_type`: `str` (default duckdb) - the blocking index to use,
+              `duckdb` or `numpy`.
           `index_options`: `dict` - options to pass to the index.
+          `score_workers`: `int` (default 1) - the number of processes used to
+              score candidates with the matching algorithm.
 
     """
 
@@ -69,8 +75,9 @@ class LocalEnricher(BaseEnricher[DS]):
         self.target_store = get_store(target_dataset, target_linker)
         self.target_store.sync()
         self.target_view = self.target_store.view(target_dataset)
-        index_path = dataset_state_path(dataset.name) / "duckdb-enrich-index"
-        self._index = DuckDBIndex(
+        index_type = config.get("index_type", "duckdb")
+        index_path = dataset_state_path(dataset.name) / f"{index_type}-enrich-index"
+        self._index = get_index_type(index_type)(
             self.target_view, index_path, config.get("index_options", {})
         )
         self._index.build()
@@ -83,8 +90,15 @@ class LocalEnricher(BaseEnricher[DS]):
         self._cutoff = float(config.get("cutoff", 0.5))
         self._limit = int(config.get("limit", 5))
         self._max_bin = int(config.get("max_bin", 10))
+        self._scorer = PairScorer(
+            self._algorithm,
+            target_dataset,
+            workers=int(config.get("score_workers", 1)),
+        )
 
     def close(self) -> None:
+        self._scorer.close()
+        self._index.close()
         self.target_store.close()
 
     def load(self, entity: Entity) -> None:
@@ -98,17 +112,9 @@ class LocalEnricher(BaseEnricher[DS]):
     def candidates(self) -> Generator[Tuple[Identifier, BlockingMatches], None, None]:
         yield from self._index.matches()
 
-    def match_candidates(
+    def _select_candidates(
         self, entity: Entity, candidates: BlockingMatches
     ) -> Generator[Entity, None, None]:
-        # Make sure an entity with the same ID is yielded. E.g. a QID or ID scheme
-        # intentionally consistent between datasets.
-        if entity.id is not None:
-            same_id_match = self.target_view.get_entity(entity.id)
-            if same_id_match is not None:
-                yield same_id_match
-
-        scores: List[Tuple[float, Entity]] = []
         last_rounded_score = None
         bin = 0
 
@@ -127,15 +133,61 @@ class LocalEnricher(BaseEnricher[DS]):
             if not entity.schema.can_match(match.schema):
                 continue
 
-            result = self._algorithm.compare(entity, match)
-            if result.score < self._cutoff:
-                continue
+            yield match
+
+    def match_many(
+        self, subjects: Iterable[Tuple[Entity, BlockingMatches]]
+    ) -> Generator[Tuple[Entity, List[Entity]], None, None]:
+        """Score the candidates for a sequence of subject entities, and yield the
+        matches for each subject in the given order. The scoring of all candidates
+        is handed to the scorer in one stream, so it can be done in parallel."""
+        # Subjects are only kept until their matches have been yielded:
+        pending: Dict[int, Entity] = {}
+        results: Dict[int, List[Tuple[float, Entity]]] = {}
+
+        def pairs() -> Generator[Tuple[int, Entity, Entity], None, None]:
+            for idx, (entity, candidates) in enumerate(subjects):
+                pending[idx] = entity
+                results[idx] = []
+                for match in self._select_candidates(entity, candidates):
+                    yield idx, entity, match
+
+        def finish(idx: int) -> Tuple[Entity, List[Entity]]:
+            entity = pending.pop(idx)
+            matches: List[Entity] = []
+            # Make sure an entity with the same ID is yielded. E.g. a QID or ID
+            # scheme intentionally consistent between datasets.
+            if entity.id is not None:
+                same_id_match = self.target_view.get_entity(entity.id)
+                if same_id_match is not None:
+                    matches.append(same_id_match)
+            scores = results.pop(idx)
+            scores.sort(key=lambda s: s[0], reverse=True)
+            matches.extend(proxy for _, proxy in scores[: self._limit])
+            return entity, matches
+
+        done = 0
+        for idx, _, match, score in self._scorer.score(pairs()):
+            while done < idx:
+                yield finish(done)
+                done += 1
+            if score >= self._cutoff:
+                results[idx].append((score, match))
+        while len(pending):
+            yield finish(done)
+            done += 1
 
-            scores.append((result.score, match))
+    def match_candidates(
+        self, entity: Entity, candidates: BlockingMatches
+    ) -> Generator[Entity, None, None]:
+        for _, matches in self.match_many([(entity, candidates)]):
+            yield from matches
 
-        scores.sort(key=lambda s: s[0], reverse=True)
-        for algo_score, proxy in scores[: self._limit]:
-            yield proxy
+    def match(self, entity: Entity) -> Generator[Entity, None, None]:
+        """Look up the matches for a single entity in the target dataset. Unlike
+        `load()` and `candidates()`, this queries the index directly, so it can
+        be called any number of times, e.g. for ad-hoc screening."""
+        yield from self.match_candidates(entity, self._index.match(entity))
 
     def _traverse_nested(
         self, entity: Entity, path: List[str] = []
@@ -215,15 +267,21 @@ def enrich(context: Context) -> None:
             enricher.load_wrapped(entity)
 
         context.log.info("Matching candidates...")
-        for entity_idx, (entity_id, candidate_set) in enumerate(enricher.candidates()):
+
+        def subjects() -> Generator[Tuple[Entity, BlockingMatches], None, None]:
+            for entity_id, candidate_set in enricher.candidates():
+                subject_entity = subject_view.get_entity(entity_id.id)
+                if subject_entity is None:
+                    context.log.error("Missing entity: %r" % entity_id)
+                    continue
+                yield subject_entity, candidate_set
+
+        matched = enricher.match_many(subjects())
+        for entity_idx, (subject_entity, matches) in enumerate(matched):
             if entity_idx > 0 and entity_idx % 10000 == 0:
                 context.log.info("Enriched %s entities..." % entity_idx)
-            subject_entity = subject_view.get_entity(entity_id.id)
-            if subject_entity is None:
-                context.log.error("Missing entity: %r" % entity_id)
-                continue
             try:
-                for match in enricher.match_candidates(subject_entity, candidate_set):
+                for match in matches:
                     save_match(context, resolver, enricher, subject_entity, match)
             except EnrichmentException as exc:
                 context.log.error(
@@ -1,7 +1,26 @@
+"""The cache for HTTP responses and other data of a dataset. Entries are kept in
+memory and in a database table. Larger values are compressed with zstd and
+stored once per distinct content in a separate table, which the entries refer
+to by the hash of the content. The references are also kept in an indexed table,
+so that content no longer referred to can be found and deleted by `sweep_blobs`."""
+
+import time
+import hashlib
+import zstandard as zstd
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from functools import cache
-from sqlalchemy import MetaData, create_engine
+from typing import Any, Dict, Generator, List, Optional, Set, Tuple, Union
+from sqlalchemy import MetaData, Table, Column, create_engine, exists, literal
+from sqlalchemy import BigInteger, DateTime, LargeBinary, Unicode
 from sqlalchemy.engine import Engine
-from nomenklatura.cache import Cache
+from sqlalchemy.exc import OperationalError, InvalidRequestError
+from sqlalchemy.future import select
+from sqlalchemy.sql.expression import delete
+from sqlalchemy.dialects.postgresql import insert as upsert
+from nomenklatura.cache import Cache, CacheValue, Value, randomize_cache
+from rigour.env import ENCODING as E
+from rigour.time import naive_now
 
 from zavod import settings
 from zavod.logs import get_logger
@@ -9,6 +28,340 @@ from zavod.meta import Dataset
 from zavod.archive import dataset_state_path
 
 log = get_logger(__name__)
+WRITE_BATCH = 500
+"""Number of new cache entries collected before they are written to the database."""
+BLOB_PREFIX = "zavod:blob:"
+BLOB_MIN_SIZE = 512
+"""Values shorter than this are stored in the cache table as they are."""
+ZSTD_LEVEL = 10
+DICT_SIZE = 112_640
+DICT_SAMPLES = 1000
+"""Number of values collected to train the compression dictionary of a dataset."""
+VACUUM_INTERVAL = 3600
+"""Minimum number of seconds between deletions of expired entries."""
+
+# The text and timestamp of a cache entry; a timestamp of `None` marks a key
+# which is known not to be in the database:
+_Entry = Tuple[Value, Optional[datetime]]
+
+
+class TieredCache(Cache):
+    """A cache which keeps the most recently used entries in memory, in front of
+    the database table. New entries are written to the database in batches, when
+    the cache is flushed or when enough of them have been collected."""
+
+    def __init__(
+        self,
+        engine: Engine,
+        metadata: MetaData,
+        dataset: Dataset,
+        max_memory: int,
+        create: bool = False,
+    ) -> None:
+        super().__init__(engine, metadata, dataset, create=create)
+        self._blobs = Table(
+            "cache_blob",
+            metadata,
+            Column("hash", Unicode(), primary_key=True),
+            Column("data", LargeBinary(), nullable=False),
+            extend_existing=True,
+        )
+        self._refs = Table(
+            "cache_blob_ref",
+            metadata,
+            Column("key", Unicode(), primary_key=True),
+            Column("hash", Unicode(), nullable=False, index=True),
+            extend_existing=True,
+        )
+        self._dicts = Table(
+            "cache_dict",
+            metadata,
+            Column("id", BigInteger(), primary_key=True, autoincrement=False),
+            Column("dataset", Unicode(), nullable=False, index=True),
+            Column("data", LargeBinary(), nullable=False),
+            Column("timestamp", DateTime),
+            extend_existing=True,
+        )
+        if create:
+            metadata.create_all(bind=engine, checkfirst=True)
+        self.max_memory = max_memory
+        self._memory: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._memory_size = 0
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._zstd_dicts: Dict[int, zstd.ZstdCompressionDict] = {}
+        self._compressor: Optional[zstd.ZstdCompressor] = None
+        self._dict_id: Optional[int] = None
+        self._samples: List[Union[bytes, bytearray, memoryview]] = []
+        self._vacuumed = -float(VACUUM_INTERVAL)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writes = 0
+
+    def _entry_size(self, key: str, entry: _Entry) -> int:
+        return len(key) + len(entry[0] or "")
+
+    def _remember(self, key: str, entry: _Entry) -> None:
+        self._forget(key)
+        size = self._entry_size(key, entry)
+        if size > self.max_memory:
+            return
+        self._memory[key] = entry
+        self._memory_size += size
+        while self._memory_size > self.max_memory:
+            old_key, old_entry = self._memory.popitem(last=False)
+            self._memory_size -= self._entry_size(old_key, old_entry)
+            self.evictions += 1
+
+    def _forget(self, key: str) -> None:
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._memory_size -= self._entry_size(key, entry)
+
+    def _load(self, key: str) -> Optional[_Entry]:
+        table = self._table
+        q = select(table.c.text, table.c.timestamp)
+        q = q.filter(table.c.key == key)
+        q = q.order_by(table.c.timestamp.desc())
+        q = q.limit(1)
+        try:
+            row = self.conn.execute(q).fetchone()
+        except InvalidRequestError as ire:
+            log.warning("Cache fetch error: %s" % ire)
+            self.reset()
+            return None
+        if row is None:
+            return (None, None)
+        return (self._decode(row.text), row.timestamp)
+
+    def _get_dict(self, dict_id: int) -> zstd.ZstdCompressionDict:
+        zstd_dict = self._zstd_dicts.get(dict_id)
+        if zstd_dict is None:
+            q = select(self._dicts.c.data).filter(self._dicts.c.id == dict_id)
+            data = self.conn.execute(q).scalar_one()
+            zstd_dict = zstd.ZstdCompressionDict(data)
+            self._zstd_dicts[dict_id] = zstd_dict
+        return zstd_dict
+
+    @property
+    def compressor(self) -> zstd.ZstdCompressor:
+        if self._compressor is None:
+            zstd_dict: Optional[zstd.ZstdCompressionDict] = None
+            if settings.CACHE_DICTIONARY:
+                q = select(self._dicts.c.id)
+                q = q.filter(self._dicts.c.dataset == self.dataset.name)
+                q = q.order_by(self._dicts.c.timestamp.desc()).limit(1)
+                self._dict_id = self.conn.execute(q).scalar()
+                if self._dict_id is not None:
+                    zstd_dict = self._get_dict(self._dict_id)
+            self._compressor = zstd.ZstdCompressor(
+                level=ZSTD_LEVEL, dict_data=zstd_dict
+            )
+        return self._compressor
+
+    def _train_dict(self, data: bytes) -> None:
+        """Collect samples of the cached values and train a compression dictionary
+        once there are enough of them."""
+        self._samples.append(data)
+        if len(self._samples) < DICT_SAMPLES:
+            return
+        samples, self._samples = self._samples, []
+        try:
+            zstd_dict = zstd.train_dictionary(DICT_SIZE, samples, level=ZSTD_LEVEL)
+        except zstd.ZstdError as exc:
+            log.warning("Cannot train cache dictionary: %s" % exc)
+            return
+        row = {
+            "id": zstd_dict.dict_id(),
+            "dataset": self.dataset.name,
+            "data": zstd_dict.as_bytes(),
+            "timestamp": naive_now(),
+        }
+        stmt = upsert(self._dicts).values([row]).on_conflict_do_nothing()
+        self.conn.execute(stmt)
+        self._dict_id = zstd_dict.dict_id()
+        self._zstd_dicts[self._dict_id] = zstd_dict
+        self._compressor = zstd.ZstdCompressor(level=ZSTD_LEVEL, dict_data=zstd_dict)
+        log.info("Trained cache dictionary", dataset=self.dataset.name)
+
+    def _encode(self, rows: List[Dict[str, Any]]) -> None:
+        """Replace the larger values of the given rows with references to their
+        compressed content, and store any content not yet in the database."""
+        refs: Dict[str, str] = {}
+        keys: List[Dict[str, Any]] = []
+        for row in rows:
+            text = row["text"]
+            if text is None or len(text) < BLOB_MIN_SIZE:
+                continue
+            digest = hashlib.sha256(text.encode(E)).hexdigest()
+            refs[digest] = text
+            keys.append({"key": row["key"], "hash": digest})
+            row["text"] = f"{BLOB_PREFIX}{digest}"
+        if not len(refs):
+            return
+        rstmt = upsert(self._refs).values(keys)
+        rstmt = rstmt.on_conflict_do_update(
+            index_elements=["key"], set_=dict(hash=rstmt.excluded.hash)
+        )
+        self.conn.execute(rstmt)
+        q = select(self._blobs.c.hash).filter(self._blobs.c.hash.in_(list(refs)))
+        existing: Set[str] = set(self.conn.execute(q).scalars())
+        blobs: List[Dict[str, Any]] = []
+        for digest, text in refs.items():
+            if digest in existing:
+                continue
+            data = text.encode(E)
+            blobs.append({"hash": digest, "data": self.compressor.compress(data)})
+            if settings.CACHE_DICTIONARY and self._dict_id is None:
+                self._train_dict(data)
+        if len(blobs):
+            stmt = upsert(self._blobs).values(blobs).on_conflict_do_nothing()
+            self.conn.execute(stmt)
+
+    def _decode(self, text: Value) -> Value:
+        if text is None or not text.startswith(BLOB_PREFIX):
+            return text
+        digest = text[len(BLOB_PREFIX) :]
+        q = select(self._blobs.c.data).filter(self._blobs.c.hash == digest)
+        data = self.conn.execute(q).scalar()
+        if data is None:
+            log.warning("Cached content is missing", hash=digest)
+            return None
+        dict_id = zstd.get_frame_parameters(data).dict_id
+        zstd_dict = self._get_dict(dict_id) if dict_id else None
+        decompressor = zstd.ZstdDecompressor(dict_data=zstd_dict)
+        return decompressor.decompress(data).decode(E)
+
+    def get(self, key: str, max_age: Optional[int] = None) -> Optional[Value]:
+        if max_age is not None and max_age < 1:
+            return None
+        if key in self._preload:
+            return super().get(key, max_age=max_age)
+        entry = self._memory.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._memory.move_to_end(key)
+        elif key in self._pending:
+            # Evicted from memory before it was written to the database:
+            self.hits += 1
+            row = self._pending[key]
+            entry = (row["text"], row["timestamp"])
+        else:
+            self.misses += 1
+            entry = self._load(key)
+            if entry is None:
+                return None
+            self._remember(key, entry)
+        text, timestamp = entry
+        if timestamp is None:
+            return None
+        if max_age is not None:
+            if timestamp <= naive_now() - randomize_cache(max_age):
+                return None
+        return text
+
+    def set(self, key: str, value: Value) -> None:
+        self._preload.pop(key, None)
+        timestamp = naive_now()
+        self._remember(key, (value, timestamp))
+        self._pending[key] = {
+            "timestamp": timestamp,
+            "key": key,
+            "dataset": self.dataset.name,
+            "text": value,
+        }
+        if len(self._pending) >= WRITE_BATCH:
+            self._write()
+
+    def _write(self) -> None:
+        if not len(self._pending):
+            return
+        rows = [dict(r) for r in self._pending.values()]
+        self._pending = {}
+        try:
+            self._encode(rows)
+            istmt = upsert(self._table).values(rows)
+            values = dict(timestamp=istmt.excluded.timestamp, text=istmt.excluded.text)
+            stmt = istmt.on_conflict_do_update(index_elements=["key"], set_=values)
+            self.conn.execute(stmt)
+            self.writes += len(rows)
+        except (OperationalError, InvalidRequestError) as exc:
+            log.info("Error while saving to cache: %s" % exc)
+            self.reset()
+
+    def delete(self, key: str) -> None:
+        self._forget(key)
+        self._pending.pop(key, None)
+        super().delete(key)
+
+    def all(self, like: Optional[str]) -> Generator[CacheValue, None, None]:
+        self._write()
+        for value in super().all(like):
+            value.text = self._decode(value.text)
+            yield value
+
+    def clear(self) -> None:
+        self._memory.clear()
+        self._memory_size = 0
+        self._pending = {}
+        super().clear()
+
+    def vacuum(self) -> None:
+        """Delete the expired entries of the dataset. The content they refer to is
+        left to `sweep_blobs`, as it may be shared with other datasets."""
+        if settings.CACHE_MAX_AGE < 1:
+            return
+        cutoff = naive_now() - timedelta(days=settings.CACHE_MAX_AGE)
+        table = self._table
+        pq = delete(table).where(table.c.dataset == self.dataset.name)
+        pq = pq.where(table.c.timestamp < cutoff)
+        deleted = self.conn.execute(pq).rowcount
+        for key, (_, timestamp) in list(self._memory.items()):
+            if timestamp is not None and timestamp < cutoff:
+                self._forget(key)
+        log.info("Vacuumed cache", dataset=self.dataset.name, expired=deleted)
+
+    def sweep_blobs(self) -> None:
+        """Delete the stored content which is no longer referred to by any entry
+        of the cache. This scans the whole database, so it is run as a separate
+        maintenance step rather than when a dataset is flushed."""
+        self._write()
+        table, refs, blobs = self._table, self._refs, self._blobs
+        # References of entries which were deleted or replaced:
+        current = exists().where(table.c.key == refs.c.key)
+        current = current.where(
+            table.c.text == literal(BLOB_PREFIX, Unicode()) + refs.c.hash
+        )
+        stale = self.conn.execute(delete(refs).where(~current)).rowcount
+        referred = exists().where(refs.c.hash == blobs.c.hash)
+        orphans = self.conn.execute(delete(blobs).where(~referred)).rowcount
+        log.info("Swept cache content", stale=stale, orphans=orphans)
+
+    def flush(self) -> None:
+        self._write()
+        # Expired entries are deleted in passing, at most once per interval:
+        if time.monotonic() - self._vacuumed > VACUUM_INTERVAL:
+            self._vacuumed = time.monotonic()
+            try:
+                self.vacuum()
+            except (OperationalError, InvalidRequestError) as exc:
+                log.info("Error while vacuuming the cache: %s" % exc)
+                self.reset()
+        super().flush()
+
+    def close(self) -> None:
+        super().close()
+        log.info(
+            "Cache statistics",
+            dataset=self.dataset.name,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            writes=self.writes,
+        )
+
+    def __repr__(self) -> str:
+        return f"<TieredCache({self._table!r})>"
 
 
 @cache
@@ -25,7 +378,7 @@ def get_metadata(uri: str) -> MetaData:
 
 
 @cache
-def get_cache(dataset: Dataset) -> Cache:
+def get_cache(dataset: Dataset) -> TieredCache:
     """Get a cache object for the given dataset."""
     database_uri = settings.CACHE_DATABASE_URI
     if database_uri is None:
@@ -34,4 +387,5 @@ def get_cache(dataset: Dataset) -> Cache:
     engine = get_engine(database_uri)
     metadata = get_metadata(database_uri)
     log.info("Using cache: %r" % engine, dataset=dataset.name)
-    return Cache(engine, metadata, dataset, create=True)
+    max_memory = settings.CACHE_MEMORY_SIZE * 1024 * 1024
+    return TieredCache(engine, metadata, dataset, max_memory, create=True)
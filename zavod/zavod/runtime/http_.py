@@ -1,16 +1,20 @@
+import time
 import warnings
-from typing import Any, Optional, Tuple, Mapping, Union, List
+import threading
+from typing import Any, Dict, Optional, Tuple, Mapping, Union, List
 from functools import partial
 from pathlib import Path
+from urllib.parse import urlparse
 from banal import hash_data
-from requests import Session
+from requests import PreparedRequest, Response, Session
 from requests.adapters import HTTPAdapter
-from urllib3.exceptions import InsecureRequestWarning
+from urllib3.exceptions import InsecureRequestWarning, InvalidHeader
 from urllib3.util import Retry
 
 from zavod import settings
 from zavod.logs import get_logger
 from zavod.meta.http import HTTP
+from zavod.runtime.stats import HTTPStats
 
 log = get_logger(__name__)
 warnings.filterwarnings("ignore", category=InsecureRequestWarning)
@@ -20,7 +24,140 @@ _Headers = Optional[Mapping[str, str]]
 _Body = Optional[Union[Mapping[str, str], List[Tuple[str, str]]]]
 
 
-def make_session(http_conf: HTTP) -> Session:
+THROTTLE_STATUSES = (429, 503)
+MIN_RATE_FACTOR = 1 / 16
+"""Throttling responses never slow a host down below this share of its rate."""
+
+
+class TokenBucket(object):
+    """A token bucket for one host: requests may be sent in bursts of up to
+    `burst` requests, and are otherwise spaced to `rate` requests per second. A
+    bucket without a rate only makes requests wait while the host is blocked."""
+
+    def __init__(self, rate: Optional[float], burst: int) -> None:
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def reserve(self, now: float) -> float:
+        """Take a token and return the number of seconds to wait for it."""
+        if self.rate is None:
+            return max(0.0, self.updated - now)
+        if now > self.updated:
+            elapsed = now - self.updated
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.updated = now
+        self.tokens -= 1
+        deficit = max(0.0, -self.tokens) / self.rate
+        return max(0.0, self.updated - now) + deficit
+
+    def throttle(self, now: float, retry_after: Optional[float]) -> None:
+        """Slow down after the host responded that it is overloaded."""
+        if self.rate is not None and self.max_rate is not None:
+            min_rate = self.max_rate * MIN_RATE_FACTOR
+            self.rate = max(min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+        if retry_after is not None:
+            self.updated = max(self.updated, now + retry_after)
+
+    def recover(self) -> None:
+        """Speed up again after a successful response."""
+        if self.rate is not None and self.max_rate is not None:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class RateLimiter(object):
+    """Limit the rate of requests sent to each host, as configured in the `http`
+    section of the dataset metadata. Safe to share between threads."""
+
+    def __init__(self, http_conf: HTTP) -> None:
+        self.http_conf = http_conf
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    def _bucket(self, url: str) -> TokenBucket:
+        host = urlparse(url).netloc
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            rate = self.http_conf.get_rate_limit(host)
+            bucket = TokenBucket(rate, self.http_conf.burst)
+            self._buckets[host] = bucket
+        return bucket
+
+    def wait(self, url: str) -> float:
+        """Block until a request to the host of the given URL may be sent, and
+        return the number of seconds spent waiting."""
+        with self._lock:
+            delay = self._bucket(url).reserve(time.monotonic())
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def throttle(self, url: str, retry_after: Optional[float] = None) -> None:
+        with self._lock:
+            self._bucket(url).throttle(time.monotonic(), retry_after)
+
+    def recover(self, url: str) -> None:
+        with self._lock:
+            self._bucket(url).recover()
+
+
+class LimitedAdapter(HTTPAdapter):
+    """A transport adapter which sends requests through a `RateLimiter` and
+    records their outcome in the context's HTTP statistics."""
+
+    def __init__(
+        self,
+        limiter: RateLimiter,
+        stats: Optional[HTTPStats] = None,
+        **kwargs: Any,
+    ) -> None:
+        self.limiter = limiter
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def send(self, request: PreparedRequest, *args: Any, **kwargs: Any) -> Response:
+        url = request.url or ""
+        waited = self.limiter.wait(url)
+        if waited > 0 and self.stats is not None:
+            self.stats.observe_wait(waited)
+        started = time.monotonic()
+        response = super().send(request, *args, **kwargs)
+        self.observe(url, response, time.monotonic() - started)
+        return response
+
+    def observe(self, url: str, response: Response, latency: float) -> None:
+        """Adapt the rate limit of the host to the response."""
+        # Retries made by urllib3 within the request, e.g. for 429 responses:
+        history = getattr(getattr(response.raw, "retries", None), "history", ())
+        throttled = sum(1 for h in history if h.status in THROTTLE_STATUSES)
+        if response.status_code in THROTTLE_STATUSES:
+            throttled += 1
+            retry_after = None
+            header = response.headers.get("Retry-After")
+            if header is not None:
+                try:
+                    retry_after = Retry().parse_retry_after(header)
+                except InvalidHeader:
+                    pass
+            self.limiter.throttle(url, retry_after)
+            log.info(
+                "HTTP request throttled",
+                url=url,
+                status=response.status_code,
+                retry_after=retry_after,
+            )
+        elif throttled > 0:
+            self.limiter.throttle(url)
+        else:
+            self.limiter.recover(url)
+        if self.stats is not None:
+            self.stats.observe(latency, len(history), throttled)
+
+
+def make_session(http_conf: HTTP, stats: Optional[HTTPStats] = None) -> Session:
     session = Session()
     session.headers["User-Agent"] = http_conf.user_agent
     session.verify = False
@@ -34,8 +171,16 @@ def make_session(http_conf: HTTP) -> Session:
         status_forcelist=http_conf.retry_statuses,
         allowed_methods=http_conf.retry_methods,
     )
-    session.mount("https://", HTTPAdapter(max_retries=retries))
-    session.mount("http://", HTTPAdapter(max_retries=retries))
+    # One limiter is shared by both adapters, so each host has a single bucket:
+    limiter = RateLimiter(http_conf)
+    for prefix in ("https://", "http://"):
+        adapter = LimitedAdapter(
+            limiter,
+            stats=stats,
+            max_retries=retries,
+            pool_maxsize=max(1, http_conf.max_concurrency),
+        )
+        session.mount(prefix, adapter)
     return session
 
 
@@ -59,20 +204,17 @@ def request_hash(
     return f"{url}[{hsh}]"
 
 
-def fetch_file(
+def download_file(
     session: Session,
     url: str,
-    name: str,
-    data_path: Path = settings.DATA_PATH,
+    out_path: Path,
     auth: Optional[Any] = None,
     headers: Optional[Any] = None,
     method: str = "GET",
     data: _Body = None,
-) -> Path:
-    """Fetch a (large) file via HTTP to the data path."""
-    out_path = data_path.joinpath(name)
-    if out_path.exists():
-        return out_path
+) -> Response:
+    """Download the response body of an HTTP request to the given path. Nothing
+    is written if the server responds that the resource is not modified."""
     log.info("Fetching file", url=url)
     out_path.parent.mkdir(parents=True, exist_ok=True)
     with session.request(
@@ -84,7 +226,35 @@ def fetch_file(
         data=data,
     ) as res:
         res.raise_for_status()
+        if res.status_code == 304:
+            return res
         with open(out_path, "wb") as fh:
             for chunk in res.iter_content(chunk_size=8192 * 10):
                 fh.write(chunk)
+    return res
+
+
+def fetch_file(
+    session: Session,
+    url: str,
+    name: str,
+    data_path: Path = settings.DATA_PATH,
+    auth: Optional[Any] = None,
+    headers: Optional[Any] = None,
+    method: str = "GET",
+    data: _Body = None,
+) -> Path:
+    """Fetch a (large) file via HTTP to the data path."""
+    out_path = data_path.joinpath(name)
+    if out_path.exists():
+        return out_path
+    download_file(
+        session,
+        url,
+        out_path,
+        auth=auth,
+        headers=headers,
+        method=method,
+        data=data,
+    )
     return out_path
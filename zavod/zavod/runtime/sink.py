@@ -4,8 +4,13 @@ from nomenklatura.statement import Statement
 from nomenklatura.statement.serialize import PackStatementWriter
 
 
+from zavod import settings
 from zavod.meta import Dataset
 from zavod.archive import dataset_resource_path, STATEMENTS_FILE
+from zavod.archive import STATEMENTS_COLUMNAR_FILE, TIMESTAMPS_FILE
+from zavod.archive.columnar import write_columnar_statements
+from zavod.archive.compression import open_text_writer
+from zavod.runtime.timestamps import TimeStampWriter
 
 
 class DatasetSink(object):
@@ -14,26 +19,48 @@ class DatasetSink(object):
     def __init__(self, dataset: Dataset) -> None:
         self.dataset = dataset
         self.path = dataset_resource_path(dataset.name, STATEMENTS_FILE)
+        self.columnar_path = dataset_resource_path(
+            dataset.name, STATEMENTS_COLUMNAR_FILE
+        )
+        self.timestamps_path = dataset_resource_path(dataset.name, TIMESTAMPS_FILE)
         self.fh: Optional[TextIO] = None
         self.writer: Optional[PackStatementWriter] = None
+        self.timestamps: Optional[TimeStampWriter] = None
 
     def emit(self, stmt: Statement) -> None:
         """Write a statement to the dataset output."""
         if self.fh is None or self.writer is None:
-            self.fh = open(self.path, "w", encoding=DEFAULT_ENCODING)
+            # A columnar file from a previous run would shadow the new statements:
+            self.columnar_path.unlink(missing_ok=True)
+            self.fh = open_text_writer(
+                self.path,
+                compression=settings.STATEMENTS_COMPRESSION,
+                encoding=DEFAULT_ENCODING,
+            )
             self.writer = PackStatementWriter(self.fh)
+            self.timestamps = TimeStampWriter(self.timestamps_path)
         self.writer.write(stmt)
+        if not stmt.external and self.timestamps is not None:
+            self.timestamps.add(stmt)
 
     def close(self) -> None:
+        written = self.writer is not None
         if self.writer is not None:
             self.writer.close()
             self.writer = None
         if self.fh is not None:
             self.fh.close()
             self.fh = None
+        if self.timestamps is not None:
+            self.timestamps.close()
+            self.timestamps = None
+        if written and settings.STATEMENTS_COLUMNAR:
+            write_columnar_statements(self.path, self.columnar_path)
 
     def clear(self) -> None:
         """Delete the dataset statements output file."""
         self.close()
         if self.path.is_file():
             self.path.unlink()
+        self.columnar_path.unlink(missing_ok=True)
+        self.timestamps_path.unlink(missing_ok=True)
@@ -0,0 +1,86 @@
+import json
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+from requests import Response
+
+from zavod.meta import Dataset
+from zavod.archive import dataset_resource_path, get_dataset_artifact
+from zavod.archive import ARTIFACTS, SOURCES, SOURCES_FILE
+from zavod.archive.backend import ArchiveObject, get_archive_backend
+
+
+class DatasetSources(object):
+    """Remember the HTTP validators (ETag, Last-Modified) of the files fetched by
+    the dataset, and the version of the dataset with which a copy of each file
+    was archived. This is published with each version, so that the next run can
+    make conditional requests and reuse the archived copy of unchanged files."""
+
+    def __init__(self, dataset: Dataset) -> None:
+        self.dataset = dataset
+        self.path = dataset_resource_path(dataset.name, SOURCES_FILE)
+        self.unchanged: Set[str] = set()
+        self._sources: Optional[Dict[str, Dict[str, Any]]] = None
+
+    @property
+    def sources(self) -> Dict[str, Dict[str, Any]]:
+        if self._sources is None:
+            self._sources = {}
+            if not self.path.exists():
+                self.path = get_dataset_artifact(self.dataset.name, SOURCES_FILE)
+            if self.path.exists():
+                with open(self.path, "r") as fh:
+                    self._sources = json.load(fh).get("sources", {})
+        return self._sources
+
+    def _store(self) -> None:
+        with open(self.path, "w") as fh:
+            json.dump({"sources": self.sources}, fh, indent=2, sort_keys=True)
+
+    def get_object(self, key: str) -> Optional[ArchiveObject]:
+        """Get the archived copy of the file fetched with the given request
+        fingerprint, if there is one."""
+        source = self.sources.get(key)
+        if source is None or source.get("version") is None:
+            return None
+        name = f"{ARTIFACTS}/{self.dataset.name}/{source['version']}"
+        object = get_archive_backend().get_object(f"{name}/{SOURCES}/{source['name']}")
+        if not object.exists() or object.size() != source.get("size"):
+            return None
+        return object
+
+    def conditional_headers(self, key: str) -> Dict[str, str]:
+        """Request headers to only fetch the file again if it has changed."""
+        source = self.sources.get(key, {})
+        headers: Dict[str, str] = {}
+        if source.get("etag") is not None:
+            headers["If-None-Match"] = source["etag"]
+        if source.get("last_modified") is not None:
+            headers["If-Modified-Since"] = source["last_modified"]
+        return headers
+
+    def save(
+        self, key: str, name: str, path: Path, response: Response, version: str
+    ) -> None:
+        """Record the validators of a file which has been downloaded in the run
+        of the given version."""
+        self.unchanged.discard(name)
+        self.sources[key] = {
+            "name": name,
+            "url": response.url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "size": path.stat().st_size,
+            "version": version,
+        }
+        self._store()
+
+    def reuse(self, key: str) -> None:
+        """Record that the archived copy of a file is still current."""
+        self.unchanged.add(self.sources[key]["name"])
+
+    def fetched(self, version: str) -> List[str]:
+        """The names of the files downloaded in the run of the given version,
+        which need to be archived with it."""
+        return sorted(
+            s["name"] for s in self.sources.values() if s["version"] == version
+        )
@@ -1,14 +1,73 @@
+import threading
+from array import array
+from typing import Any, Dict, Optional
+
 # from zavod.entity import Entity
 
 
+class HTTPStats(object):
+    """Counters for the HTTP requests made by a context. They are updated by the
+    session's transport adapters, possibly from several threads."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.latencies = array("d")
+
+    def observe_wait(self, seconds: float) -> None:
+        with self._lock:
+            self.waits += 1
+            self.wait_time += seconds
+
+    def observe(self, latency: float, retries: int, throttled: int) -> None:
+        with self._lock:
+            self.requests += 1
+            self.retries += retries
+            self.throttled += throttled
+            self.latencies.append(latency)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        """The response latency, in seconds, below which `pct` percent of the
+        requests completed."""
+        with self._lock:
+            latencies = sorted(self.latencies)
+        if not len(latencies):
+            return None
+        idx = min(len(latencies) - 1, int(len(latencies) * pct / 100))
+        return latencies[idx]
+
+    def as_dict(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = {
+            "requests": self.requests,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "waits": self.waits,
+            "wait_time": round(self.wait_time, 3),
+        }
+        for pct in (50, 90, 99):
+            latency = self.percentile(pct)
+            if latency is not None:
+                data[f"latency_p{pct}"] = round(latency, 3)
+        return data
+
+
 class ContextStats(object):
     """A simple object for tracking the number of statements, entities and targets
     emitted by a dataset context while running the dataset method."""
 
     def __init__(self) -> None:
+        self.http = HTTPStats()
         self.reset()
 
     def reset(self) -> None:
+        self.http.reset()
         self.statements = 0
         self.changed = 0
         self.entities = 0
@@ -1,58 +1,270 @@
-import plyvel  # type: ignore
-from typing import Dict, Iterable
+"""The timestamp index stores the first_seen date of every statement emitted by a
+dataset, so that statements emitted again can keep their original date. It is a
+compact binary artifact published with each version of the dataset: a header
+with a dictionary of the distinct dates, followed by three columns with the
+hashed entity IDs, the hashed statement IDs and the dates, sorted by entity. The
+columns are memory-mapped and the entity column is searched with a binary search,
+so the index needs no building or loading when a crawl starts."""
+
+import json
+import shutil
+import struct
+import numpy as np
+import numpy.typing as npt
+from array import array
+from hashlib import blake2b
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 from nomenklatura.statement import Statement
 from rigour.env import ENCODING as E
 
 from zavod.logs import get_logger
 from zavod.meta import Dataset
 from zavod.archive import dataset_state_path, iter_previous_statements
+from zavod.archive import get_artifact_object
+from zavod.archive.backend import get_archive_backend
+from zavod.archive import STATEMENTS_FILE, TIMESTAMPS_FILE
 
 log = get_logger(__name__)
+MAGIC = b"ZTSTAMP2"
+RECORD = np.dtype([("entity", "<u8"), ("stmt", "<u8"), ("date", "<u4")])
+# The number of records buffered by the writer before they are sorted and
+# flushed to disk as a run (about 20 bytes each):
+RUN_SIZE = 2_000_000
+# The number of records read from each run per step of the merge:
+MERGE_CHUNK = 100_000
+
+
+def _hash(value: str) -> int:
+    digest = blake2b(value.encode(E), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _column_offsets(header_length: int, count: int) -> Tuple[int, int, int]:
+    """Get the file offsets of the entity, statement and date columns."""
+    offset = len(MAGIC) + 8 + header_length
+    offset += -offset % 8
+    return offset, offset + count * 8, offset + count * 16
+
+
+class TimeStampWriter(object):
+    """Collect the first_seen dates of statements and write them to a timestamp
+    index file. Records are buffered up to `RUN_SIZE`, then sorted and flushed to
+    a run file next to the index. On close, the runs are merged into the index
+    in chunks, so the memory used does not grow with the size of the dataset."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.runs_path = path.with_name(f"{path.name}.runs")
+        shutil.rmtree(self.runs_path, ignore_errors=True)
+        self.runs: List[npt.NDArray[Any]] = []
+        self.entities = array("Q")
+        self.stmts = array("Q")
+        self.dates = array("I")
+        self.date_ids: Dict[str, int] = {}
+
+    def add(self, stmt: Statement) -> None:
+        if stmt.first_seen is None or stmt.id is None or stmt.entity_id is None:
+            return
+        if len(stmt.first_seen.strip()) == 0:
+            return
+        date_id = self.date_ids.setdefault(stmt.first_seen, len(self.date_ids))
+        self.entities.append(_hash(stmt.entity_id))
+        self.stmts.append(_hash(stmt.id))
+        self.dates.append(date_id)
+        if len(self.entities) >= RUN_SIZE:
+            self._flush()
+
+    def _sorted_buffer(self) -> npt.NDArray[Any]:
+        records = np.empty(len(self.entities), dtype=RECORD)
+        records["entity"] = np.frombuffer(self.entities, dtype=np.uint64)
+        records["stmt"] = np.frombuffer(self.stmts, dtype=np.uint64)
+        records["date"] = np.frombuffer(self.dates, dtype=np.uint32)
+        records.sort(order=("entity", "stmt"))
+        self.entities = array("Q")
+        self.stmts = array("Q")
+        self.dates = array("I")
+        return records
+
+    def _flush(self) -> None:
+        self.runs_path.mkdir(parents=True, exist_ok=True)
+        run_path = self.runs_path / f"{len(self.runs)}.npy"
+        np.save(run_path, self._sorted_buffer())
+        self.runs.append(np.load(run_path, mmap_mode="r"))
+
+    def _merge(self, runs: List[npt.NDArray[Any]]) -> Iterable[npt.NDArray[Any]]:
+        """Merge the sorted runs into sorted chunks of records. Each step reads a
+        chunk from every run and emits the records up to the smallest of their
+        last keys, which no record left in any of the runs can precede."""
+        cursors = [0 for _ in runs]
+        while True:
+            chunks = []
+            for idx, (run, cursor) in enumerate(zip(runs, cursors)):
+                if cursor < len(run):
+                    chunks.append((idx, run[cursor : cursor + MERGE_CHUNK]))
+            if not len(chunks):
+                return
+            cut = min((c[-1]["entity"], c[-1]["stmt"]) for _, c in chunks)
+            parts = []
+            for idx, chunk in chunks:
+                entity, stmt = chunk["entity"], chunk["stmt"]
+                below = (entity < cut[0]) | ((entity == cut[0]) & (stmt <= cut[1]))
+                taken = int(np.count_nonzero(below))
+                parts.append(chunk[:taken])
+                cursors[idx] += taken
+            merged = np.concatenate(parts)
+            merged.sort(order=("entity", "stmt"))
+            yield merged
+
+    def close(self) -> int:
+        """Write the index file and return the number of records."""
+        runs = self.runs
+        if len(self.entities) or not len(runs):
+            runs = runs + [self._sorted_buffer()]
+        count = sum(len(run) for run in runs)
+        dates = sorted(self.date_ids, key=lambda d: self.date_ids[d])
+        header = json.dumps({"dates": dates, "count": count}).encode(E)
+        entity_at, stmt_at, date_at = _column_offsets(len(header), count)
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as fh:
+            fh.write(MAGIC)
+            fh.write(struct.pack("<Q", len(header)))
+            fh.write(header)
+            fh.truncate(date_at + count * 4)
+        if count > 0:
+            entities = np.memmap(
+                tmp_path, np.uint64, mode="r+", offset=entity_at, shape=(count,)
+            )
+            stmts = np.memmap(
+                tmp_path, np.uint64, mode="r+", offset=stmt_at, shape=(count,)
+            )
+            date_ids = np.memmap(
+                tmp_path, np.uint32, mode="r+", offset=date_at, shape=(count,)
+            )
+            pos = 0
+            for merged in self._merge(runs):
+                end = pos + len(merged)
+                entities[pos:end] = merged["entity"]
+                stmts[pos:end] = merged["stmt"]
+                date_ids[pos:end] = merged["date"]
+                pos = end
+            for column in (entities, stmts, date_ids):
+                column.flush()
+            del entities, stmts, date_ids
+        self.runs = []
+        shutil.rmtree(self.runs_path, ignore_errors=True)
+        tmp_path.replace(self.path)
+        return count
+
+
+class StatementTimestamps(object):
+    """The first_seen dates of the statements of one entity."""
+
+    def __init__(self, dates: Dict[int, str]) -> None:
+        self.dates = dates
+
+    def get(self, stmt_id: str, default: Optional[str] = None) -> Optional[str]:
+        return self.dates.get(_hash(stmt_id), default)
+
+    def __len__(self) -> int:
+        return len(self.dates)
 
 
 class TimeStampIndex(object):
     def __init__(self, dataset: Dataset) -> None:
-        path = dataset_state_path(dataset.name) / "timestamps"
-        self.db = plyvel.DB(path.as_posix(), create_if_missing=True)
+        self.path = dataset_state_path(dataset.name) / TIMESTAMPS_FILE
+        self.dates: List[str] = []
+        self.keys: npt.NDArray[np.uint64] = np.zeros(0, dtype=np.uint64)
+        self.stmts: npt.NDArray[np.uint64] = np.zeros(0, dtype=np.uint64)
+        self.date_ids: npt.NDArray[np.uint32] = np.zeros(0, dtype=np.uint32)
+        if self.path.exists():
+            try:
+                self._open()
+            except ValueError as exc:
+                log.warning("Cannot open timestamp index: %s" % exc)
+
+    def _open(self) -> None:
+        with open(self.path, "rb") as fh:
+            if fh.read(len(MAGIC)) != MAGIC:
+                raise ValueError("Invalid timestamp index: %s" % self.path)
+            (length,) = struct.unpack("<Q", fh.read(8))
+            header = json.loads(fh.read(length).decode(E))
+        self.dates = header["dates"]
+        count = header["count"]
+        if count == 0:
+            self.close()
+            return
+        entity_at, stmt_at, date_at = _column_offsets(length, count)
+        self.keys = np.memmap(
+            self.path, np.uint64, mode="r", offset=entity_at, shape=(count,)
+        )
+        self.stmts = np.memmap(
+            self.path, np.uint64, mode="r", offset=stmt_at, shape=(count,)
+        )
+        self.date_ids = np.memmap(
+            self.path, np.uint32, mode="r", offset=date_at, shape=(count,)
+        )
 
     def index(self, statements: Iterable[Statement]) -> None:
         log.info("Building timestamp index...")
-        batch = self.db.write_batch()
-        idx = 0
-        for idx, stmt in enumerate(statements):
-            if stmt.first_seen is None or stmt.id is None or stmt.entity_id is None:
-                continue
-            if len(stmt.first_seen.strip()) == 0:
-                continue
-            key = f"{stmt.entity_id}:{stmt.id}"
-            batch.put(key.encode(E), stmt.first_seen.encode(E))
-            if idx > 0 and idx % 500_000 == 0:
-                batch.write()
-                batch = self.db.write_batch()
-        batch.write()
-        # self.db.compact_range()
-        log.info("Index ready.", count=idx)
+        writer = TimeStampWriter(self.path)
+        for stmt in statements:
+            writer.add(stmt)
+        count = writer.close()
+        self._open()
+        log.info("Index ready.", count=count)
 
     @classmethod
     def build(cls, dataset: Dataset) -> "TimeStampIndex":
         index = cls(dataset)
+        # Use the timestamps published with the previous statements if possible:
+        object = get_artifact_object(dataset.name, STATEMENTS_FILE)
+        if object is not None:
+            prefix, _ = object.name.rsplit("/", 1)
+            backend = get_archive_backend()
+            stamps = backend.get_object(f"{prefix}/{TIMESTAMPS_FILE}")
+            if stamps.exists():
+                log.info("Backfilling timestamp index...", object=stamps.name)
+                stamps.backfill(index.path)
+                try:
+                    index._open()
+                    return index
+                except ValueError as exc:
+                    # Published in an older format, rebuild it:
+                    log.warning("Cannot open timestamp index: %s" % exc)
         index.index(iter_previous_statements(dataset, external=False))
         return index
 
-    def get(self, entity_id: str) -> Dict[str, str]:
-        timestamps: Dict[str, str] = {}
-        prefix = entity_id.encode(E)
-        with self.db.iterator(prefix=prefix) as it:
-            for key, value in it:
-                stmt_id = key.decode(E).split(":", 1)[1]
-                timestamps[stmt_id] = value.decode(E)
-        return timestamps
+    def _read(self, start: int, end: int) -> StatementTimestamps:
+        stmts = zip(self.stmts[start:end].tolist(), self.date_ids[start:end].tolist())
+        return StatementTimestamps({s: self.dates[d] for s, d in stmts})
+
+    def get(self, entity_id: str) -> StatementTimestamps:
+        key = np.uint64(_hash(entity_id))
+        start = int(np.searchsorted(self.keys, key, side="left"))
+        end = int(np.searchsorted(self.keys, key, side="right"))
+        return self._read(start, end)
+
+    def get_many(self, entity_ids: Iterable[str]) -> Dict[str, StatementTimestamps]:
+        """Get the timestamps for a batch of entities. The entity keys are sorted,
+        so the index is read in a single ordered pass."""
+        ids = list(set(entity_ids))
+        keys = np.array([_hash(i) for i in ids], dtype=np.uint64)
+        order = np.argsort(keys, kind="stable")
+        starts = np.searchsorted(self.keys, keys[order], side="left")
+        ends = np.searchsorted(self.keys, keys[order], side="right")
+        results: Dict[str, StatementTimestamps] = {}
+        for idx, start, end in zip(order, starts, ends):
+            results[ids[idx]] = self._read(start, end)
+        return results
 
     def close(self) -> None:
-        self.db.close()
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.stmts = np.zeros(0, dtype=np.uint64)
+        self.date_ids = np.zeros(0, dtype=np.uint32)
 
     def __hash__(self) -> int:
-        return hash(self.db.name)
+        return hash(self.path)
 
     def __repr__(self) -> str:
-        return f"<TimeStampIndex({self.db.name!r})>"
+        return f"<TimeStampIndex({self.path.as_posix()!r})>"
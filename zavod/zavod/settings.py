@@ -69,6 +69,18 @@ ENRICH_TOPICS = {
 # Store configuration
 STORE_RETAIN_DAYS = int(env_str("ZAVOD_STORE_RETAIN_DAYS", "3"))
 
+# Number of worker processes used to decode leaf datasets in a store sync
+STORE_SYNC_WORKERS = int(env_str("ZAVOD_STORE_SYNC_WORKERS", "1"))
+
+# Number of assembled entities kept in memory during an export or validation pass
+VIEW_CACHE_SIZE = int(env_str("ZAVOD_VIEW_CACHE_SIZE", "10000"))
+
+# Number of tokenized property values kept in memory while building a blocking index
+TOKENIZER_CACHE_SIZE = int(env_str("ZAVOD_TOKENIZER_CACHE_SIZE", "200000"))
+
+# Number of worker processes used to export shards of the entities in a store
+EXPORT_WORKERS = int(env_str("ZAVOD_EXPORT_WORKERS", "1"))
+
 # Release version
 RELEASE = env_str("ZAVOD_RELEASE", RUN_TIME.strftime("%Y%m%d"))
 
@@ -81,6 +93,18 @@ ARCHIVE_BACKEND = env.get("ZAVOD_ARCHIVE_BACKEND", "FileSystemBackend")
 ARCHIVE_BUCKET = env.get("ZAVOD_ARCHIVE_BUCKET", None)
 ARCHIVE_BUCKET = env.get("OPENSANCTIONS_BACKFILL_BUCKET", ARCHIVE_BUCKET)
 ARCHIVE_PATH = Path(env.get("ZAVOD_ARCHIVE_PATH", DATA_PATH.joinpath("archive")))
+
+# Archive objects are read in chunks, with several range reads in flight
+ARCHIVE_CHUNK_SIZE = int(env_str("ZAVOD_ARCHIVE_CHUNK_SIZE", str(16 * 1024 * 1024)))
+ARCHIVE_WORKERS = int(env_str("ZAVOD_ARCHIVE_WORKERS", "8"))
+
+# A local cache directory for archive objects, which can be shared by processes
+ARCHIVE_CACHE_PATH = env.get("ZAVOD_ARCHIVE_CACHE_PATH")
+# Maximum size of the archive cache, in MB
+ARCHIVE_CACHE_SIZE = int(env_str("ZAVOD_ARCHIVE_CACHE_SIZE", "20480"))
+
+# Number of files uploaded to the archive at the same time when publishing
+PUBLISH_WORKERS = int(env_str("ZAVOD_PUBLISH_WORKERS", "4"))
 BACKFILL_RELEASE = env_str("ZAVOD_BACKFILL_RELEASE", "latest")
 
 # File path for the resolver path used for entity deduplication
@@ -95,6 +119,18 @@ HTTP_USER_AGENT = env_str("ZAVOD_HTTP_USER_AGENT", HTTP_USER_AGENT)
 # Database-backed cache settings
 CACHE_DATABASE_URI = env.get("ZAVOD_DATABASE_URI")
 CACHE_DATABASE_URI = env.get("OPENSANCTIONS_DATABASE_URI", CACHE_DATABASE_URI)
+# Memory used to keep recently used cache entries in the process, in MB
+CACHE_MEMORY_SIZE = int(env_str("ZAVOD_CACHE_MEMORY_SIZE", "128"))
+# Train a compression dictionary on the cached responses of each dataset
+CACHE_DICTIONARY = as_bool(env_str("ZAVOD_CACHE_DICTIONARY", "false"))
+# Cache entries older than this number of days are deleted, 0 to keep them all
+CACHE_MAX_AGE = int(env_str("ZAVOD_CACHE_MAX_AGE", "180"))
+
+# Write a columnar copy of the statements next to the statement pack
+STATEMENTS_COLUMNAR = as_bool(env_str("ZAVOD_STATEMENTS_COLUMNAR", "false"))
+
+# Compress the statement pack ("gzip" or "zstd"), readers detect the compression
+STATEMENTS_COMPRESSION = env.get("ZAVOD_STATEMENTS_COMPRESSION")
 
 # Load DB batch size
 DB_BATCH_SIZE = int(env_str("ZAVOD_DB_BATCH_SIZE", "1000"))
@@ -1,21 +1,213 @@
+import os
+import math
+import pickle
 import shutil
+import hashlib
 import plyvel  # type: ignore
-from typing import List, Optional
+import multiprocessing
+from pathlib import Path
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Deque, Dict, Generator, List, Optional, Set, Tuple
 from followthemoney.exc import InvalidData
+from followthemoney.types import registry
+from followthemoney.property import Property
 from nomenklatura.statement import Statement
 from nomenklatura.resolver import Linker
-from nomenklatura.store.level import LevelDBStore, LevelDBView
+from nomenklatura.store.level import LevelDBStore, LevelDBView, unpack_statement
 from nomenklatura.publish.dates import simplify_dates
 from nomenklatura.publish.edges import simplify_undirected
 
+from zavod import settings
 from zavod.logs import get_logger
 from zavod.entity import Entity
-from zavod.meta import Dataset
-from zavod.archive import dataset_state_path
+from zavod.meta import Dataset, get_catalog
+from zavod.archive import dataset_state_path, get_statements_version
 from zavod.archive import iter_dataset_statements
 
 log = get_logger(__name__)
 View = LevelDBView[Dataset, Entity]
+RUN_BATCH = 10_000
+REMOVE_BATCH = 10_000
+E = "utf-8"
+# Files of a LevelDB database which are not needed to open a copy of it:
+SNAPSHOT_SKIP = ("LOCK", "LOG", "LOG.old")
+
+
+def _dump_leaf_statements(leaf_name: str, path: Path) -> int:
+    """Decode all statements of a leaf dataset in a worker process and write them
+    as pickled batches to a run file, to be loaded by the single store writer."""
+    leaf = get_catalog().require(leaf_name)
+    count = 0
+    batch: List[Tuple[Any, ...]] = []
+    with open(path, "wb") as fh:
+        for stmt in iter_dataset_statements(leaf, external=True):
+            batch.append(
+                (
+                    stmt.id,
+                    stmt.entity_id,
+                    stmt.prop,
+                    stmt.schema,
+                    stmt.value,
+                    stmt.dataset,
+                    stmt.lang,
+                    stmt.original_value,
+                    stmt.first_seen,
+                    stmt.last_seen,
+                    stmt.target,
+                    stmt.external,
+                )
+            )
+            if len(batch) >= RUN_BATCH:
+                pickle.dump(batch, fh, protocol=pickle.HIGHEST_PROTOCOL)
+                count += len(batch)
+                batch = []
+        pickle.dump(batch, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        count += len(batch)
+    return count
+
+
+def _read_leaf_statements(path: Path) -> Generator[Statement, None, None]:
+    with open(path, "rb") as fh:
+        while True:
+            try:
+                batch = pickle.load(fh)
+            except EOFError:
+                break
+            for row in batch:
+                yield Statement(
+                    id=row[0],
+                    entity_id=row[1],
+                    prop=row[2],
+                    schema=row[3],
+                    value=row[4],
+                    dataset=row[5],
+                    lang=row[6],
+                    original_value=row[7],
+                    first_seen=row[8],
+                    last_seen=row[9],
+                    target=row[10],
+                    external=row[11],
+                )
+
+
+Shard = Tuple[Optional[bytes], Optional[bytes]]
+
+
+def _iter_entity_keys(view: View) -> Generator[bytes, None, None]:
+    """Yield the first entity key for each entity in the store."""
+    current_id: Optional[bytes] = None
+    with view.store.db.iterator(prefix=b"e:", include_value=False) as it:
+        for key in it:
+            _, entity_id, _ = key.split(b":", 2)
+            if entity_id != current_id:
+                current_id = entity_id
+                yield key
+
+
+def get_entity_shards(view: View, shards: int) -> List[Shard]:
+    """Split the entity keyspace of the store into contiguous key ranges with
+    roughly the same number of entities. Processing the ranges in order is
+    equivalent to iterating over `view.entities()`."""
+    total = sum(1 for _ in _iter_entity_keys(view))
+    size = max(1, math.ceil(total / max(1, shards)))
+    bounds: List[Optional[bytes]] = [None]
+    for idx, key in enumerate(_iter_entity_keys(view)):
+        if idx > 0 and idx % size == 0:
+            bounds.append(key)
+    bounds.append(None)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def iter_shard_entities(view: View, shard: Shard) -> Generator[Entity, None, None]:
+    """Iterate over the entities in the view which are within the given range of
+    entity keys."""
+    start, stop = shard
+    start = b"e:" if start is None else start
+    stop = b"e;" if stop is None else stop
+    with view.store.db.iterator(start=start, stop=stop, include_value=False) as it:
+        current_id: Optional[str] = None
+        current_match = False
+        for key in it:
+            _, entity_id, dataset = key.decode(E).split(":", 2)
+            if entity_id != current_id:
+                current_id = entity_id
+                current_match = False
+            if current_match:
+                continue
+            if dataset in view.dataset_names:
+                current_match = True
+                entity = view.get_entity(entity_id)
+                if entity is not None:
+                    yield entity
+
+
+Adjacent = List[Tuple[Property, Entity]]
+
+
+class CachedView(LevelDBView[Dataset, Entity]):
+    """A view which keeps recently assembled entities and their adjacency in a
+    bounded LRU cache. Exporters and validators which look at the neighbours of
+    the same entity during one pass over the store then share the result instead
+    of each reading and assembling the adjacent entities again."""
+
+    def __init__(
+        self,
+        store: LevelDBStore[Dataset, Entity],
+        scope: Dataset,
+        external: bool = False,
+        cache_size: int = settings.VIEW_CACHE_SIZE,
+    ) -> None:
+        super().__init__(store, scope, external=external)
+        self.cache_size = cache_size
+        self._entities: OrderedDict[str, Optional[Entity]] = OrderedDict()
+        self._adjacent: OrderedDict[Tuple[str, bool], Adjacent] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_entity(self, id: str) -> Optional[Entity]:
+        if id in self._entities:
+            self.hits += 1
+            self._entities.move_to_end(id)
+            return self._entities[id]
+        self.misses += 1
+        entity = super().get_entity(id)
+        self._entities[id] = entity
+        if len(self._entities) > self.cache_size:
+            self._entities.popitem(last=False)
+        return entity
+
+    def get_adjacent(
+        self, entity: Entity, inverted: bool = True
+    ) -> Generator[Tuple[Property, Entity], None, None]:
+        if entity.id is None:
+            yield from super().get_adjacent(entity, inverted=inverted)
+            return
+        key = (entity.id, inverted)
+        adjacent = self._adjacent.get(key)
+        if adjacent is None:
+            adjacent = list(super().get_adjacent(entity, inverted=inverted))
+            self._adjacent[key] = adjacent
+            if len(self._adjacent) > self.cache_size:
+                self._adjacent.popitem(last=False)
+        else:
+            self._adjacent.move_to_end(key)
+        yield from adjacent
+
+    def log_stats(self) -> None:
+        total = self.hits + self.misses
+        log.info(
+            "Entity cache: %d hits, %d misses" % (self.hits, self.misses),
+            dataset=self.scope.name,
+            hit_rate=self.hits / total if total else 0.0,
+            cached=len(self._entities),
+        )
+
+
+def cached_view(view: View) -> CachedView:
+    """Make a view with an entity and adjacency cache over the same store and
+    scope as the given one, to be used for a single pass over the entities."""
+    return CachedView(view.store, view.scope, external=view.external)
 
 
 def get_store(dataset: Dataset, linker: Linker[Entity]) -> "Store":
@@ -28,11 +220,37 @@ class Store(LevelDBStore[Dataset, Entity]):
         self,
         dataset: Dataset,
         linker: Linker[Entity],
+        path: Optional[Path] = None,
     ):
-        path = dataset_state_path(dataset.name) / "store"
+        if path is None:
+            path = dataset_state_path(dataset.name) / "store"
         super().__init__(dataset, linker, path)
         self.entity_class = Entity
 
+    def snapshot(self, path: Path) -> None:
+        """Make a copy of the store database at the given path, which can be opened
+        by another process. The database is closed while its files are copied, so
+        that the copy is consistent, and opened again afterwards, which invalidates
+        any iterators open on it. The table files of LevelDB are never modified, so
+        they are hard-linked rather than copied."""
+        shutil.rmtree(path, ignore_errors=True)
+        path.mkdir(parents=True)
+        self.db.close()
+        try:
+            for src in self.path.iterdir():
+                if src.name in SNAPSHOT_SKIP:
+                    continue
+                dest = path / src.name
+                if src.suffix in (".ldb", ".sst"):
+                    try:
+                        os.link(src, dest)
+                        continue
+                    except OSError:
+                        pass
+                shutil.copy2(src, dest)
+        finally:
+            self.db = plyvel.DB(self.path.as_posix(), create_if_missing=True)
+
     def view(self, scope: Dataset, external: bool = False) -> View:
         return LevelDBView(self, scope, external=external)
 
@@ -54,16 +272,57 @@ class Store(LevelDBStore[Dataset, Entity]):
             entity = simplify_undirected(entity)
         return entity
 
-    def sync(self, clear: bool = False) -> None:
-        if clear:
-            self.clear()
-        ds_key = f"dataset:{self.dataset.name}".encode("utf-8")
-        if self.db.get(ds_key):
+    def _iter_parallel_statements(
+        self, leaves: List[Dataset], workers: int
+    ) -> Generator[Statement, None, None]:
+        """Decode the leaf datasets in a pool of worker processes, while yielding
+        their statements in the same order as a sequential scan."""
+        runs_path = dataset_state_path(self.dataset.name) / "sync-runs"
+        shutil.rmtree(runs_path, ignore_errors=True)
+        runs_path.mkdir(parents=True)
+        # Forked workers inherit the dataset catalog and archive settings:
+        context = multiprocessing.get_context("fork")
+        pending: Deque[Tuple[Dataset, Path, "Future[int]"]] = deque()
+        try:
+            with ProcessPoolExecutor(workers, mp_context=context) as executor:
+                for leaf in leaves:
+                    path = runs_path / f"{leaf.name}.pickle"
+                    future = executor.submit(_dump_leaf_statements, leaf.name, path)
+                    pending.append((leaf, path, future))
+                    # Don't let the workers get too far ahead of the writer:
+                    if len(pending) > workers * 2:
+                        yield from self._load_run(*pending.popleft())
+                while len(pending):
+                    yield from self._load_run(*pending.popleft())
+        finally:
+            shutil.rmtree(runs_path, ignore_errors=True)
+
+    def _load_run(
+        self, leaf: Dataset, path: Path, future: "Future[int]"
+    ) -> Generator[Statement, None, None]:
+        count = future.result()
+        log.info(
+            "Loading leaf dataset into aggregator...",
+            scope=self.dataset.name,
+            dataset=leaf.name,
+            statements=count,
+        )
+        yield from _read_leaf_statements(path)
+        path.unlink()
+
+    def _iter_statements(
+        self, leaves: List[Dataset], workers: int
+    ) -> Generator[Statement, None, None]:
+        if workers > 1 and len(leaves) > 1:
+            yield from self._iter_parallel_statements(leaves, workers)
             return
-        log.info("Building local LevelDB aggregator...", scope=self.dataset.name)
+        for leaf in leaves:
+            yield from iter_dataset_statements(leaf, external=True)
+
+    def _load(self, leaves: List[Dataset], workers: int) -> int:
         idx = 0
         with self.writer() as writer:
-            stmts = iter_dataset_statements(self.dataset, external=True)
+            stmts = self._iter_statements(leaves, workers)
             for idx, stmt in enumerate(stmts):
                 if idx > 0 and idx % 50_000 == 0:
                     log.info(
@@ -73,12 +332,156 @@ class Store(LevelDBStore[Dataset, Entity]):
                         dataset=stmt.dataset,
                     )
                 writer.add_statement(stmt)
+        return idx
+
+    def _linker_key(self) -> str:
+        """Fingerprint the entity clusters used to derive the canonical IDs in the
+        store keys. If they change, the store must be rebuilt completely."""
+        digest = hashlib.sha1()
+        for canonical in sorted(c.id for c in self.linker.canonicals()):
+            referents = ",".join(sorted(self.linker.get_referents(canonical)))
+            digest.update(f"{canonical}:{referents}\n".encode(E))
+        return digest.hexdigest()
+
+    def _leaf_versions(self) -> Dict[str, str]:
+        """Get the statement versions of all leaf datasets. An empty string means
+        the version is unknown and the leaf is always re-loaded."""
+        versions: Dict[str, str] = {}
+        for leaf in self.dataset.leaves:
+            versions[leaf.name] = get_statements_version(leaf.name) or ""
+        return versions
+
+    def _stored_versions(self) -> Dict[str, str]:
+        versions: Dict[str, str] = {}
+        with self.db.iterator(prefix=b"version:") as it:
+            for key, value in it:
+                _, name = key.decode(E).split(":", 1)
+                versions[name] = value.decode(E)
+        return versions
+
+    def _save_versions(self, versions: Dict[str, str], removed: Set[str]) -> None:
+        batch = self.db.write_batch()
+        for name, version in versions.items():
+            batch.put(f"version:{name}".encode(E), version.encode(E))
+        for name in removed:
+            batch.delete(f"version:{name}".encode(E))
+        batch.put(f"linker:{self.dataset.name}".encode(E), self._linker_key().encode(E))
+        batch.write()
+
+    def _remove_datasets(self, names: Set[str]) -> int:
+        """Delete all statements from the given leaf datasets from the store, keeping
+        the statements other datasets have contributed to the same entities."""
+        entity_ids: Set[str] = set()
+        with self.db.iterator(prefix=b"e:", include_value=False) as it:
+            for key in it:
+                _, entity_id, dataset = key.decode(E).split(":", 2)
+                if dataset in names:
+                    entity_ids.add(entity_id)
+        batch = self.db.write_batch()
+        for idx, entity_id in enumerate(entity_ids):
+            removed_refs: Set[str] = set()
+            retained_refs: Set[str] = set()
+            for prefix, external in (("s", False), ("x", True)):
+                prefix_key = f"{prefix}:{entity_id}:".encode(E)
+                with self.db.iterator(prefix=prefix_key) as it:
+                    for key, value in it:
+                        stmt = unpack_statement(value, entity_id, external)
+                        refs = retained_refs
+                        if stmt.dataset in names:
+                            batch.delete(key)
+                            refs = removed_refs
+                        if stmt.prop_type == registry.entity.name:
+                            refs.add(self.linker.get_canonical(stmt.value))
+            for ref in removed_refs.difference(retained_refs):
+                batch.delete(f"i:{ref}:{entity_id}".encode(E))
+            for name in names:
+                batch.delete(f"e:{entity_id}:{name}".encode(E))
+            if idx > 0 and idx % REMOVE_BATCH == 0:
+                batch.write()
+                batch = self.db.write_batch()
+        for name in names:
+            batch.delete(f"ls:{name}".encode(E))
+        batch.write()
+        return len(entity_ids)
+
+    def _sync_changed(self, workers: int) -> None:
+        """Re-load only the leaf datasets whose statement version differs from the
+        one recorded when they were last loaded into the store."""
+        versions = self._leaf_versions()
+        stored = self._stored_versions()
+        changed = [
+            leaf
+            for leaf in self.dataset.leaves
+            if versions[leaf.name] == "" or stored.get(leaf.name) != versions[leaf.name]
+        ]
+        removed = set(stored.keys()).difference(versions.keys())
+        if not len(changed) and not len(removed):
+            log.info("Local LevelDB aggregator is up to date.", scope=self.dataset.name)
+            return
+        outdated = removed.union(c.name for c in changed if c.name in stored)
+        log.info(
+            "Updating local LevelDB aggregator...",
+            scope=self.dataset.name,
+            changed=[c.name for c in changed],
+            removed=sorted(removed),
+        )
+        if len(outdated):
+            entities = self._remove_datasets(outdated)
+            log.info("Removed outdated statements.", entities=entities)
+        count = self._load(changed, workers)
+        self._save_versions({c.name: versions[c.name] for c in changed}, removed)
+        self.db.compact_range()
+        log.info(
+            "Local LevelDB aggregator is ready.",
+            scope=self.dataset.name,
+            statements=count,
+        )
+
+    def sync(
+        self,
+        clear: bool = False,
+        workers: Optional[int] = None,
+        incremental: bool = False,
+    ) -> None:
+        """Load the statements of all leaf datasets into the store.
+
+        Args:
+            clear: Delete the existing store contents before loading.
+            workers: Number of processes decoding leaf datasets in parallel, defaults
+                to `ZAVOD_STORE_SYNC_WORKERS`. The store is always written by the
+                current process.
+            incremental: If the store has been built before, only re-load the leaf
+                datasets whose statement version has changed since.
+        """
+        if clear:
+            self.clear()
+        workers = settings.STORE_SYNC_WORKERS if workers is None else workers
+        ds_key = f"dataset:{self.dataset.name}".encode(E)
+        if self.db.get(ds_key):
+            if not incremental:
+                return
+            linker_key = self.db.get(f"linker:{self.dataset.name}".encode(E))
+            if linker_key is not None and linker_key.decode(E) == self._linker_key():
+                self._sync_changed(workers)
+                return
+            log.info("Entity clusters have changed, rebuilding aggregator...")
+            self.clear()
+
+        log.info(
+            "Building local LevelDB aggregator...",
+            scope=self.dataset.name,
+            workers=workers,
+        )
+        versions = self._leaf_versions() if incremental else {}
+        count = self._load(list(self.dataset.leaves), workers)
+        if incremental:
+            self._save_versions(versions, set())
         self.db.put(ds_key, b"1")
         self.db.compact_range()
         log.info(
             "Local LevelDB aggregator is ready.",
             scope=self.dataset.name,
-            statements=idx,
+            statements=count,
         )
 
     def clear(self) -> None:
@@ -207,3 +207,49 @@ def test_limit(vcontext: Context):
     assert len(results) == 0, results
 
     shutil.rmtree(settings.DATA_PATH, ignore_errors=True)
+
+
+def test_parallel_scoring(vcontext: Context):
+    """Scoring candidates in worker processes gives the same matches"""
+    crawl_dataset(vcontext.dataset)
+    results = {}
+    for workers in (1, 2):
+        dataset_data = deepcopy(DATASET_DATA)
+        dataset_data["config"]["score_workers"] = workers
+        enricher = load_enricher(vcontext, dataset_data, "testdataset1")
+        subjects = [
+            CompositeEntity.from_data(vcontext.dataset, UMBRELLA_CORP),
+            CompositeEntity.from_data(vcontext.dataset, JON_DOVER),
+        ]
+        for subject in subjects:
+            enricher.load(subject)
+        by_id = {s.id: s for s in subjects}
+        candidates = [(by_id[i.id], c) for i, c in enricher.candidates()]
+        results[workers] = [
+            (subject.id, [m.id for m in matches])
+            for subject, matches in enricher.match_many(candidates)
+        ]
+        enricher.close()
+    assert results[1] == results[2]
+    assert any(len(matches) for _, matches in results[1]), results[1]
+
+    shutil.rmtree(settings.DATA_PATH, ignore_errors=True)
+
+
+def test_match_online(vcontext: Context):
+    """Single entity lookups give the same matches as the batch process"""
+    crawl_dataset(vcontext.dataset)
+    enricher = load_enricher(vcontext, DATASET_DATA, "testdataset1")
+    subject = CompositeEntity.from_data(vcontext.dataset, UMBRELLA_CORP)
+    online = [m.id for m in enricher.match(subject)]
+    assert online, online
+    # Lookups don't consume the index:
+    assert [m.id for m in enricher.match(subject)] == online
+
+    enricher.load(subject)
+    candidates = [(subject, c) for _, c in enricher.candidates()]
+    batch = [m.id for _, matches in enricher.match_many(candidates) for m in matches]
+    assert batch == online
+    enricher.close()
+
+    shutil.rmtree(settings.DATA_PATH, ignore_errors=True)
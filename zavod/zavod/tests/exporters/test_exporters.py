@@ -7,11 +7,15 @@ from nomenklatura.stream import StreamEntity
 from nomenklatura.statement import Statement, CSV
 from nomenklatura.statement.serialize import read_path_statements
 from datetime import datetime
+from typing import Dict, List
 
 from zavod import settings
 from zavod.store import get_store
 from zavod.integration import get_resolver
-from zavod.exporters import export_dataset
+from zavod.context import Context
+from zavod.entity import Entity
+from zavod.exporters import export_dataset, export_data, EXPORTERS
+from zavod.exporters.common import Exporter
 from zavod.archive import clear_data_path, DATASETS
 from zavod.exporters.ftm import FtMExporter
 from zavod.exporters.names import NamesExporter
@@ -98,6 +102,78 @@ def test_export(testdataset1: Dataset):
         assert "Oswell E. Spencer" in {t["name"] for t in targets}
 
 
+def test_sharded_export(testdataset1: Dataset):
+    dataset_path = settings.DATA_PATH / DATASETS / testdataset1.name
+    clear_data_path(testdataset1.name)
+    crawl_dataset(testdataset1)
+    store = get_store(testdataset1, get_resolver())
+    store.sync(clear=True)
+    view = store.view(testdataset1)
+    sharded = default_exports - {"source.csv"}
+
+    outputs = {}
+    for workers in (1, 3):
+        context = Context(testdataset1)
+        context.begin(clear=True)
+        export_data(context, view, workers=workers)
+        context.close()
+        for name in sharded:
+            with open(dataset_path / name, "rb") as fh:
+                outputs[(workers, name)] = fh.read()
+    for name in sharded:
+        assert len(outputs[(1, name)]) > 0, name
+        assert outputs[(1, name)] == outputs[(3, name)], name
+    assert not list(dataset_path.glob("*.part"))
+    # The store snapshots read by the workers are removed again:
+    assert not list(dataset_path.glob("_state/export-store.*"))
+    store.close()
+
+
+class CountingExporter(Exporter):
+    FILE_NAME = "counted.txt"
+    PARALLEL = True
+    merged_counts: List[Dict[str, int]] = []
+
+    def setup(self) -> None:
+        self.fh = open(self.path, "w")
+        self.count = 0
+
+    def feed(self, entity: Entity) -> None:
+        self.fh.write(f"{entity.id}\n")
+        self.count += 1
+
+    def get_counts(self) -> Dict[str, int]:
+        return {"entities": self.count}
+
+    def merged(self, counts: List[Dict[str, int]]) -> None:
+        self.merged_counts.extend(counts)
+        super().merged(counts)
+
+    def finish(self) -> None:
+        self.fh.close()
+        super().finish()
+
+
+def test_sharded_export_counts(testdataset1: Dataset, monkeypatch):
+    clear_data_path(testdataset1.name)
+    crawl_dataset(testdataset1)
+    monkeypatch.setitem(EXPORTERS, CountingExporter.FILE_NAME, CountingExporter)
+    monkeypatch.setattr(testdataset1, "exports", {CountingExporter.FILE_NAME})
+    store = get_store(testdataset1, get_resolver())
+    store.sync(clear=True)
+    view = store.view(testdataset1)
+    context = Context(testdataset1)
+    context.begin(clear=True)
+    export_data(context, view, workers=3)
+    context.close()
+
+    # The merged exporter is passed the counts reported by each shard:
+    total = len(list(view.entities()))
+    assert len(CountingExporter.merged_counts) == 3
+    assert sum(c["entities"] for c in CountingExporter.merged_counts) == total
+    store.close()
+
+
 def test_minimal_export_config(testdataset2: Dataset):
     """Test export when dataset.exporters is empty list"""
     dataset_path = settings.DATA_PATH / "datasets" / testdataset2.name
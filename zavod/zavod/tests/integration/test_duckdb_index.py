@@ -1,10 +1,14 @@
+import time
 from pathlib import Path
 from tempfile import mkdtemp
 
 from normality import slugify
 from nomenklatura import CompositeEntity
+from nomenklatura.judgement import Judgement
+from nomenklatura.resolver import Identifier
 
 from zavod.entity import Entity
+from zavod.integration import duckdb_index
 from zavod.integration.duckdb_index import DuckDBIndex
 from zavod.crawl import crawl_dataset
 from zavod.integration import get_resolver
@@ -55,6 +59,114 @@ def test_pairs(testdataset_dedupe: Dataset):
     assert bond == 2.0, bond
 
 
+def test_partitioned_pairs(testdataset_dedupe: Dataset):
+    crawl_dataset(testdataset_dedupe)
+    resolver = get_resolver()
+    store = get_store(testdataset_dedupe, resolver)
+    store.sync(clear=True)
+    view = store.view(testdataset_dedupe)
+    index = DuckDBIndex(view, Path(mkdtemp()).resolve(), {"memory_budget": 1000})
+    assert index.threads == 1
+    assert index.memory_limit == 1000
+    index.build()
+    pairs = list(index.pairs())
+    assert len(pairs) > 3
+    index.close()
+
+    options = {"pair_partitions": 3, "threads": 2}
+    index = DuckDBIndex(view, Path(mkdtemp()).resolve(), options)
+    index.build()
+    assert list(index.pairs()) == pairs
+    assert list(index.pairs(max_pairs=3)) == pairs[:3]
+    index.close()
+    store.close()
+
+
+def test_batched_insert(testdataset_dedupe: Dataset, monkeypatch):
+    crawl_dataset(testdataset_dedupe)
+    resolver = get_resolver()
+    store = get_store(testdataset_dedupe, resolver)
+    store.sync(clear=True)
+    view = store.view(testdataset_dedupe)
+    index = DuckDBIndex(view, Path(mkdtemp()).resolve())
+    index.build()
+    pairs = list(index.pairs())
+    index.close()
+
+    monkeypatch.setattr(duckdb_index, "INSERT_BATCH_SIZE", 3)
+    index = DuckDBIndex(view, Path(mkdtemp()).resolve())
+    index.build()
+    assert list(index.pairs()) == pairs
+    index.add_matching_subject(CompositeEntity.from_data(testdataset_dedupe, JOHN))
+    matches = dict(index.matches())
+    assert len(matches[Identifier.get("id-john")]) == 5
+    index.close()
+    store.close()
+
+
+def test_reuse_index(testdataset_dedupe: Dataset, monkeypatch):
+    crawl_dataset(testdataset_dedupe)
+    data_dir = Path(mkdtemp()).resolve()
+    resolver = get_resolver()
+    store = get_store(testdataset_dedupe, resolver)
+    store.sync(clear=True)
+    view = store.view(testdataset_dedupe)
+
+    index = DuckDBIndex(view, data_dir)
+    index.build()
+    pairs = list(index.pairs())
+    index.close()
+
+    # Nothing changed, the index is re-used as is, also after a new crawl of the
+    # same data:
+    crawl_dataset(testdataset_dedupe)
+    store.sync(clear=True)
+    loaded = []
+    load_entries = DuckDBIndex._load_entries
+
+    def record_entries(self, entities):
+        entities = list(entities)
+        loaded.extend(entities)
+        load_entries(self, entities)
+
+    monkeypatch.setattr(DuckDBIndex, "_load_entries", record_entries)
+    index = DuckDBIndex(view, data_dir)
+    index.build()
+    assert loaded == []
+    assert list(index.pairs()) == pairs
+    index.close()
+
+    # Merging two entities only re-indexes those:
+    monkeypatch.setattr(duckdb_index, "REBUILD_RATIO", 1.0)
+    left, right = "matching-john-smith-us", "matching-john-smith-uk"
+    canonical_id = resolver.decide(left, right, Judgement.POSITIVE)
+    store.update(canonical_id)
+    index = DuckDBIndex(view, data_dir)
+    index.build()
+    updated = list(index.pairs())
+    index_ids = {r[0] for r in index.con.execute("SELECT id FROM entries").fetchall()}
+    assert canonical_id.id in index_ids
+    assert left not in index_ids
+    assert [e.id for e in loaded] == [canonical_id.id]
+    index.close()
+
+    fresh = DuckDBIndex(view, Path(mkdtemp()).resolve())
+    fresh.build()
+    assert sorted(updated) == sorted(fresh.pairs())
+
+    # With many changes, all entities are re-loaded instead:
+    monkeypatch.setattr(duckdb_index, "REBUILD_RATIO", 0.0)
+    resolver.explode(canonical_id)
+    store.sync(clear=True)
+    loaded.clear()
+    index = DuckDBIndex(view, data_dir)
+    index.build()
+    assert len(loaded) > 3
+    assert list(index.pairs()) == pairs
+    index.close()
+    store.close()
+
+
 def test_match(testdataset1: Dataset, testdataset_dedupe: Dataset):
     crawl_dataset(testdataset_dedupe)
     data_dir = Path(mkdtemp()).resolve()
@@ -89,6 +201,72 @@ def test_match(testdataset1: Dataset, testdataset_dedupe: Dataset):
     assert john_matches[1][0] == "matching-john-smith-uk", john_matches[1]
     assert john_matches[0][1] > john_matches[1][1], john_matches[1]
 
+    # Single entity lookups give the same candidates, also after the batch:
+    online = [(match.id, score) for match, score in index.match(john)]
+    assert online == john_matches
+    assert [m.id for m, _ in index.match(bond)] == ["matching-james-bond-uk-007"]
+    nobody = dict(JOHN, properties={"name": ["Xyzzy Quux"]})
+    assert index.match(CompositeEntity.from_data(testdataset1, nobody)) == []
+
+
+def test_match_latency(testdataset1: Dataset, testdataset_dedupe: Dataset):
+    crawl_dataset(testdataset_dedupe)
+    resolver = get_resolver()
+    store = get_store(testdataset_dedupe, resolver)
+    store.sync(clear=True)
+    view = store.view(testdataset_dedupe)
+    index = DuckDBIndex(view, Path(mkdtemp()).resolve())
+    index.build()
+    john = CompositeEntity.from_data(testdataset1, JOHN)
+    expected = index.match(john)
+
+    # Pad the index with a million synthetic token rows:
+    synthetic_query = """
+        INSERT INTO entries
+        SELECT 'synthetic-' || (i // 10), 'word', 'tok' || (i % 200000)
+        FROM range(1000000) t(i)
+    """
+    index.con.execute(synthetic_query)
+    for table in ("stopwords", "field_len", "mentions", "term_frequencies"):
+        index.con.execute(f"DROP TABLE {table}")
+    index._build_frequencies()
+    count = index.con.execute("SELECT count(*) FROM term_frequencies").fetchone()
+    assert count is not None and count[0] > 500_000
+
+    assert index.match(john) == expected
+    start = time.monotonic()
+    for _ in range(10):
+        index.match(john)
+    assert (time.monotonic() - start) / 10 < 0.1
+    index.close()
+    store.close()
+
+
+def test_max_candidates(testdataset1: Dataset, testdataset_dedupe: Dataset):
+    crawl_dataset(testdataset_dedupe)
+    resolver = get_resolver()
+    store = get_store(testdataset_dedupe, resolver)
+    store.sync(clear=True)
+    view = store.view(testdataset_dedupe)
+
+    index = DuckDBIndex(view, Path(mkdtemp()).resolve(), {"max_candidates": 2})
+    index.build()
+    # Both subjects sort before their candidates, so the limit must apply to each
+    # of them, not just the last one:
+    for idx in range(3):
+        data = dict(JOHN, id=f"id-john-{idx}")
+        index.add_matching_subject(CompositeEntity.from_data(testdataset1, data))
+    entity_matches = {}
+    for entity_id, matches in index.matches():
+        entity_matches[entity_id.id] = [(match.id, score) for match, score in matches]
+    assert len(entity_matches) == 3, entity_matches
+    for matches in entity_matches.values():
+        assert len(matches) == 2, matches
+        assert matches[0][0] == "matching-john-smith-us", matches
+        assert matches[0][1] >= matches[1][1], matches
+    index.close()
+    store.close()
+
 
 def test_stopwords(testdataset1: Dataset):
     def e(name: str) -> Entity:
@@ -149,3 +327,20 @@ def test_stopwords(testdataset1: Dataset):
 
     assert len(entity_matches[too_common_first_name.id]) == 3
     assert len(entity_matches[matching_last_name.id]) == 1
+
+
+def test_cgroup_memory_limit(monkeypatch, tmp_path: Path):
+    unlimited = tmp_path / "memory.max"
+    unlimited.write_text("max\n")
+    monkeypatch.setattr(duckdb_index, "CGROUP_MEMORY_LIMITS", (unlimited,))
+    assert duckdb_index.cgroup_memory_limit() is None
+
+    limited = tmp_path / "memory.limit_in_bytes"
+    limited.write_text(f"{1000 * duckdb_index.MB}\n")
+    limits = (tmp_path / "missing", limited)
+    monkeypatch.setattr(duckdb_index, "CGROUP_MEMORY_LIMITS", limits)
+    assert duckdb_index.cgroup_memory_limit() == 1000 * duckdb_index.MB
+    assert duckdb_index.available_memory() <= 1000 * duckdb_index.MB
+    threads, memory_limit = duckdb_index.plan_resources(None)
+    assert threads == 1
+    assert memory_limit == 800
@@ -0,0 +1,88 @@
+from pathlib import Path
+from tempfile import mkdtemp
+
+from pytest import approx
+from nomenklatura import CompositeEntity
+
+import zavod.integration.numpy_index
+from zavod.crawl import crawl_dataset
+from zavod.integration import get_resolver
+from zavod.integration.duckdb_index import DuckDBIndex
+from zavod.integration.numpy_index import NumpyIndex
+from zavod.meta.dataset import Dataset
+from zavod.store import get_store
+
+BOND = {
+    "schema": "Person",
+    "id": "id-bond",
+    "properties": {"name": ["Secret McSecretface"], "idNumber": ["007"]},
+}
+JOHN = {
+    "schema": "Person",
+    "id": "id-john",
+    "properties": {"name": ["John Smith"], "country": ["US"]},
+}
+
+
+def _flatten(pairs):
+    return [((left.id, right.id), approx(score)) for (left, right), score in pairs]
+
+
+def _candidates(matches):
+    return [(match.id, approx(score)) for match, score in matches]
+
+
+def test_numpy_index(testdataset1: Dataset, testdataset_dedupe: Dataset, monkeypatch):
+    crawl_dataset(testdataset_dedupe)
+    resolver = get_resolver()
+    store = get_store(testdataset_dedupe, resolver)
+    store.sync(clear=True)
+    view = store.view(testdataset_dedupe)
+
+    duckdb = DuckDBIndex(view, Path(mkdtemp()).resolve())
+    duckdb.build()
+    index = NumpyIndex(view, Path(mkdtemp()).resolve())
+    index.build()
+    assert (index.data_dir / "tfs.npy").exists()
+
+    # Same pairs, scores and order as the DuckDB index:
+    expected = list(duckdb.pairs())
+    assert len(expected) > 3
+    assert _flatten(index.pairs()) == _flatten(expected)
+    assert _flatten(index.pairs(max_pairs=3)) == _flatten(expected[:3])
+    # Pairs are generated and summed up in small partitions just the same:
+    monkeypatch.setattr(zavod.integration.numpy_index, "PAIR_CHUNK", 2)
+    assert _flatten(index.pairs()) == _flatten(expected)
+    assert _flatten(index.pairs(max_pairs=3)) == _flatten(expected[:3])
+
+    for data in (BOND, JOHN):
+        entity = CompositeEntity.from_data(testdataset1, data)
+        duckdb.add_matching_subject(entity)
+        index.add_matching_subject(entity)
+    expected_matches = list(duckdb.matches())
+    matches = list(index.matches())
+    assert len(matches) == 2
+    assert [e.id for e, _ in matches] == [e.id for e, _ in expected_matches]
+    for (_, found), (_, wanted) in zip(matches, expected_matches):
+        assert _candidates(found) == _candidates(wanted)
+
+    john = CompositeEntity.from_data(testdataset1, JOHN)
+    assert index.match(john) == matches[1][1]
+    unknown = dict(JOHN, properties={"name": ["Xyzzy Quux"]})
+    assert index.match(CompositeEntity.from_data(testdataset1, unknown)) == []
+    duckdb.close()
+    index.close()
+
+    # The arrays are re-opened rather than rebuilt for the same contents:
+    tfs_path = index.data_dir / "tfs.npy"
+    built = tfs_path.stat().st_mtime_ns
+    reopened = NumpyIndex(view, index.data_dir.parent)
+    reopened.build()
+    assert tfs_path.stat().st_mtime_ns == built
+    assert reopened.match(john) == matches[1][1]
+    reopened.close()
+    reopened = NumpyIndex(view, index.data_dir.parent, {"stopwords_pct": 2})
+    reopened.build()
+    assert tfs_path.stat().st_mtime_ns != built
+    reopened.close()
+    store.close()
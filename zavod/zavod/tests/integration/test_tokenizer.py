@@ -0,0 +1,38 @@
+from nomenklatura import CompositeEntity
+
+from zavod.integration import tokenizer
+from zavod.integration.tokenizer import tokenize_entity, tokenize_entities
+from zavod.meta.dataset import Dataset
+
+JOHN = {
+    "schema": "Person",
+    "id": "id-john",
+    "properties": {
+        "name": ["John Smith"],
+        "country": ["US"],
+        "birthDate": ["1980-01-02"],
+        "idNumber": ["AB-1234"],
+    },
+}
+
+
+def test_tokenize_entities(testdataset1: Dataset):
+    john = CompositeEntity.from_data(testdataset1, JOHN)
+    tokens = set(tokenize_entity(john))
+    assert ("wd", "john") in tokens, tokens
+    assert ("name", "john smith") in tokens, tokens
+    assert ("country", "us") in tokens, tokens
+    assert ("date", "1980") in tokens, tokens
+    assert ("identifier", "AB1234") in tokens, tokens
+
+    other = CompositeEntity.from_data(testdataset1, dict(JOHN, id="id-other"))
+    before = tokenizer._value_tokens.cache_info()
+    batch = list(tokenize_entities([john, other]))
+    assert [e.id for e, _ in batch] == ["id-john", "id-other"]
+    for _, entity_tokens in batch:
+        assert set(entity_tokens) == tokens
+    # Both entities have the same values, so all are tokenized from the cache:
+    after = tokenizer._value_tokens.cache_info()
+    assert after.misses == before.misses
+    assert after.hits > before.hits
+    tokenizer.log_cache_stats()
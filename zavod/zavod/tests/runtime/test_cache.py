@@ -0,0 +1,128 @@
+from datetime import timedelta
+from nomenklatura.cache import Cache
+from rigour.time import naive_now
+from sqlalchemy import select, update
+
+import zavod.runtime.cache
+from zavod import settings
+from zavod.meta import Dataset
+from zavod.archive import dataset_state_path
+from zavod.runtime.cache import BLOB_PREFIX, TieredCache, get_engine, get_metadata
+
+
+def _make_cache(dataset: Dataset, max_memory: int) -> TieredCache:
+    cache_path = dataset_state_path(dataset.name) / "tiered.sqlite3"
+    uri = f"sqlite:///{cache_path.as_posix()}"
+    engine = get_engine(uri)
+    metadata = get_metadata(uri)
+    return TieredCache(engine, metadata, dataset, max_memory, create=True)
+
+
+def test_tiered_cache(testdataset1: Dataset):
+    cache = _make_cache(testdataset1, max_memory=1000)
+    assert cache.get("missing", max_age=7) is None
+    assert cache.misses == 1
+    # The absent key is remembered, too:
+    assert cache.get("missing", max_age=7) is None
+    assert cache.hits == 1
+
+    cache.set("missing", "now present")
+    cache.set("foo", "bar")
+    assert cache.get("foo", max_age=7) == "bar"
+    assert cache.get("missing") == "now present"
+    assert cache.hits == 3
+    assert cache.get("foo", max_age=0) is None
+
+    # Entries are only written to the database when the cache is flushed:
+    assert cache.writes == 0
+    other = Cache(cache._engine, cache._table.metadata, testdataset1)
+    assert other.get("foo") is None
+    other.close()
+    cache.flush()
+    assert cache.writes == 2
+    other = Cache(cache._engine, cache._table.metadata, testdataset1)
+    assert other.get("foo") == "bar"
+    other.close()
+
+    cache.delete("foo")
+    assert cache.get("foo") is None
+
+    # Old entries are evicted from memory, but still in the database:
+    for i in range(20):
+        cache.set(f"key{i}", "x" * 100)
+    assert cache.evictions > 0
+    assert cache._memory_size <= cache.max_memory
+    assert cache.get("key0") == "x" * 100
+    cache.flush()
+    misses = cache.misses
+    assert cache.get("key1") == "x" * 100
+    assert cache.misses == misses + 1
+    assert len(list(cache.all("key%"))) == 20
+    cache.close()
+
+
+def test_cache_storage(testdataset1: Dataset, monkeypatch):
+    cache = _make_cache(testdataset1, max_memory=100_000)
+    page = "<html>%s</html>" % ("Hello, World! " * 200)
+    cache.set("page1", page)
+    cache.set("page2", page)
+    cache.set("short", "tiny")
+    cache.flush()
+
+    # Identical content is stored once, and compressed:
+    blobs = list(cache.conn.execute(select(cache._blobs)))
+    assert len(blobs) == 1
+    assert len(blobs[0].data) < len(page) / 10
+    rows = {r.key: r.text for r in cache.conn.execute(select(cache._table))}
+    assert rows["page1"] == rows["page2"]
+    assert rows["page1"].startswith(BLOB_PREFIX)
+    assert rows["short"] == "tiny"
+
+    # Read back from the database rather than from memory:
+    cache._memory.clear()
+    assert cache.get("page1") == page
+    assert cache.get("short") == "tiny"
+    assert {v.key: v.text for v in cache.all("page%")}["page2"] == page
+
+    # Expired entries are vacuumed, and unreferenced content is swept:
+    monkeypatch.setattr(settings, "CACHE_MAX_AGE", 30)
+    old = naive_now() - timedelta(days=31)
+    table = cache._table
+    for key in ("page1", "page2"):
+        stmt = update(table).where(table.c.key == key).values(timestamp=old)
+        cache.conn.execute(stmt)
+    cache.vacuum()
+    assert len(list(cache.conn.execute(select(cache._blobs)))) == 1
+    cache.sweep_blobs()
+    assert len(list(cache.conn.execute(select(cache._blobs)))) == 0
+    assert len(list(cache.conn.execute(select(cache._refs)))) == 0
+    cache._memory.clear()
+    assert cache.get("page1") is None
+    assert cache.get("short") == "tiny"
+    cache.close()
+
+
+def test_cache_dictionary(testdataset1: Dataset, monkeypatch):
+    monkeypatch.setattr(settings, "CACHE_DICTIONARY", True)
+    monkeypatch.setattr(zavod.runtime.cache, "DICT_SAMPLES", 200)
+    cache = _make_cache(testdataset1, max_memory=100_000)
+    pages = {}
+    for i in range(300):
+        pages[f"page{i}"] = "<html><body><h1>Entity %d</h1>%s</body></html>" % (
+            i,
+            " ".join(f"<p>row {j} of {i}</p>" for j in range(i % 50 + 30)),
+        )
+    for key, page in pages.items():
+        cache.set(key, page)
+    cache.flush()
+    assert cache._dict_id is not None
+    dicts = list(cache.conn.execute(select(cache._dicts)))
+    assert len(dicts) == 1
+    assert dicts[0].dataset == testdataset1.name
+
+    # A new cache object finds the dictionary to decompress the content:
+    cache.close()
+    cache = _make_cache(testdataset1, max_memory=100_000)
+    assert cache.get("page299") == pages["page299"]
+    assert cache.get("page0") == pages["page0"]
+    cache.close()
@@ -5,7 +5,8 @@ from rigour.time import utc_now
 from zavod import settings
 from zavod.meta import Dataset
 from zavod.crawl import crawl_dataset
-from zavod.archive import iter_dataset_statements
+from zavod.archive import iter_dataset_statements, TIMESTAMPS_FILE
+from zavod.runtime import timestamps
 from zavod.runtime.timestamps import TimeStampIndex
 
 
@@ -34,6 +35,26 @@ def test_timestamps(testdataset1: Dataset):
     assert "TimeStampIndex" in repr(index), repr(index)
 
 
+def test_timestamp_runs(testdataset1: Dataset, monkeypatch):
+    crawl_dataset(testdataset1)
+    stmts = list(iter_dataset_statements(testdataset1, external=False))
+    index = TimeStampIndex(dataset=testdataset1)
+    index.index(stmts)
+    expected = index.path.read_bytes()
+    index.close()
+
+    # Sorted runs flushed to disk merge into the same index file:
+    monkeypatch.setattr(timestamps, "RUN_SIZE", 3)
+    monkeypatch.setattr(timestamps, "MERGE_CHUNK", 2)
+    index.index(stmts)
+    assert index.path.read_bytes() == expected
+    assert not index.path.with_name(f"{index.path.name}.runs").exists()
+    for stmt in stmts:
+        assert stmt.entity_id is not None
+        assert index.get(stmt.entity_id).get(stmt.id) == stmt.first_seen
+    index.close()
+
+
 def test_backfill(testdataset1: Dataset):
     prev_time = settings.RUN_TIME_ISO
     crawl_dataset(testdataset1)
@@ -60,3 +81,30 @@ def test_backfill(testdataset1: Dataset):
             continue
         assert stamps.get(stmt.id, second_time) != ""
         assert stamps.get(stmt.id, second_time) == prev_time
+
+
+def test_published_timestamps(testdataset1: Dataset, monkeypatch):
+    prev_time = settings.RUN_TIME_ISO
+    crawl_dataset(testdataset1)
+    data_path = settings.DATA_PATH / "datasets" / testdataset1.name
+    assert (data_path / TIMESTAMPS_FILE).is_file()
+
+    archive_path = settings.ARCHIVE_PATH / "datasets/latest" / testdataset1.name
+    archive_path.mkdir(parents=True, exist_ok=True)
+    for name in ("statements.pack", TIMESTAMPS_FILE):
+        copyfile(data_path / name, archive_path / name)
+
+    # The published index is used as-is, rather than rebuilt from statements:
+    def fail(*args, **kwargs):
+        raise AssertionError("Statements should not be read")
+
+    monkeypatch.setattr(timestamps, "iter_previous_statements", fail)
+    index = TimeStampIndex.build(dataset=testdataset1)
+    assert index.path.read_bytes() == (data_path / TIMESTAMPS_FILE).read_bytes()
+    stmts = list(iter_dataset_statements(testdataset1, external=False))
+    for stmt in stmts:
+        assert stmt.entity_id is not None
+        stamps = index.get(stmt.entity_id)
+        assert stamps.get(stmt.id) == prev_time
+    assert len(index.get("no-such-entity")) == 0
+    index.close()
@@ -1,12 +1,32 @@
+import os
+import json
+import time
 import shutil
+import pytest
+import threading
+from typing import List
+from nomenklatura.statement import Statement
+from nomenklatura.versions import Version
+from nomenklatura.statement.serialize import PackStatementWriter
 
 from zavod import settings
 from zavod.meta import Dataset
+from zavod.crawl import crawl_dataset
 from zavod.runtime.versions import make_version
 from zavod.archive import get_dataset_artifact, publish_resource, publish_artifact
 from zavod.archive import clear_data_path, dataset_data_path, dataset_resource_path
 from zavod.archive import publish_dataset_version, get_archive_backend
 from zavod.archive import DATASETS, ARTIFACTS, VERSIONS_FILE
+from zavod.archive import STATEMENTS_FILE, STATEMENTS_COLUMNAR_FILE
+from zavod.archive import iter_dataset_statements, _read_fh_statements
+from zavod.archive import iter_previous_statements
+from zavod.archive.backend import FileSystemBackend, FileSystemObject
+from zavod.archive.backend import md5_checksum
+from zavod.archive.cache import get_artifact_cache, _locked, LOCK_SUFFIX
+from zavod.archive.columnar import read_columnar_rows, read_columnar_statements
+from zavod.archive.columnar import write_columnar_statements
+from zavod.archive.compression import GZIP, ZSTD
+from zavod.archive.compression import get_file_compression, open_text_file
 
 
 def test_archive_publish(testdataset1: Dataset):
@@ -65,3 +85,315 @@ def test_artifact_backfill(testdataset1: Dataset):
     assert versions_file.exists()
     local_path = get_dataset_artifact(testdataset1.name, name)
     assert local_path.exists()
+
+
+def test_columnar_statements(testdataset1: Dataset):
+    settings.STATEMENTS_COLUMNAR = True
+    try:
+        crawl_dataset(testdataset1)
+    finally:
+        settings.STATEMENTS_COLUMNAR = False
+    pack_path = dataset_resource_path(testdataset1.name, STATEMENTS_FILE)
+    columnar_path = dataset_resource_path(testdataset1.name, STATEMENTS_COLUMNAR_FILE)
+    assert columnar_path.exists()
+    with open(pack_path, "r") as fh:
+        packed = {s.id: s for s in _read_fh_statements(fh, True)}
+    columnar = {s.id: s for s in read_columnar_statements(columnar_path)}
+    assert len(packed) > 5
+    assert packed.keys() == columnar.keys()
+    for stmt_id, stmt in packed.items():
+        assert stmt.to_dict() == columnar[stmt_id].to_dict()
+    stmts = list(iter_dataset_statements(testdataset1))
+    assert len(stmts) == len(packed)
+
+    rows = list(read_columnar_rows(columnar_path, ["entity_id", "prop"]))
+    assert len(rows) == len(packed)
+    assert all(len(row) == 2 for row in rows)
+    with pytest.raises(ValueError):
+        list(read_columnar_rows(columnar_path, ["foo"]))
+
+
+def test_columnar_previous_statements(testdataset1: Dataset, monkeypatch):
+    settings.STATEMENTS_COLUMNAR = True
+    try:
+        crawl_dataset(testdataset1)
+    finally:
+        settings.STATEMENTS_COLUMNAR = False
+    plain = {s.id: s.to_dict() for s in iter_dataset_statements(testdataset1)}
+    versions = ["20240101000000-aaa", "20240102000000-bbb"]
+    for version in versions:
+        for name in (STATEMENTS_FILE, STATEMENTS_COLUMNAR_FILE):
+            path = dataset_resource_path(testdataset1.name, name)
+            publish_artifact(
+                path, testdataset1.name, Version.from_string(version), name
+            )
+
+    backfills: List[str] = []
+    backfill = FileSystemObject.backfill
+
+    def counted_backfill(self: FileSystemObject, dest) -> None:
+        backfills.append(self.name)
+        backfill(self, dest)
+
+    monkeypatch.setattr(FileSystemObject, "backfill", counted_backfill)
+
+    # Reading two versions at once keeps a separate local copy of each:
+    first = iter_previous_statements(testdataset1, version=versions[0])
+    first_stmt = next(first)
+    second = {
+        s.id: s.to_dict()
+        for s in iter_previous_statements(testdataset1, version=versions[1])
+    }
+    first_stmts = {first_stmt.id: first_stmt.to_dict()}
+    first_stmts.update({s.id: s.to_dict() for s in first})
+    assert first_stmts == plain
+    assert second == plain
+    assert len(backfills) == 2
+
+    # The local copy of a version is re-used by the next read:
+    again = list(iter_previous_statements(testdataset1, version=versions[1]))
+    assert len(again) == len(plain)
+    assert len(backfills) == 2
+
+
+def test_columnar_empty_values(tmp_path):
+    data_path = tmp_path / "it's"
+    data_path.mkdir()
+    pack_path = data_path / STATEMENTS_FILE
+    stmt = Statement(
+        entity_id="a",
+        prop="name",
+        schema="Person",
+        value="",
+        dataset="test",
+        first_seen="",
+        last_seen="",
+    )
+    with open(pack_path, "w") as fh:
+        writer = PackStatementWriter(fh)
+        writer.write(stmt)
+        writer.close()
+    columnar_path = data_path / STATEMENTS_COLUMNAR_FILE
+    write_columnar_statements(pack_path, columnar_path)
+    (read,) = read_columnar_statements(columnar_path)
+    assert read.to_dict() == stmt.to_dict()
+    assert read.value == ""
+    assert read.lang is None
+
+
+@pytest.mark.parametrize("compression", [GZIP, ZSTD])
+def test_compressed_statements(testdataset1: Dataset, compression: str):
+    crawl_dataset(testdataset1)
+    plain = {s.id: s.to_dict() for s in iter_dataset_statements(testdataset1)}
+    settings.STATEMENTS_COMPRESSION = compression
+    settings.STATEMENTS_COLUMNAR = True
+    try:
+        crawl_dataset(testdataset1)
+    finally:
+        settings.STATEMENTS_COMPRESSION = None
+        settings.STATEMENTS_COLUMNAR = False
+    pack_path = dataset_resource_path(testdataset1.name, STATEMENTS_FILE)
+    assert get_file_compression(pack_path) == compression
+    columnar_path = dataset_resource_path(testdataset1.name, STATEMENTS_COLUMNAR_FILE)
+    columnar = {s.id: s.to_dict() for s in read_columnar_statements(columnar_path)}
+    assert columnar == plain
+    columnar_path.unlink()
+    local = {s.id: s.to_dict() for s in iter_dataset_statements(testdataset1)}
+    assert local == plain
+
+    # Statements streamed from the archive are decompressed on the fly:
+    publish_artifact(
+        pack_path, testdataset1.name, settings.RUN_VERSION, STATEMENTS_FILE
+    )
+    make_version(testdataset1, settings.RUN_VERSION)
+    publish_dataset_version(testdataset1.name)
+    stream = {s.id: s.to_dict() for s in iter_previous_statements(testdataset1)}
+    assert stream == plain
+
+    # Closing a reader early stops the decompression thread:
+    with open_text_file(pack_path) as fh:
+        assert len(fh.readline())
+
+
+class SlowObject(FileSystemObject):
+    """A file system object with the latency of a remote store, which counts the
+    range reads in flight."""
+
+    def __init__(self, name: str, latency: float = 0.02, fail_at: int = -1):
+        super().__init__(FileSystemBackend(), name)
+        self.latency = latency
+        self.fail_at = fail_at
+        self.lock = threading.Lock()
+        self.ranges: List[int] = []
+        self.active = 0
+        self.max_active = 0
+
+    def read_range(self, start: int, end: int) -> bytes:
+        if start == self.fail_at:
+            raise IOError("Connection reset")
+        with self.lock:
+            self.ranges.append(start)
+            self.active += 1
+            self.max_active = max(self.active, self.max_active)
+        time.sleep(self.latency)
+        with self.lock:
+            self.active -= 1
+        return super().read_range(start, end)
+
+
+def test_chunked_backfill(testdataset1: Dataset, tmp_path, monkeypatch):
+    name = "test/data.bin"
+    source = settings.ARCHIVE_PATH / name
+    source.parent.mkdir(parents=True, exist_ok=True)
+    source.write_bytes(os.urandom(10_000))
+    monkeypatch.setattr(settings, "ARCHIVE_CHUNK_SIZE", 1000)
+
+    # Chunks are fetched in parallel, which benchmarks faster than one at a time:
+    timings = {}
+    for workers in (1, 8):
+        monkeypatch.setattr(settings, "ARCHIVE_WORKERS", workers)
+        object = SlowObject(name)
+        dest = tmp_path / f"data-{workers}.bin"
+        start = time.monotonic()
+        object.backfill(dest)
+        timings[workers] = time.monotonic() - start
+        assert dest.read_bytes() == source.read_bytes()
+        assert len(object.ranges) == 10
+        assert object.max_active <= workers
+        assert (object.max_active > 1) == (workers > 1)
+    assert timings[8] < timings[1], timings
+
+    # An interrupted download is resumed without fetching the same chunks again:
+    monkeypatch.setattr(settings, "ARCHIVE_WORKERS", 1)
+    dest = tmp_path / "resumed.bin"
+    object = SlowObject(name, latency=0, fail_at=5000)
+    with pytest.raises(IOError):
+        object.backfill(dest)
+    assert not dest.exists()
+    object = SlowObject(name, latency=0)
+    object.backfill(dest)
+    assert sorted(object.ranges) == [5000, 6000, 7000, 8000, 9000]
+    assert dest.read_bytes() == source.read_bytes()
+    assert list(tmp_path.glob("resumed.bin.*")) == []
+
+    # Corrupted downloads are rejected:
+    object = SlowObject(name, latency=0)
+    monkeypatch.setattr(object, "checksum", lambda: "xxx")
+    with pytest.raises(RuntimeError):
+        object.backfill(tmp_path / "corrupt.bin")
+    assert list(tmp_path.glob("corrupt.bin*")) == []
+
+    # Reading the object streams the ranges in order:
+    source.write_text("hello\n" * 1000)
+    object = SlowObject(name)
+    with object.open() as fh:
+        assert fh.read() == source.read_text()
+    assert sorted(object.ranges) == object.ranges
+    assert len(object.ranges) == 6
+
+
+def test_file_system_checksum(tmp_path):
+    source = tmp_path / "source.txt"
+    source.write_text("hello, world!\n")
+    backend = FileSystemBackend()
+    object = backend.get_object("test/checksum.txt")
+    assert object.checksum() is None
+    object.publish(source)
+    assert object.checksum() == md5_checksum(source)
+    copy = backend.get_object("test/checksum-copy.txt")
+    copy.republish(object.name)
+    assert copy.checksum() == md5_checksum(source)
+    copy.backfill(tmp_path / "copy.txt")
+    assert (tmp_path / "copy.txt").read_text() == "hello, world!\n"
+
+    # A checksum which doesn't match the file fails the download:
+    data = json.loads(copy.checksum_path.read_text())
+    data["md5"] = md5_checksum(copy.checksum_path)
+    copy.checksum_path.write_text(json.dumps(data))
+    with pytest.raises(RuntimeError):
+        copy.backfill(tmp_path / "corrupt.txt")
+
+    # A file replaced outside of publishing has no known checksum:
+    time.sleep(0.01)
+    object.path.write_text("goodbye!\n")
+    assert object.checksum() is None
+
+
+def test_artifact_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "ARCHIVE_CACHE_PATH", str(tmp_path / "cache"))
+    monkeypatch.setattr(settings, "ARCHIVE_CACHE_SIZE", 1)
+    get_artifact_cache.cache_clear()
+    try:
+        cache = get_artifact_cache()
+        assert cache is not None
+        name = "test/cached.txt"
+        source = settings.ARCHIVE_PATH / name
+        source.parent.mkdir(parents=True, exist_ok=True)
+        source.write_text("hello, world!\n")
+
+        # Concurrent readers download the object once:
+        objects = [SlowObject(name) for _ in range(4)]
+        dests = [tmp_path / f"dest-{i}.txt" for i in range(4)]
+        threads = [
+            threading.Thread(target=o.backfill, args=(d,))
+            for o, d in zip(objects, dests)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sum(len(o.ranges) for o in objects) == 1
+        assert all(d.read_text() == "hello, world!\n" for d in dests)
+        assert cache.misses == 1 and cache.hits == 3
+
+        object = SlowObject(name)
+        with object.open() as fh:
+            assert fh.read() == "hello, world!\n"
+        assert len(object.ranges) == 0
+
+        # A new version of the object is not served from the cache:
+        time.sleep(0.01)
+        source.write_text("goodbye!\n")
+        object = SlowObject(name)
+        with object.open() as fh:
+            assert fh.read() == "goodbye!\n"
+        assert len(object.ranges) == 1
+        assert len(cache._entries()) == 2
+
+        # Least recently used entries are evicted beyond the size limit:
+        other = settings.ARCHIVE_PATH / "test/large.bin"
+        other.write_bytes(os.urandom(800_000))
+        SlowObject("test/large.bin").backfill(tmp_path / "large.bin")
+        old = SlowObject(name)
+        old.backfill(tmp_path / "again.txt")
+        assert len(old.ranges) == 0
+        cache.max_size = 500_000
+        cache.evict()
+        entries = cache._entries()
+        assert len(entries) == 1
+        assert entries[0][1] == len("goodbye!\n")
+        # The lock files of evicted entries are removed with them:
+        assert len(list(cache.path.glob(f"*/*{LOCK_SUFFIX}"))) == 1
+    finally:
+        get_artifact_cache.cache_clear()
+
+
+def test_cache_lock_removed(tmp_path):
+    lock = tmp_path / f"entry{LOCK_SUFFIX}"
+    acquired = threading.Event()
+
+    def wait_for_lock() -> None:
+        with _locked(lock):
+            assert lock.exists()
+            acquired.set()
+
+    # A lock waited on while its file is deleted is taken on the new file:
+    with _locked(lock):
+        waiter = threading.Thread(target=wait_for_lock)
+        waiter.start()
+        time.sleep(0.05)
+        lock.unlink()
+    waiter.join(timeout=5)
+    assert acquired.is_set()
+    with _locked(lock, blocking=False) as free:
+        assert free
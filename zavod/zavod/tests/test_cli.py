@@ -1,6 +1,7 @@
 import shutil
 from click.testing import CliRunner
 
+import zavod.cli
 from zavod import settings
 from zavod.meta import Dataset
 from zavod.integration import get_resolver
@@ -66,6 +67,15 @@ def test_dump_file():
     shutil.rmtree(settings.DATA_PATH)
 
 
+def test_cache_sweep():
+    runner = CliRunner()
+    result = runner.invoke(cli, ["cache-sweep", "/dev/null"])
+    assert result.exit_code != 0, result.output
+    result = runner.invoke(cli, ["cache-sweep", DATASET_1_YML.as_posix()])
+    assert result.exit_code == 0, result.output
+    shutil.rmtree(settings.DATA_PATH)
+
+
 def test_run_dataset(testdataset1: Dataset):
     latest_path = settings.ARCHIVE_PATH / "datasets" / "latest" / testdataset1.name
     artifacts_path = (
@@ -114,6 +124,8 @@ def test_run_validation_failed(testdataset3: Dataset):
     assert "Assertion failed for value" in result.output, result.output
     with open(artifacts_path / "issues.json", "r") as f:
         assert "Assertion failed for value" in f.read()
+    # Exports from the same pass are not published
+    assert not (artifacts_path / "entities.ftm.json").exists()
     shutil.rmtree(settings.DATA_PATH)
 
 
@@ -138,3 +150,18 @@ def test_xref_dataset(testdataset1: Dataset):
     get_resolver.cache_clear()
     resolver = get_resolver()
     assert len(resolver.edges) == 0
+
+
+def test_run_export_failed(testdataset1: Dataset, monkeypatch):
+    failures = []
+
+    def export_dataset(*args, **kwargs):
+        raise ValueError("Exporter crashed")
+
+    monkeypatch.setattr(zavod.cli, "export_dataset", export_dataset)
+    monkeypatch.setattr(zavod.cli, "publish_failure", failures.append)
+    runner = CliRunner()
+    result = runner.invoke(cli, ["run", DATASET_1_YML.as_posix()])
+    assert result.exit_code != 0, result.output
+    # Only a validation abort publishes the run as failed:
+    assert failures == []
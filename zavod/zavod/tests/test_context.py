@@ -1,19 +1,28 @@
+import time
 from typing import cast
 from datetime import datetime
 
 import pytest
 import requests_mock
+from requests import Response
 from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError
 import orjson
 from lxml import etree
+from nomenklatura.versions import Version
 
 from zavod import settings
 from zavod.context import Context
 from zavod.meta import Dataset
 from zavod.entity import Entity
 from zavod.crawl import crawl_dataset
-from zavod.archive import iter_dataset_statements
-from zavod.runtime.http_ import request_hash
+from zavod.publish import _publish_artifacts
+from zavod.runtime.versions import make_version
+from zavod.archive import iter_dataset_statements, clear_data_path
+from zavod.meta.http import HTTP
+from zavod.runtime.http_ import request_hash, make_session
+from zavod.runtime.http_ import LimitedAdapter, RateLimiter
+from zavod.runtime.stats import HTTPStats
 from zavod.runtime.cache import get_cache, get_engine, get_metadata
 from zavod.runtime.sink import DatasetSink
 from zavod.exc import RunFailedException
@@ -73,6 +82,97 @@ def test_context_helpers(testdataset1: Dataset):
     context.close()
 
 
+def test_context_emit_many(testdataset1: Dataset):
+    crawl_dataset(testdataset1)
+    stmts = list(iter_dataset_statements(testdataset1, external=False))
+    prev_time = stmts[0].first_seen
+    by_entity = {}
+    for stmt in stmts:
+        by_entity.setdefault(stmt.entity_id, []).append(stmt)
+    entities = [Entity.from_statements(testdataset1, s) for s in by_entity.values()]
+
+    context = Context(testdataset1)
+    context.timestamps.index(stmts)
+    assert context.data_time_iso != "2030-01-01T00:00:00"
+    context.data_time = datetime(2030, 1, 1)
+    context.emit_many(entities, batch_size=3)
+    assert context.stats.entities == len(entities)
+    assert context.stats.statements == len(stmts)
+    assert context.stats.changed == len(stmts)
+    context.close()
+
+    for stmt in iter_dataset_statements(testdataset1):
+        assert stmt.first_seen == prev_time, stmt
+        assert stmt.last_seen == "2030-01-01T00:00:00", stmt
+
+
+def test_context_emit_previous(testdataset1: Dataset):
+    crawl_dataset(testdataset1)
+    stmts = list(iter_dataset_statements(testdataset1))
+    _publish_artifacts(testdataset1)
+    clear_data_path(testdataset1.name)
+
+    make_version(testdataset1, Version.new("bbb"), overwrite=True)
+    context = Context(testdataset1)
+    assert context.data_time_iso != "2030-01-01T00:00:00"
+    context.data_time = datetime(2030, 1, 1)
+    context.emit_previous()
+    assert context.stats.statements == len(stmts)
+    assert context.stats.changed == len(stmts)
+    context.close()
+
+    previous = {s.id: s for s in stmts}
+    again = list(iter_dataset_statements(testdataset1))
+    assert len(again) == len(stmts)
+    for stmt in again:
+        assert stmt.first_seen == previous[stmt.id].first_seen, stmt
+        assert stmt.target == previous[stmt.id].target, stmt
+        assert stmt.last_seen == "2030-01-01T00:00:00", stmt
+
+
+def test_context_archive_sources(testdataset1: Dataset, monkeypatch):
+    monkeypatch.setattr(testdataset1.http, "archive_sources", True)
+    url = "https://test.com/data.xml"
+    data = "<data>%s</data>" % ("Hello, World!" * 100)
+    make_version(testdataset1, Version.new("aaa"), overwrite=True)
+    context = Context(testdataset1)
+    with requests_mock.Mocker() as m:
+        m.get(url, text=data, headers={"ETag": '"v1"'})
+        path = context.fetch_resource("data.xml", url)
+        assert "If-None-Match" not in m.last_request.headers
+    assert not context.is_source_unchanged("data.xml")
+    context.close()
+    _publish_artifacts(testdataset1)
+    clear_data_path(testdataset1.name)
+
+    # The server reports that the file is unchanged:
+    make_version(testdataset1, Version.new("bbb"), overwrite=True)
+    context = Context(testdataset1)
+    with requests_mock.Mocker() as m:
+        m.get(url, status_code=304)
+        path = context.fetch_resource("data.xml", url)
+        assert m.last_request.headers["If-None-Match"] == '"v1"'
+    assert context.is_source_unchanged("data.xml")
+    with open(path, "r") as fh:
+        assert fh.read() == data
+    context.close()
+    _publish_artifacts(testdataset1)
+    clear_data_path(testdataset1.name)
+
+    # The copy archived with the first version is still used:
+    make_version(testdataset1, Version.new("ccc"), overwrite=True)
+    context = Context(testdataset1)
+    with requests_mock.Mocker() as m:
+        m.get(url, text="<data />", headers={"ETag": '"v2"'})
+        path = context.fetch_resource("data.xml", url)
+        assert m.last_request.headers["If-None-Match"] == '"v1"'
+    assert not context.is_source_unchanged("data.xml")
+    with open(path, "r") as fh:
+        assert fh.read() == "<data />"
+    assert context.sources.fetched(context.version.id) == ["data.xml"]
+    context.close()
+
+
 def test_context_dry_run(testdataset1: Dataset):
     context = Context(testdataset1, dry_run=True)
     assert context.dataset == testdataset1
@@ -152,6 +252,86 @@ def test_context_get_fetchers(testdataset1: Dataset):
     get_metadata.cache_clear()
 
 
+def test_context_fetch_many(testdataset1: Dataset):
+    context = Context(testdataset1)
+    urls = [f"https://test.com/page/{i}" for i in range(20)]
+
+    with requests_mock.Mocker() as m:
+        for url in urls:
+            m.get(url, text=url.upper())
+        results = list(context.fetch_many(urls, cache_days=14))
+        assert [u for u, _ in results] == urls
+        assert all(text == url.upper() for url, text in results)
+        assert m.call_count == len(urls)
+
+        # Cached responses are not fetched again:
+        more = urls + ["https://test.com/page/new"]
+        m.get("https://test.com/page/new", text="NEW")
+        results = list(context.fetch_many(more, cache_days=14, ordered=False))
+        assert sorted(u for u, _ in results) == sorted(more)
+        assert m.call_count == len(urls) + 1
+
+    with requests_mock.Mocker() as m:
+        m.get("https://test.com/page/fail", status_code=500)
+        with pytest.raises(HTTPError):
+            list(context.fetch_many(["https://test.com/page/fail"]))
+
+    context.close()
+    get_cache.cache_clear()
+    get_engine.cache_clear()
+    get_metadata.cache_clear()
+
+
+def test_rate_limiter():
+    conf = HTTP({"rate_limit": 20, "host_rate_limits": {"fast.com": 1000}})
+    limiter = RateLimiter(conf)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.wait("https://test.com/a")
+    for _ in range(5):
+        limiter.wait("https://fast.com/a")
+    # Four intervals for the first host, almost none for the other:
+    assert time.monotonic() - start >= 0.19
+    assert time.monotonic() - start < 1.0
+
+    # Throttling halves the rate and honours Retry-After:
+    limiter.throttle("https://test.com/a", retry_after=0.2)
+    assert limiter._bucket("https://test.com/a").rate == 10
+    assert limiter.wait("https://test.com/a") >= 0.2
+    limiter.recover("https://test.com/a")
+    assert limiter._bucket("https://test.com/a").rate == 11
+
+    # Hosts without a rate limit only wait when they are blocked:
+    limiter = RateLimiter(HTTP({}))
+    assert limiter.wait("https://test.com/a") == 0.0
+    limiter.throttle("https://test.com/a", retry_after=0.1)
+    assert limiter.wait("https://test.com/a") > 0.05
+    assert limiter._bucket("https://test.com/a").rate is None
+
+
+def test_limited_adapter():
+    stats = HTTPStats()
+    session = make_session(HTTP({"max_concurrency": 12}), stats=stats)
+    adapter = cast(LimitedAdapter, session.get_adapter("https://test.com"))
+    assert isinstance(adapter, LimitedAdapter)
+    assert adapter._pool_maxsize == 12
+
+    response = Response()
+    response.status_code = 429
+    response.headers["Retry-After"] = "0"
+    adapter.observe("https://test.com/a", response, 0.5)
+    response = Response()
+    response.status_code = 200
+    adapter.observe("https://test.com/a", response, 0.1)
+    assert stats.requests == 2
+    assert stats.throttled == 1
+    assert stats.percentile(50) == 0.5
+    data = stats.as_dict()
+    assert data["requests"] == 2
+    assert data["latency_p99"] == 0.5
+    session.close()
+
+
 def test_context_post_fetchers(testdataset1: Dataset):
     context = Context(testdataset1)
 
@@ -22,6 +22,10 @@ TEST_DATASET = {
         "backoff_factor": 0.5,
         "retry_statuses": [500],
         "retry_methods": ["GET"],
+        "max_concurrency": 8,
+        "rate_limit": 2,
+        "burst": 3,
+        "host_rate_limits": {"api.example.com": 0.5},
     },
 }
 
@@ -81,6 +85,11 @@ def test_basic():
     assert test_ds.http.retry_methods == ["GET"]
     assert test_ds.http.backoff_factor == 0.5
     assert test_ds.http.user_agent == settings.HTTP_USER_AGENT
+    assert test_ds.http.max_concurrency == 8
+    assert test_ds.http.rate_limit == 2.0
+    assert test_ds.http.burst == 3
+    assert test_ds.http.get_rate_limit("api.example.com") == 0.5
+    assert test_ds.http.get_rate_limit("example.com") == 2.0
 
 
 def test_validation(testdataset1: Dataset, testdataset3: Dataset):
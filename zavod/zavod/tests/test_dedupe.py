@@ -27,6 +27,30 @@ def test_store_access(testdataset1: Dataset):
         assert edge.user == AUTO_USER
 
 
+def test_parallel_xref(testdataset1: Dataset):
+    crawl_dataset(testdataset1)
+    resolver = get_resolver()
+    store = get_store(testdataset1, resolver)
+    store.sync()
+    state_path = dataset_state_path(testdataset1.name)
+    blocking_xref(store, state_path)
+    serial = {k: e.score for k, e in resolver.edges.items()}
+    assert len(serial)
+
+    blocking_xref(store, state_path, score_workers=2)
+    parallel = {k: e.score for k, e in resolver.edges.items()}
+    assert parallel == serial
+    for edge in resolver.edges.values():
+        assert edge.user == AUTO_USER
+
+    blocking_xref(store, state_path, index_type="numpy")
+    numpy_edges = {k: e.score for k, e in resolver.edges.items()}
+    assert numpy_edges == serial
+    with pytest.raises(ValueError):
+        blocking_xref(store, state_path, index_type="foo")
+    store.close()
+
+
 def test_resolve_dedupe(testdataset1: Dataset):
     stats = crawl_dataset(testdataset1)
     resolver = get_resolver()
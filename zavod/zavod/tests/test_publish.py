@@ -11,6 +11,7 @@ from zavod.crawl import crawl_dataset
 from zavod.store import get_store
 from zavod.exporters import export_dataset
 from zavod.integration import get_resolver
+from zavod import publish
 from zavod.publish import publish_dataset, publish_failure
 from zavod.exc import RunFailedException
 
@@ -93,3 +94,32 @@ def test_publish_failure(testdataset1: Dataset):
     assert artifact_path.joinpath("issues.json").exists()
     assert artifact_path.joinpath("index.json").exists()
     assert latest_path.joinpath("index.json").exists()
+
+
+def test_publish_order(testdataset1: Dataset, monkeypatch):
+    crawl_dataset(testdataset1)
+    store = get_store(testdataset1, get_resolver())
+    store.sync()
+    export_dataset(testdataset1, store.view(testdataset1))
+    store.close()
+
+    uploads = []
+    for func in ("publish_artifact", "publish_resource", "publish_dataset_version"):
+        original = getattr(publish, func)
+
+        def record(*args, _func=original, _name=func, **kwargs):
+            _func(*args, **kwargs)
+            uploads.append((_name, args[-1] if len(args) > 1 else args[0]))
+
+        monkeypatch.setattr(publish, func, record)
+    monkeypatch.setattr(settings, "PUBLISH_WORKERS", 3)
+    publish_dataset(testdataset1, latest=False)
+
+    names = [name for _, name in uploads]
+    assert uploads[-1][0] == "publish_dataset_version"
+    assert "entities.ftm.json" in names
+    assert STATEMENTS_FILE in names
+    # Metadata is published after everything else:
+    tail = {INDEX_FILE, VERSIONS_FILE}
+    assert set(names[-4:-1]) == tail, names
+    assert not tail.intersection(names[:-4]), names
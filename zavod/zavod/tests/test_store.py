@@ -1,8 +1,11 @@
+from typing import List, Tuple
+from nomenklatura.versions import Version
+
 from zavod import settings
 from zavod.meta import Dataset
 from zavod.crawl import crawl_dataset
 from zavod.integration import get_resolver
-from zavod.store import get_store
+from zavod.store import get_store, cached_view, Store
 
 
 def test_store_access(testdataset1: Dataset):
@@ -34,3 +37,107 @@ def test_store_access(testdataset1: Dataset):
     store.clear()
     empty = store.view(testdataset1, external=False)
     assert len(list(empty.entities())) == 0
+
+
+def test_store_snapshot(testdataset1: Dataset, tmp_path):
+    resolver = get_resolver()
+    crawl_dataset(testdataset1)
+    store = get_store(testdataset1, resolver)
+    store.sync()
+    view = store.view(testdataset1)
+    ids = sorted(e.id for e in view.entities())
+    store.snapshot(tmp_path / "snapshot")
+
+    # The store stays open and the snapshot can be opened next to it:
+    copy = Store(testdataset1, resolver, path=tmp_path / "snapshot")
+    copy_view = copy.view(testdataset1)
+    assert sorted(e.id for e in copy_view.entities()) == ids
+    assert sorted(e.id for e in view.entities()) == ids
+    copy.close()
+    store.close()
+
+
+def test_cached_view(testdataset1: Dataset):
+    crawl_dataset(testdataset1)
+    store = get_store(testdataset1, get_resolver())
+    store.sync()
+    view = store.view(testdataset1)
+    cached = cached_view(view)
+    for entity in view.entities():
+        expected = [(p.name, a.id) for p, a in view.get_adjacent(entity)]
+        for _ in range(3):
+            adjacent = [(p.name, a.id) for p, a in cached.get_adjacent(entity)]
+            assert adjacent == expected, entity.id
+    # Every adjacent entity was read from the store only once:
+    assert 0 < cached.misses <= len(list(view.entities()))
+    assert cached.hits > 0
+    assert cached.get_entity("osv-john-doe") is cached.get_entity("osv-john-doe")
+    assert cached.get_entity("no-such-entity") is None
+
+    small = cached_view(view)
+    small.cache_size = 2
+    ids = [e.id for e in view.entities()]
+    for entity_id in ids:
+        small.get_entity(entity_id)
+    assert len(small._entities) == 2
+    store.close()
+
+
+def test_store_parallel_sync(
+    testdataset1: Dataset, testdataset2: Dataset, collection: Dataset
+):
+    resolver = get_resolver()
+    crawl_dataset(testdataset1)
+    crawl_dataset(testdataset2)
+    store = get_store(collection, resolver)
+    store.sync(workers=1)
+    sequential = list(store.db.iterator())
+    assert len(sequential) > 10
+    store.sync(clear=True, workers=2)
+    parallel = list(store.db.iterator())
+    assert sequential == parallel
+    store.close()
+
+
+def _store_data(store: Store) -> List[Tuple[bytes, bytes]]:
+    data: List[Tuple[bytes, bytes]] = []
+    for key, value in store.db.iterator():
+        if key.split(b":", 1)[0] in (b"s", b"x", b"e", b"i", b"ls"):
+            data.append((key, value))
+    return data
+
+
+def test_store_incremental_sync(
+    testdataset1: Dataset, testdataset2: Dataset, collection: Dataset
+):
+    resolver = get_resolver()
+    crawl_dataset(testdataset1)
+    crawl_dataset(testdataset2)
+    store = get_store(collection, resolver)
+    store.sync(incremental=True)
+    full = _store_data(store)
+    versions = store._stored_versions()
+    assert set(versions.keys()) == {testdataset1.name, testdataset2.name}
+
+    # Nothing changed:
+    store.sync(incremental=True)
+    assert _store_data(store) == full
+
+    # Removing a source leaves only the statements of the other:
+    store._remove_datasets({testdataset2.name})
+    single = get_store(testdataset1, resolver)
+    single.sync()
+    assert _store_data(store) == _store_data(single)
+    single.close()
+
+    # A new version of a source is re-loaded:
+    orig_version = settings.RUN_VERSION
+    settings.RUN_VERSION = Version.new()
+    try:
+        crawl_dataset(testdataset2)
+    finally:
+        settings.RUN_VERSION = orig_version
+    store.sync(incremental=True)
+    assert store._stored_versions()[testdataset2.name] != versions[testdataset2.name]
+    assert _store_data(store) == full
+    store.close()
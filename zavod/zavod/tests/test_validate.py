@@ -1,3 +1,4 @@
+import pytest
 from typing import Type
 from structlog.testing import capture_logs
 
@@ -11,7 +12,10 @@ from zavod.validators import (
     TopiclessTargetValidator,
     EmptyValidator,
 )
-from zavod.archive import clear_data_path
+from zavod.exc import RunFailedException
+from zavod.exporters import export_data
+from zavod.exporters.ftm import FtMExporter
+from zavod.archive import clear_data_path, dataset_resource_path, HASH_FILE
 from zavod.crawl import crawl_dataset
 from zavod.validators.assertions import AssertionsValidator
 from zavod.validators.common import BaseValidator
@@ -117,3 +121,38 @@ def test_empty(testdataset3) -> None:
     logs = [f"{entry['log_level']}: {entry['event']}" for entry in cap_logs]
     assert "warning: No entities validated." in logs, logs
     assert validator.abort is False
+
+
+def test_validate_with_export(testdataset3) -> None:
+    clear_data_path(testdataset3.name)
+    crawl_dataset(testdataset3)
+    context = Context(testdataset3)
+    context.begin(clear=True)
+    store = get_store(testdataset3, get_dataset_linker(testdataset3))
+    store.sync()
+    view = store.view(testdataset3)
+
+    with capture_logs() as cap_logs:
+        export_data(context, view, validators=[TopiclessTargetValidator])
+    logs = [f"{entry['log_level']}: {entry['event']}" for entry in cap_logs]
+    assert "warning: td3-target-no-topic-co is a target but has no topics" in logs
+    ftm_path = dataset_resource_path(testdataset3.name, FtMExporter.FILE_NAME)
+    assert ftm_path.exists()
+    names = [r.name for r in context.resources.all()]
+    assert FtMExporter.FILE_NAME in names
+
+    # Left behind by a delta export, which must not be published:
+    hash_path = dataset_resource_path(testdataset3.name, HASH_FILE)
+    hash_path.touch()
+    with capture_logs() as cap_logs:
+        with pytest.raises(RunFailedException):
+            export_data(context, view, validators=[AssertionsValidator])
+    logs = [f"{entry['log_level']}: {entry['event']}" for entry in cap_logs]
+    assert "error: One or more assertions failed." in logs, logs
+    assert not ftm_path.exists()
+    assert not hash_path.exists()
+    names = [r.name for r in context.resources.all()]
+    assert FtMExporter.FILE_NAME not in names
+
+    store.close()
+    context.close()
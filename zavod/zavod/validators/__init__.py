@@ -6,7 +6,7 @@ from zavod.archive import dataset_data_path
 from zavod.context import Context
 from zavod.exc import RunFailedException
 from zavod.meta.dataset import Dataset
-from zavod.store import View
+from zavod.store import View, cached_view
 from zavod.entity import Entity
 from zavod.validators.assertions import AssertionsValidator
 from zavod.validators.common import BaseValidator
@@ -102,6 +102,7 @@ def validate_dataset(dataset: Dataset, view: View) -> None:
             dataset=dataset_data_path(dataset.name),
         )
 
+        view = cached_view(view)
         validators = [validator(context, view) for validator in VALIDATORS]
         for idx, entity in enumerate(view.entities()):
             if idx > 0 and idx % 10000 == 0:
@@ -115,6 +116,7 @@ def validate_dataset(dataset: Dataset, view: View) -> None:
             validator.finish()
             if validator.abort:
                 abort = True
+        view.log_stats()
 
         if abort:
             raise RunFailedException("Validation caused abort.")
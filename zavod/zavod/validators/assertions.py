@@ -1,9 +1,10 @@
-from typing import Dict, Any, Optional, cast
+from typing import Dict, List, Any, Optional, cast
 from zavod.context import Context
 
 from zavod.entity import Entity
 from zavod.meta.assertion import Assertion, Comparison, Metric
-from zavod.exporters.statistics import Statistics
+from zavod.exporters.common import Exporter
+from zavod.exporters.statistics import Statistics, StatisticsExporter
 from zavod.validators.common import BaseValidator
 from zavod.store import View
 
@@ -62,10 +63,19 @@ class AssertionsValidator(BaseValidator):
     def __init__(self, context: Context, view: View) -> None:
         super().__init__(context, view)
         self.stats = Statistics()
+        self.observe = True
         self.abort = False
 
+    def attach(self, exporters: List[Exporter]) -> None:
+        # Re-use the statistics computed for the export, if any:
+        for exporter in exporters:
+            if isinstance(exporter, StatisticsExporter):
+                self.stats = exporter.stats
+                self.observe = False
+
     def feed(self, entity: Entity) -> None:
-        self.stats.observe(entity)
+        if self.observe:
+            self.stats.observe(entity)
 
     def finish(self) -> None:
         for assertion in self.context.dataset.assertions:
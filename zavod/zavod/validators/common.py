@@ -1,7 +1,12 @@
+from typing import TYPE_CHECKING, List
+
 from zavod.context import Context
 from zavod.store import View
 from zavod.entity import Entity
 
+if TYPE_CHECKING:
+    from zavod.exporters.common import Exporter
+
 
 class BaseValidator(object):
 
@@ -10,6 +15,11 @@ class BaseValidator(object):
         self.view = view
         self.abort = False
 
+    def attach(self, exporters: List["Exporter"]) -> None:
+        """Called with the set up exporters when the validator is fed from the
+        same pass over the entities as an export."""
+        return None
+
     def feed(self, entity: Entity) -> None:
         raise NotImplementedError()
 